@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""Measure clean_nerve scan throughput against a fake ZooKeeper.
+
+Synthetic registration trees of each of --nodes instance nodes are built in
+the in-memory FakeZooKeeper from tests/fake_zk.py, and clean_nerve run against
+them with each of --max-in-flight, reporting nodes/sec. Every request to the
+fake takes --latency-ms to complete, as a round trip to a real ensemble
+would, but any number may be outstanding at once; with no latency, the
+benchmark measures clean_nerve's own overhead.
+
+    python benchmarks/clean_nerve_benchmark.py [--nodes N ...] [--max-in-flight N ...] [--latency-ms N] [--delete]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# Run from a checkout, so import nerve_tools and the fake from there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from nerve_tools import clean_nerve  # noqa: E402
+from nerve_tools.zk_topology import SMARTSTACK_ROOT  # noqa: E402
+from tests.fake_zk import FakeZooKeeper  # noqa: E402
+from tests.fake_zk import build_registration_tree  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--instances-per-service", type=int, default=20)
+    parser.add_argument("--orphan-every", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--max-in-flight", type=int, nargs="+", default=[64])
+    parser.add_argument("--delete", action="store_true", help="Delete the orphans rather than simulating")
+    args = parser.parse_args()
+
+    for node_count in args.nodes:
+        for max_in_flight in args.max_in_flight:
+            # Deleting changes the tree, so build a fresh one each time
+            zk = FakeZooKeeper(args.latency_ms / 1000)
+            services = max(1, node_count // args.instances_per_service)
+            build_registration_tree(
+                zk,
+                SMARTSTACK_ROOT,
+                services,
+                args.instances_per_service,
+                args.orphan_every,
+            )
+            stats = clean_nerve.ScanStats()
+
+            start = time.monotonic()
+            removed = clean_nerve.clean(
+                simulate=not args.delete,
+                zk=zk,
+                roots=[SMARTSTACK_ROOT],
+                max_in_flight=max_in_flight,
+                stats=stats,
+            )
+            elapsed = time.monotonic() - start
+            print(
+                f"nodes={stats.nodes_scanned:<8} max_in_flight={max_in_flight:<5} "
+                f"{stats.nodes_scanned / elapsed:10.0f} nodes/sec "
+                f"({sum(removed.values())} orphans, {elapsed:.2f}s)"
+            )
+
+
+if __name__ == "__main__":
+    main()
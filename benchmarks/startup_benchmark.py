@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""Check that every nerve-tools entry point starts up within its budget.
+
+Each entry point module is imported in a fresh interpreter with
+`-X importtime` and the cumulative import time of nerve_tools is compared
+with the budget below. The median of several runs is used to smooth out
+noise. Exits non-zero if any entry point is over budget.
+
+    python benchmarks/startup_benchmark.py [--runs N]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+from typing import Dict
+
+# Milliseconds. These leave headroom over what the tools take today, but are
+# far below what importing paasta_tools, environment_tools, requests etc. at
+# load time costs, so deferring one of those imports by mistake will fail.
+STARTUP_BUDGETS_MS: Dict[str, float] = {
+    "nerve_tools.clean_nerve": 60,
+    "nerve_tools.configure_nerve": 60,
+    "nerve_tools.updown_service": 60,
+}
+
+
+def measure_import_time_ms(
+    module: str,
+) -> float:
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+
+    total_us = 0
+    for line in output.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or line.endswith("imported package"):
+            continue
+        _, cumulative, name = line.split("|")
+        # Only count top-level imports, the nested ones are already included
+        if not name.startswith(" ") or name[1:2] == " ":
+            continue
+        if name.strip().startswith("nerve_tools"):
+            total_us += int(cumulative)
+    return total_us / 1000
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    for module, budget_ms in sorted(STARTUP_BUDGETS_MS.items()):
+        elapsed_ms = statistics.median(measure_import_time_ms(module) for _ in range(args.runs))
+        status = "ok" if elapsed_ms <= budget_ms else "OVER BUDGET"
+        failed |= elapsed_ms > budget_ms
+        print(f"{module:32} {elapsed_ms:8.1f}ms (budget {budget_ms:.0f}ms) {status}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,29 +5,85 @@
 # This script will remove those nodes.  See SRV-1418 for more information.
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import glob
+import hashlib
+import json
 import logging
 import os
+import queue
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Generic
 from typing import Iterable
 from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import TypeVar
 
-import kazoo.client
-import kazoo.exceptions
-import yaml
+from nerve_tools.clean_nerve_report import CANDIDATE_REASONS
+from nerve_tools.clean_nerve_report import REPORT_FORMATS
+from nerve_tools.clean_nerve_report import LatencyHistogram
+from nerve_tools.clean_nerve_report import ScanStats
+from nerve_tools.clean_nerve_report import get_candidate_reasons
+from nerve_tools.clean_nerve_report import write_report
+from nerve_tools.config import CleanNerveClusterResult
+from nerve_tools.util import get_hostname
+from nerve_tools.util import get_yaml_loader
+from nerve_tools.zk_topology import DEFAULT_ROOTS
+from nerve_tools.zk_topology import DEFAULT_ZK_TOPOLOGY_DIR
+from nerve_tools.zk_topology import ZK_DEFAULT_CLUSTER_TYPE
+from nerve_tools.zk_topology import get_indexed_zk_topology
+from nerve_tools.zk_topology import load_zk_topology_index
 
-try:
-    from yaml import CSafeLoader as Loader  # type: ignore
-except ImportError:
-    from yaml import SafeLoader as Loader  # type: ignore
+if TYPE_CHECKING:
+    import kazoo.client
+    from kazoo.interfaces import IAsyncResult
+    from kazoo.protocol.states import WatchedEvent
+    from kazoo.protocol.states import ZnodeStat
 
 
-# CEP 355 Zookeepers
-ZK_DEFAULT_CLUSTER_TYPE = "infrastructure"
-ZK_TOPOLOGY_DIR = "/nail/etc/zookeeper_discovery"
+ZK_TOPOLOGY_DIR = DEFAULT_ZK_TOPOLOGY_DIR
 
-LOG_FORMAT = "%(levelname)s %(message)s"
+# Maximum number of outstanding ZK read requests while scanning
+DEFAULT_MAX_IN_FLIGHT = 64
+
+# Number of orphaned nodes to delete per ZK transaction
+DEFAULT_DELETE_BATCH_SIZE = 50
+
+# Number of clusters to clean concurrently
+DEFAULT_WORKERS = 4
+
+# How long to wait to connect to a cluster before giving up on it
+DEFAULT_CONNECT_TIMEOUT_S = 10.0
+
+# How long a node must stay orphaned before the daemon removes it
+DEFAULT_GRACE_PERIOD_S = 60.0
+
+# Queued by OrphanWatcher when the Partition of services it owns changes
+_REBALANCE = ""
+
+# Services are scanned in chunks of this many, with progress checkpointed
+# after each one
+CHECKPOINT_INTERVAL_SERVICES = 100
+
+# Clusters are cleaned concurrently, see _thread_named
+LOG_FORMAT = "%(levelname)s [%(threadName)s] %(message)s"
 log = logging.getLogger()
 
+V = TypeVar("V")
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
@@ -43,12 +99,125 @@ def parse_args() -> argparse.Namespace:
         default=ZK_DEFAULT_CLUSTER_TYPE,
         help="Cluster type (default: %(default)s).",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT,
+        help="Maximum number of outstanding ZooKeeper reads while scanning (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--delete-batch-size",
+        type=int,
+        default=DEFAULT_DELETE_BATCH_SIZE,
+        help="Number of orphaned nodes to delete per ZooKeeper transaction (default: %(default)s).",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of clusters to clean concurrently (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=DEFAULT_CONNECT_TIMEOUT_S,
+        help="Seconds to wait to connect to each cluster (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--root",
+        dest="roots",
+        action="append",
+        help=f"Clean instance nodes of the services under this path.  May be given more than once "
+        f"(default: {' '.join(DEFAULT_ROOTS)}).",
+    )
+    parser.add_argument(
+        "--max-reads-per-second",
+        type=float,
+        help="Limit ZooKeeper reads to this many per second, per cluster (default: unlimited).",
+    )
+    parser.add_argument(
+        "--max-deletes-per-second",
+        type=float,
+        help="Limit ZooKeeper deletes to this many per second, per cluster (default: unlimited).",
+    )
+    parser.add_argument(
+        "--checkpoint-file",
+        type=str,
+        help="Record the last service cleaned in each cluster here, and resume after it on the next run.",
+    )
+    parser.add_argument(
+        "--max-services",
+        type=int,
+        help="Clean at most this many services under each root per cluster.  Use with --checkpoint-file to "
+        "clean a large tree in slices over several runs.",
+    )
+    parser.add_argument(
+        "--cversion-cache-file",
+        type=str,
+        help="Cache the cversion of each service here, and skip services whose children are unchanged since a "
+        "scan found nothing to remove.",
+    )
+    parser.add_argument(
+        "--full-scan",
+        action="store_true",
+        help="Scan every service, even those --cversion-cache-file says are unchanged.",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running, watching for and removing new orphans after the initial scan.",
+    )
+    parser.add_argument(
+        "--grace-period-s",
+        type=float,
+        default=DEFAULT_GRACE_PERIOD_S,
+        help="With --daemon, only remove nodes which are still orphaned after this many seconds "
+        "(default: %(default)s).",
+    )
+    parser.add_argument(
+        "--partition-path",
+        type=str,
+        help="Share each cluster's services with the other clean_nerve instances registered under this ZooKeeper "
+        "path, rather than cleaning them all.  Instances should either run as --daemon or be started together.",
+    )
+    parser.add_argument(
+        "--report-file",
+        type=str,
+        help="Write a report of what was found in each cluster here.",
+    )
+    parser.add_argument(
+        "--report-format",
+        choices=REPORT_FORMATS,
+        default="json",
+        help="json appends a line per cluster to --report-file on each run; prometheus replaces it with a "
+        "textfile for node_exporter (default: %(default)s).",
+    )
+    args = parser.parse_args()
+    if args.daemon:
+        # Only used by one-off runs, so would silently be ignored
+        for option, value in [
+            ("--checkpoint-file", args.checkpoint_file),
+            ("--max-services", args.max_services),
+            ("--cversion-cache-file", args.cversion_cache_file),
+            ("--report-file", args.report_file),
+        ]:
+            if value is not None:
+                parser.error(f"{option} can't be used with --daemon")
+    return args
 
 
 def get_zk_cluster_locations(
     cluster_type: str,
 ) -> Iterator[str]:
+    index = load_zk_topology_index(ZK_TOPOLOGY_DIR)
+    if index is not None:
+        symlinks = index["symlinks"].get(cluster_type, [])
+        for cluster_location in index["topologies"].get(cluster_type, {}):
+            if cluster_location not in symlinks:
+                yield cluster_location
+        return
+
     for path in glob.glob(f"{ZK_TOPOLOGY_DIR}/{cluster_type}/*.yaml"):
         if os.path.islink(path):
             # Ignore the 'local.yaml' symlink
@@ -60,42 +229,945 @@ def get_zk_topology(
     cluster_type: str,
     cluster_location: str,
 ) -> Iterable[str]:
+    index = load_zk_topology_index(ZK_TOPOLOGY_DIR)
+    if index is not None:
+        return get_indexed_zk_topology(index, cluster_type, cluster_location)
+
+    import yaml
+
     zk_topology_path = os.path.join(ZK_TOPOLOGY_DIR, cluster_type, cluster_location + ".yaml")
     with open(zk_topology_path) as fp:
-        zk_topology = yaml.load(fp, Loader=Loader)
+        zk_topology = yaml.load(fp, Loader=get_yaml_loader())
     return ["%s:%d" % (entry[0], entry[1]) for entry in zk_topology]
 
 
-def clean(
-    simulate: bool,
-    zk: kazoo.client.KazooClient,
+class TokenBucket:
+    """Limit operations to rate per second on average, while allowing bursts
+    of up to a second's worth."""
+
+    def __init__(
+        self,
+        rate: float,
+    ) -> None:
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+
+    def acquire(
+        self,
+        tokens: int = 1,
+    ) -> None:
+        """Block until tokens operations may go ahead.
+
+        Taking more tokens than the bucket holds is allowed; the caller just
+        waits until the debt has been paid off.
+        """
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+        self._tokens -= tokens
+        if self._tokens < 0:
+            time.sleep(-self._tokens / self.rate)
+
+
+class ClusterStateFile(Generic[V]):
+    """State kept between runs for one cluster, in a JSON file shared with
+    every other cluster."""
+
+    # Clusters are cleaned concurrently, each with their own instances
+    _lock = threading.Lock()
+
+    def __init__(
+        self,
+        path: str,
+        cluster_location: str,
+    ) -> None:
+        self.path = path
+        self.cluster_location = cluster_location
+
+    def _load_all(self) -> Dict[str, Dict[str, V]]:
+        try:
+            with open(self.path) as fp:
+                states: Dict[str, Dict[str, V]] = json.load(fp)
+            return states
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            log.warning("Ignoring corrupt state file %s" % self.path)
+            return {}
+
+    def load(self) -> Dict[str, V]:
+        with self._lock:
+            return self._load_all().get(self.cluster_location, {})
+
+    def save(
+        self,
+        state: Dict[str, V],
+    ) -> None:
+        with self._lock:
+            states = self._load_all()
+            states[self.cluster_location] = state
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as fp:
+                json.dump(states, fp, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+class ScanCheckpoint(ClusterStateFile[str]):
+    """The last service fully cleaned under each root of one cluster."""
+
+    def get_last_service(
+        self,
+        root: str,
+    ) -> Optional[str]:
+        return self.load().get(root)
+
+    def set_last_service(
+        self,
+        root: str,
+        service: Optional[str],
+    ) -> None:
+        """Record service as the last one cleaned, or with None, that a full
+        pass has been completed and the next should start from the top."""
+        checkpoints = self.load()
+        if service is None:
+            checkpoints.pop(root, None)
+        else:
+            checkpoints[root] = service
+        self.save(checkpoints)
+
+
+# The cversion of every service whose instances were all found to be in use
+# when it was last scanned, keyed by service path.
+CversionCache = ClusterStateFile[int]
+
+
+def _rendezvous_weight(
+    member: str,
+    path: str,
 ) -> int:
-    removed_count = 0
-    services: Iterable[str] = []
+    return int.from_bytes(hashlib.sha1(f"{member}:{path}".encode()).digest()[:8], "big")
+
+
+class Partition:
+    """This instance's share of the services in a cluster, when several
+    clean_nerve instances divide up the work.
+
+    Each instance registers an ephemeral node under member_path, and every
+    service belongs to the member with the highest rendezvous hash for it,
+    so when members come or go, only the services of those members move.
+    """
+
+    def __init__(
+        self,
+        zk: "kazoo.client.KazooClient",
+        member_path: str,
+    ) -> None:
+        from kazoo.recipe.party import ShallowParty
+
+        self.zk = zk
+        self.member_path = member_path
+        self._party = ShallowParty(zk, member_path, identifier=get_hostname())
+        self._members: List[str] = []
+        self._listeners: List[Callable[[], None]] = []
+        self._session_lost = False
+
+    @property
+    def member(self) -> str:
+        node: str = self._party.node
+        return node
+
+    def add_listener(
+        self,
+        listener: Callable[[], None],
+    ) -> None:
+        """Call listener (on kazoo's event thread) whenever the membership
+        changes."""
+        self._listeners.append(listener)
+
+    def join(self) -> None:
+        from kazoo.recipe.watchers import ChildrenWatch
+
+        self._party.join()
+        self.zk.add_listener(self._on_state_change)
+        ChildrenWatch(self.zk, self.member_path, self._on_members_changed)
+
+    def leave(self) -> None:
+        self.zk.remove_listener(self._on_state_change)
+        self._party.leave()
+
+    def _on_members_changed(
+        self,
+        members: List[str],
+    ) -> None:
+        log.info("Sharing services with %d clean_nerve instances" % len(members))
+        self._members = members
+        for listener in self._listeners:
+            listener()
+
+    def _on_state_change(
+        self,
+        state: str,
+    ) -> None:
+        from kazoo.protocol.states import KazooState
+
+        if state == KazooState.LOST:
+            self._session_lost = True
+        elif state == KazooState.CONNECTED and self._session_lost:
+            # Our member node went with the old session
+            self._session_lost = False
+            self.zk.handler.spawn(self._party.join)
 
-    services = zk.get_children("/smartstack/global")
-    for service in services:
-        instances = zk.get_children("/smartstack/global/%s" % service)
-        for instance in instances:
-            path = f"/smartstack/global/{service}/{instance}"
+    def owns(
+        self,
+        path: str,
+    ) -> bool:
+        members = self._members
+        if self.member not in members:
+            # Leave everything to the others until we have rejoined
+            return False
+        return max(members, key=lambda member: _rendezvous_weight(member, path)) == self.member
+
+
+def _pipeline(
+    requests: Iterable[Tuple[str, Callable[[], "IAsyncResult"]]],
+    max_in_flight: int,
+    limiter: Optional[TokenBucket] = None,
+    latency: Optional[LatencyHistogram] = None,
+) -> Iterator[Tuple[str, "IAsyncResult"]]:
+    """Submit each (key, request) while keeping at most max_in_flight of them
+    outstanding, and yield (key, async result) in submission order.
+
+    requests is consumed lazily, so it may itself depend on the results
+    yielded here.
+    """
+    window: Deque[Tuple[str, "IAsyncResult"]] = collections.deque()
+    for key, submit in requests:
+        if limiter is not None:
+            limiter.acquire()
+        result = submit()
+        if latency is not None:
+            latency.time(result)
+        window.append((key, result))
+        if len(window) >= max_in_flight:
+            yield window.popleft()
+    while window:
+        yield window.popleft()
+
+
+def get_instance_nodes(
+    zk: "kazoo.client.KazooClient",
+    root: str,
+    services: Iterable[str],
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    read_limiter: Optional[TokenBucket] = None,
+    watch: Optional[Callable[["WatchedEvent"], None]] = None,
+    read_latency: Optional[LatencyHistogram] = None,
+) -> Iterator[Tuple[str, bytes, "ZnodeStat"]]:
+    """Yield (path, data, stat) for every instance node of the given services,
+    optionally leaving watch set on the children of each service.
+
+    Rather than a blocking round trip per node, both the child listings and
+    the node reads are pipelined with a bounded number of requests in flight.
+    """
+    import kazoo.exceptions
+
+    service_paths = (f"{root}/{service}" for service in services)
+    listings = _pipeline(
+        ((path, functools.partial(zk.get_children_async, path, watch)) for path in service_paths),
+        max_in_flight,
+        read_limiter,
+        read_latency,
+    )
+
+    def get_instance_paths() -> Iterator[str]:
+        for service_path, result in listings:
             try:
-                data, stat = zk.get(path)
+                instances = result.get()
             except kazoo.exceptions.NoNodeError:
                 continue
+            for instance in instances:
+                yield f"{service_path}/{instance}"
+
+    reads = _pipeline(
+        ((path, functools.partial(zk.get_async, path)) for path in get_instance_paths()),
+        max_in_flight,
+        read_limiter,
+        read_latency,
+    )
+    for path, result in reads:
+        try:
+            data, stat = result.get()
+        except kazoo.exceptions.NoNodeError:
+            continue
+        yield path, data, stat
+
+
+def get_service_cversions(
+    zk: "kazoo.client.KazooClient",
+    root: str,
+    services: Iterable[str],
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    read_limiter: Optional[TokenBucket] = None,
+    read_latency: Optional[LatencyHistogram] = None,
+) -> Dict[str, int]:
+    """Return the cversion (number of changes to its children) of each of
+    the given services that still exists."""
+    stats = _pipeline(
+        ((service, functools.partial(zk.exists_async, f"{root}/{service}")) for service in services),
+        max_in_flight,
+        read_limiter,
+        read_latency,
+    )
+    cversions = {}
+    for service, result in stats:
+        stat = result.get()
+        if stat is not None:
+            cversions[service] = stat.cversion
+    return cversions
+
+
+def is_orphan(
+    data: bytes,
+    stat: "ZnodeStat",
+) -> bool:
+    return len(get_candidate_reasons(data, stat)) == len(CANDIDATE_REASONS)
+
+
+def delete_nodes(
+    zk: "kazoo.client.KazooClient",
+    nodes: Sequence[Tuple[str, int]],
+) -> int:
+    """Delete (path, version) nodes in a single transaction and return how
+    many were deleted.
+
+    Each delete is pinned to the version seen when the node was scanned, so a
+    node that has since been written to (or has gained children) is left
+    alone. Since the whole transaction fails if any one delete does, fall back
+    to deleting the nodes one by one in that case.
+    """
+    import kazoo.exceptions
+
+    transaction = zk.transaction()
+    for path, version in nodes:
+        transaction.delete(path, version=version)
+    results = transaction.commit()
+    if not any(isinstance(result, Exception) for result in results):
+        return len(nodes)
+
+    removed_count = 0
+    for path, version in nodes:
+        try:
+            zk.delete(path, version=version)
+            removed_count += 1
+        except kazoo.exceptions.NoNodeError:
+            pass
+        except (kazoo.exceptions.BadVersionError, kazoo.exceptions.NotEmptyError):
+            log.info("Not removing %s, it has changed since it was scanned" % path)
+    return removed_count
+
+
+def clean_root(
+    simulate: bool,
+    zk: "kazoo.client.KazooClient",
+    root: str,
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    delete_batch_size: int = DEFAULT_DELETE_BATCH_SIZE,
+    read_limiter: Optional[TokenBucket] = None,
+    delete_limiter: Optional[TokenBucket] = None,
+    checkpoint: Optional[ScanCheckpoint] = None,
+    max_services: Optional[int] = None,
+    cversion_cache: Optional[CversionCache] = None,
+    full_scan: bool = False,
+    partition: Optional[Partition] = None,
+    stats: Optional[ScanStats] = None,
+) -> int:
+    """Remove orphaned instance nodes under root, returning how many were (or
+    in simulate mode, would have been) removed.
+
+    With a cversion_cache, a service whose children haven't changed since a
+    scan that found nothing to remove is skipped, unless full_scan is set.
+    That misses an in-use node whose data is later emptied in place, so an
+    occasional full scan is still needed.
+
+    With a partition, only the services it owns are cleaned.
+
+    What was found is added to stats, if given.
+    """
+    read_latency = stats.read_latency if stats is not None else None
+    removed_count = 0
+    skipped_count = 0
+    to_delete: List[Tuple[str, int]] = []
+
+    def flush() -> int:
+        nonlocal to_delete
+        if not to_delete:
+            return 0
+        if delete_limiter is not None:
+            delete_limiter.acquire(len(to_delete))
+        count = delete_nodes(zk, to_delete)
+        if stats is not None:
+            stats.deletes_failed += len(to_delete) - count
+        to_delete = []
+        return count
+
+    if read_limiter is not None:
+        read_limiter.acquire()
+    # Sorted, so that a checkpoint is a position in a stable order
+    listing_start = time.monotonic()
+    services = sorted(zk.get_children(root))
+    if read_latency is not None:
+        read_latency.observe(time.monotonic() - listing_start)
+
+    cversions = cversion_cache.load() if cversion_cache is not None else {}
+    # Forget services which no longer exist
+    service_paths = {f"{root}/{service}" for service in services}
+    for path in list(cversions):
+        if path.startswith(f"{root}/") and path not in service_paths:
+            del cversions[path]
+
+    if partition is not None:
+        services = [service for service in services if partition.owns(f"{root}/{service}")]
+
+    last_service = checkpoint.get_last_service(root) if checkpoint is not None else None
+    if last_service is not None:
+        log.info("Resuming after %s" % last_service)
+        services = [service for service in services if service > last_service]
+    complete = max_services is None or len(services) <= max_services
+    if not complete:
+        services = services[:max_services]
+
+    # Deletes are flushed at the end of each chunk so that everything before
+    # the checkpoint really has been cleaned.
+    for start in range(0, len(services), CHECKPOINT_INTERVAL_SERVICES):
+        end = start + CHECKPOINT_INTERVAL_SERVICES
+        chunk = services[start:end]
+
+        if cversion_cache is not None:
+            chunk_cversions = get_service_cversions(zk, root, chunk, max_in_flight, read_limiter, read_latency)
+            to_scan = [
+                service
+                for service in chunk
+                if service in chunk_cversions
+                and (full_scan or cversions.get(f"{root}/{service}") != chunk_cversions[service])
+            ]
+            skipped_count += len(chunk) - len(to_scan)
+        else:
+            to_scan = chunk
+        if stats is not None:
+            stats.services_scanned += len(to_scan)
+
+        services_with_candidates = set()
+        for path, data, stat in get_instance_nodes(
+            zk,
+            root,
+            to_scan,
+            max_in_flight,
+            read_limiter,
+            read_latency=read_latency,
+        ):
+            reasons = get_candidate_reasons(data, stat)
+            if stats is not None:
+                stats.count_node(reasons)
+            if len(reasons) != len(CANDIDATE_REASONS):
+                continue
 
-            if len(data) != 0:
+            services_with_candidates.add(path.rpartition("/")[0])
+            log.info("Removing %s" % path)
+            if simulate:
+                removed_count += 1
                 continue
-            if stat.ephemeralOwner != 0:
+
+            to_delete.append((path, stat.version))
+            if len(to_delete) >= delete_batch_size:
+                removed_count += flush()
+
+        removed_count += flush()
+        if cversion_cache is not None:
+            for service in chunk:
+                service_path = f"{root}/{service}"
+                if service not in chunk_cversions or service_path in services_with_candidates:
+                    cversions.pop(service_path, None)
+                else:
+                    cversions[service_path] = chunk_cversions[service]
+        # A simulated run removes nothing, so mustn't let the next real one
+        # skip what it scanned
+        if checkpoint is not None and not simulate:
+            checkpoint.set_last_service(root, chunk[-1])
+
+    if checkpoint is not None and not simulate and complete:
+        checkpoint.set_last_service(root, None)
+    # Saved once per root rather than with each checkpoint, as the file holds
+    # every service of every cluster.  If the scan stops early, the services
+    # it got through are just scanned again next time.
+    if cversion_cache is not None:
+        cversion_cache.save(cversions)
+
+    if skipped_count:
+        log.info("Skipped %d services with unchanged children" % skipped_count)
+    if stats is not None:
+        stats.services_skipped += skipped_count
+    return removed_count
+
+
+def clean(
+    simulate: bool,
+    zk: "kazoo.client.KazooClient",
+    roots: Sequence[str] = DEFAULT_ROOTS,
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    delete_batch_size: int = DEFAULT_DELETE_BATCH_SIZE,
+    read_limiter: Optional[TokenBucket] = None,
+    delete_limiter: Optional[TokenBucket] = None,
+    checkpoint: Optional[ScanCheckpoint] = None,
+    max_services: Optional[int] = None,
+    cversion_cache: Optional[CversionCache] = None,
+    full_scan: bool = False,
+    partition: Optional[Partition] = None,
+    stats: Optional[ScanStats] = None,
+) -> Dict[str, int]:
+    """Clean each of roots in turn, returning how many nodes were removed
+    from each.  Roots which don't exist in this cluster are skipped."""
+    import kazoo.exceptions
+
+    removed_counts = {}
+    for root in roots:
+        try:
+            removed_counts[root] = clean_root(
+                simulate,
+                zk,
+                root,
+                max_in_flight=max_in_flight,
+                delete_batch_size=delete_batch_size,
+                read_limiter=read_limiter,
+                delete_limiter=delete_limiter,
+                checkpoint=checkpoint,
+                max_services=max_services,
+                cversion_cache=cversion_cache,
+                full_scan=full_scan,
+                partition=partition,
+                stats=stats,
+            )
+        except kazoo.exceptions.NoNodeError:
+            log.info("Skipping %s, it does not exist" % root)
+            continue
+        log.info("Removed %d nodes from %s" % (removed_counts[root], root))
+    return removed_counts
+
+
+@contextlib.contextmanager
+def _thread_named(
+    name: str,
+) -> Iterator[None]:
+    """Name the current thread after the cluster it is cleaning for the
+    duration, so that log lines from concurrent clusters can be told apart."""
+    thread = threading.current_thread()
+    original_name = thread.name
+    thread.name = name
+    try:
+        yield
+    finally:
+        thread.name = original_name
+
+
+def clean_cluster(
+    cluster_type: str,
+    cluster_location: str,
+    simulate: bool,
+    connect_timeout: float,
+    max_in_flight: int,
+    delete_batch_size: int,
+    roots: Sequence[str] = DEFAULT_ROOTS,
+    max_reads_per_second: Optional[float] = None,
+    max_deletes_per_second: Optional[float] = None,
+    checkpoint_file: Optional[str] = None,
+    max_services: Optional[int] = None,
+    cversion_cache_file: Optional[str] = None,
+    full_scan: bool = False,
+    partition_path: Optional[str] = None,
+    stats: Optional[ScanStats] = None,
+) -> CleanNerveClusterResult:
+    import kazoo.client
+
+    result: CleanNerveClusterResult = {
+        "cluster_location": cluster_location,
+        "connected": False,
+        "removed_count": 0,
+        "removed_counts": {},
+        "error": None,
+    }
+
+    with _thread_named(cluster_location):
+        log.info("Processing %s" % cluster_location)
+
+        try:
+            zk_topology = get_zk_topology(cluster_type, cluster_location)
+            zk = kazoo.client.KazooClient(hosts=",".join(zk_topology))
+            zk.start(timeout=connect_timeout)
+        except Exception as e:
+            log.warning("Could not connect to zookeeper cluster for %s" % cluster_location)
+            result["error"] = f"Could not connect: {e!r}"
+            return result
+
+        result["connected"] = True
+        try:
+            partition = None
+            if partition_path:
+                partition = Partition(zk, partition_path)
+                partition.join()
+            result["removed_counts"] = clean(
+                simulate,
+                zk,
+                roots,
+                max_in_flight,
+                delete_batch_size,
+                read_limiter=TokenBucket(max_reads_per_second) if max_reads_per_second else None,
+                delete_limiter=TokenBucket(max_deletes_per_second) if max_deletes_per_second else None,
+                checkpoint=ScanCheckpoint(checkpoint_file, cluster_location) if checkpoint_file else None,
+                max_services=max_services,
+                cversion_cache=CversionCache(cversion_cache_file, cluster_location) if cversion_cache_file else None,
+                full_scan=full_scan,
+                partition=partition,
+                stats=stats,
+            )
+            result["removed_count"] = sum(result["removed_counts"].values())
+        except Exception as e:
+            log.exception("Failed to clean %s" % cluster_location)
+            result["error"] = repr(e)
+        finally:
+            zk.stop()
+            zk.close()
+
+    return result
+
+
+class OrphanWatcher:
+    """Keep removing orphaned instance nodes from one cluster as they appear.
+
+    After an initial scan, only services whose children have changed, as
+    signalled by a ZooKeeper watch, are looked at again, so the load this puts
+    on the cluster follows churn rather than the size of the tree. A node is
+    only removed once it has stayed orphaned for the grace period, and was
+    not deleted and recreated in the meantime.
+
+    With a partition, only the services it owns are watched, and the share
+    is picked up again whenever it is rebalanced.
+    """
+
+    def __init__(
+        self,
+        zk: "kazoo.client.KazooClient",
+        roots: Sequence[str],
+        simulate: bool,
+        grace_period_s: float = DEFAULT_GRACE_PERIOD_S,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        delete_batch_size: int = DEFAULT_DELETE_BATCH_SIZE,
+        read_limiter: Optional[TokenBucket] = None,
+        delete_limiter: Optional[TokenBucket] = None,
+        partition: Optional[Partition] = None,
+    ) -> None:
+        self.zk = zk
+        self.roots = roots
+        self.simulate = simulate
+        self.grace_period_s = grace_period_s
+        self.max_in_flight = max_in_flight
+        self.delete_batch_size = delete_batch_size
+        self.read_limiter = read_limiter
+        self.delete_limiter = delete_limiter
+        self.partition = partition
+        self.removed_count = 0
+
+        # Paths of roots and services whose children may have changed
+        self._changed: "queue.Queue[str]" = queue.Queue()
+        self._services: Dict[str, Set[str]] = {root: set() for root in roots}
+        # path -> (czxid, version, when to remove it) of orphans
+        self._candidates: Dict[str, Tuple[int, int, float]] = {}
+        self._session_lost = False
+
+    def _on_watch_event(
+        self,
+        event: "WatchedEvent",
+    ) -> None:
+        # Called on kazoo's event thread, so leave the work to run_once().
+        # Being a bound method, it is only registered once per path however
+        # many times it is passed as a watch.
+        self._changed.put(event.path)
+
+    def _on_state_change(
+        self,
+        state: str,
+    ) -> None:
+        from kazoo.protocol.states import KazooState
+
+        if state == KazooState.LOST:
+            # Watches don't survive the session
+            self._session_lost = True
+
+    def _on_rebalance(self) -> None:
+        self._changed.put(_REBALANCE)
+
+    def start(self) -> None:
+        self.zk.add_listener(self._on_state_change)
+        if self.partition is not None:
+            self.partition.add_listener(self._on_rebalance)
+        for root in self.roots:
+            self._changed.put(root)
+
+    def run(self) -> None:
+        self.start()
+        while True:
+            self.run_once(timeout=1.0)
+
+    def run_once(
+        self,
+        timeout: float,
+    ) -> None:
+        """Wait up to timeout for changes, look at the services which have
+        changed, and remove candidates whose grace period is up."""
+        import kazoo.exceptions
+
+        if self._session_lost and self.zk.connected:
+            log.info("Session lost, rescanning")
+            self._session_lost = False
+            for root in self.roots:
+                self._services[root] = set()
+                self._changed.put(root)
+
+        changed = self._get_changed(timeout)
+        try:
+            service_paths = {path for path in changed if path not in self._services and path != _REBALANCE}
+            for root in changed & set(self.roots):
+                service_paths.update(self._list_services(root))
+            if _REBALANCE in changed:
+                # Pick up any services that have just become ours
+                service_paths.update(
+                    f"{root}/{service}" for root, services in self._services.items() for service in services
+                )
+            if self.partition is not None:
+                service_paths = {path for path in service_paths if self.partition.owns(path)}
+                for path in list(self._candidates):
+                    if not self.partition.owns(path.rpartition("/")[0]):
+                        del self._candidates[path]
+            self._inspect(service_paths)
+            self._remove_due_candidates()
+        except kazoo.exceptions.KazooException:
+            log.exception("Failed to process changes, will retry")
+            for path in changed:
+                self._changed.put(path)
+            time.sleep(1.0)
+
+    def _get_changed(
+        self,
+        timeout: float,
+    ) -> Set[str]:
+        if self._candidates:
+            next_removal = min(remove_at for _, _, remove_at in self._candidates.values())
+            timeout = max(0.0, min(timeout, next_removal - time.monotonic()))
+        try:
+            changed = {self._changed.get(timeout=timeout)}
+        except queue.Empty:
+            return set()
+        while True:
+            try:
+                changed.add(self._changed.get_nowait())
+            except queue.Empty:
+                return changed
+
+    def _list_services(
+        self,
+        root: str,
+    ) -> List[str]:
+        """Return the paths of any services which have appeared under root."""
+        import kazoo.exceptions
+
+        if self.read_limiter is not None:
+            self.read_limiter.acquire()
+        try:
+            services = set(self.zk.get_children(root, watch=self._on_watch_event))
+        except kazoo.exceptions.NoNodeError:
+            # Be told if it is created
+            if self.zk.exists(root, watch=self._on_watch_event) is not None:
+                self._changed.put(root)
+            return []
+
+        new_services = services - self._services[root]
+        self._services[root] = services
+        return [f"{root}/{service}" for service in sorted(new_services)]
+
+    def _inspect(
+        self,
+        service_paths: Set[str],
+    ) -> None:
+        """Read every instance of the given services, (re)setting the watch
+        on each, and track which are orphans."""
+        services_by_root: Dict[str, List[str]] = collections.defaultdict(list)
+        for service_path in sorted(service_paths):
+            root, _, service = service_path.rpartition("/")
+            services_by_root[root].append(service)
+
+        orphans = {}
+        for root, services in services_by_root.items():
+            for path, data, stat in get_instance_nodes(
+                self.zk,
+                root,
+                services,
+                self.max_in_flight,
+                self.read_limiter,
+                watch=self._on_watch_event,
+            ):
+                if is_orphan(data, stat):
+                    orphans[path] = (stat.czxid, stat.version)
+
+        for path in list(self._candidates):
+            if path.rpartition("/")[0] in service_paths and path not in orphans:
+                del self._candidates[path]
+        remove_at = time.monotonic() + self.grace_period_s
+        for path, (czxid, version) in orphans.items():
+            candidate = self._candidates.get(path)
+            if candidate is None or candidate[:2] != (czxid, version):
+                log.info("%s is orphaned, removing in %.0fs" % (path, self.grace_period_s))
+                self._candidates[path] = (czxid, version, remove_at)
+
+    def _remove_due_candidates(self) -> None:
+        """Re-read each candidate whose grace period is up, and remove those
+        that are still the same orphaned node."""
+        import kazoo.exceptions
+
+        now = time.monotonic()
+        due = sorted(path for path, (_, _, remove_at) in self._candidates.items() if remove_at <= now)
+        to_delete = []
+        reads = _pipeline(
+            ((path, functools.partial(self.zk.get_async, path)) for path in due),
+            self.max_in_flight,
+            self.read_limiter,
+        )
+        for path, result in reads:
+            czxid, version, _ = self._candidates.pop(path)
+            try:
+                data, stat = result.get()
+            except kazoo.exceptions.NoNodeError:
                 continue
-            if stat.numChildren != 0:
+            if not is_orphan(data, stat) or (stat.czxid, stat.version) != (czxid, version):
                 continue
 
             log.info("Removing %s" % path)
-            removed_count += 1
-            if not simulate:
-                zk.delete(path)
+            if self.simulate:
+                self.removed_count += 1
+            else:
+                to_delete.append((path, version))
 
-    return removed_count
+        for start in range(0, len(to_delete), self.delete_batch_size):
+            end = start + self.delete_batch_size
+            batch = to_delete[start:end]
+            if self.delete_limiter is not None:
+                self.delete_limiter.acquire(len(batch))
+            self.removed_count += delete_nodes(self.zk, batch)
+
+
+def watch_cluster(
+    cluster_type: str,
+    cluster_location: str,
+    simulate: bool,
+    connect_timeout: float,
+    max_in_flight: int,
+    delete_batch_size: int,
+    roots: Sequence[str] = DEFAULT_ROOTS,
+    grace_period_s: float = DEFAULT_GRACE_PERIOD_S,
+    max_reads_per_second: Optional[float] = None,
+    max_deletes_per_second: Optional[float] = None,
+    partition_path: Optional[str] = None,
+) -> None:
+    """Run an OrphanWatcher against a cluster forever, retrying until it can
+    be connected to."""
+    import kazoo.client
+
+    with _thread_named(cluster_location):
+        while True:
+            try:
+                zk_topology = get_zk_topology(cluster_type, cluster_location)
+                zk = kazoo.client.KazooClient(hosts=",".join(zk_topology))
+                zk.start(timeout=connect_timeout)
+                break
+            except Exception:
+                log.warning("Could not connect to zookeeper cluster for %s, retrying" % cluster_location)
+                time.sleep(connect_timeout)
+
+        log.info("Watching %s" % cluster_location)
+        partition = None
+        if partition_path:
+            partition = Partition(zk, partition_path)
+            partition.join()
+        OrphanWatcher(
+            zk,
+            roots,
+            simulate,
+            grace_period_s=grace_period_s,
+            max_in_flight=max_in_flight,
+            delete_batch_size=delete_batch_size,
+            read_limiter=TokenBucket(max_reads_per_second) if max_reads_per_second else None,
+            delete_limiter=TokenBucket(max_deletes_per_second) if max_deletes_per_second else None,
+            partition=partition,
+        ).run()
+
+
+def run_daemon(
+    args: argparse.Namespace,
+) -> None:
+    """Watch every cluster until one of the watchers fails."""
+    failures: "queue.Queue[str]" = queue.Queue()
+
+    def watch(cluster_location: str) -> None:
+        try:
+            watch_cluster(
+                cluster_type=args.cluster_type,
+                cluster_location=cluster_location,
+                simulate=args.simulate,
+                connect_timeout=args.connect_timeout,
+                max_in_flight=args.max_in_flight,
+                delete_batch_size=args.delete_batch_size,
+                roots=args.roots or DEFAULT_ROOTS,
+                grace_period_s=args.grace_period_s,
+                max_reads_per_second=args.max_reads_per_second,
+                max_deletes_per_second=args.max_deletes_per_second,
+                partition_path=args.partition_path,
+            )
+        except Exception:
+            log.exception("Stopped watching %s" % cluster_location)
+        failures.put(cluster_location)
+
+    cluster_locations = list(get_zk_cluster_locations(args.cluster_type))
+    if not cluster_locations:
+        log.error("No %s clusters to watch" % args.cluster_type)
+        sys.exit(1)
+    for cluster_location in cluster_locations:
+        threading.Thread(target=watch, args=(cluster_location,), daemon=True).start()
+
+    # Rather than carrying on without it, exit and leave restarting to
+    # whatever is supervising the daemon
+    failures.get()
+    sys.exit(1)
+
+
+def log_summary(
+    results: List[CleanNerveClusterResult],
+) -> None:
+    for result in sorted(results, key=lambda r: r["cluster_location"]):
+        status = "ok" if result["error"] is None else result["error"]
+        by_root = ", ".join(f"{root}: {count}" for root, count in result["removed_counts"].items())
+        log.info(
+            "%s: removed %d nodes%s (%s)"
+            % (result["cluster_location"], result["removed_count"], f" ({by_root})" if by_root else "", status)
+        )
+    failed = [result["cluster_location"] for result in results if result["error"] is not None]
+    log.info(
+        "Removed %d nodes from %d clusters, %d failed%s"
+        % (
+            sum(result["removed_count"] for result in results),
+            len(results),
+            len(failed),
+            ": " + ", ".join(sorted(failed)) if failed else "",
+        )
+    )
 
 
 def main() -> None:
@@ -106,24 +1178,43 @@ def main() -> None:
     if args.simulate:
         log.info("Running in simulation mode")
 
-    for cluster_location in get_zk_cluster_locations(args.cluster_type):
-        log.info("Processing %s" % cluster_location)
+    if args.daemon:
+        run_daemon(args)
 
-        zk_topology = get_zk_topology(args.cluster_type, cluster_location)
-        zk_hosts = ",".join(zk_topology)
-        zk = kazoo.client.KazooClient(hosts=zk_hosts)
+    cluster_locations = list(get_zk_cluster_locations(args.cluster_type))
+    stats = {cluster_location: ScanStats() for cluster_location in cluster_locations}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [
+            executor.submit(
+                clean_cluster,
+                cluster_type=args.cluster_type,
+                cluster_location=cluster_location,
+                simulate=args.simulate,
+                connect_timeout=args.connect_timeout,
+                max_in_flight=args.max_in_flight,
+                delete_batch_size=args.delete_batch_size,
+                roots=args.roots or DEFAULT_ROOTS,
+                max_reads_per_second=args.max_reads_per_second,
+                max_deletes_per_second=args.max_deletes_per_second,
+                checkpoint_file=args.checkpoint_file,
+                max_services=args.max_services,
+                cversion_cache_file=args.cversion_cache_file,
+                full_scan=args.full_scan,
+                partition_path=args.partition_path,
+                stats=stats[cluster_location],
+            )
+            for cluster_location in cluster_locations
+        ]
+        results = [future.result() for future in futures]
 
-        try:
-            zk.start()
-        except Exception:
-            log.warn("Could not connect to zookeeper cluster for %s" % cluster_location)
-            continue
+    log_summary(results)
+    if args.report_file:
+        write_report(args.report_file, args.report_format, results, stats, args.simulate)
 
-        try:
-            removed_count = clean(args.simulate, zk)
-            log.info("Removed %d nodes" % removed_count)
-        finally:
-            zk.stop()
+    # Unreachable clusters have always just been skipped, but failing part way
+    # through cleaning one is an error.
+    if any(result["connected"] and result["error"] is not None for result in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
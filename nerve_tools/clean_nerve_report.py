@@ -0,0 +1,264 @@
+"""Machine-readable reports of what clean_nerve found and did.
+
+A report has one entry per cluster, written either as JSON lines (appended to,
+so the file accumulates a record per run) or as a Prometheus textfile
+(replaced on each run, for node_exporter's textfile collector).
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+from nerve_tools.config import CleanNerveClusterResult
+
+if TYPE_CHECKING:
+    from kazoo.interfaces import IAsyncResult
+    from kazoo.protocol.states import ZnodeStat
+
+
+REPORT_FORMATS = ["json", "prometheus"]
+
+# Upper bounds, in seconds, of the ZooKeeper read latency histogram buckets
+LATENCY_BUCKETS_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Each of the ways in which an instance node looks orphaned.  Only nodes with
+# all of them are removed.
+EMPTY_DATA = "empty_data"
+NO_EPHEMERAL_OWNER = "no_ephemeral_owner"
+NO_CHILDREN = "no_children"
+CANDIDATE_REASONS = [EMPTY_DATA, NO_EPHEMERAL_OWNER, NO_CHILDREN]
+
+
+def get_candidate_reasons(
+    data: bytes,
+    stat: "ZnodeStat",
+) -> List[str]:
+    reasons = []
+    if len(data) == 0:
+        reasons.append(EMPTY_DATA)
+    if stat.ephemeralOwner == 0:
+        reasons.append(NO_EPHEMERAL_OWNER)
+    if stat.numChildren == 0:
+        reasons.append(NO_CHILDREN)
+    return reasons
+
+
+class LatencyHistogram:
+    def __init__(
+        self,
+        buckets: Sequence[float] = LATENCY_BUCKETS_S,
+    ) -> None:
+        self.buckets = buckets
+        # The last count is of observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # Observations are made on kazoo's callback thread
+        self._lock = threading.Lock()
+
+    def observe(
+        self,
+        seconds: float,
+    ) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def time(
+        self,
+        result: "IAsyncResult",
+    ) -> None:
+        """Observe how long from now until result completes."""
+        start = time.monotonic()
+        result.rawlink(lambda _: self.observe(time.monotonic() - start))
+
+    def get_cumulative_counts(self) -> List[Tuple[str, int]]:
+        """Return (upper bound, count of observations up to it) for every
+        bucket, as Prometheus expects."""
+        with self._lock:
+            cumulative_counts = []
+            total = 0
+            for bucket, count in zip(self.buckets, self.counts):
+                total += count
+                cumulative_counts.append((repr(bucket), total))
+            cumulative_counts.append(("+Inf", self.count))
+            return cumulative_counts
+
+
+class ScanStats:
+    """What a clean_nerve run found in one cluster."""
+
+    def __init__(self) -> None:
+        self.services_scanned = 0
+        # Skipped as unchanged since a previous scan
+        self.services_skipped = 0
+        self.nodes_scanned = 0
+        # Nodes with each of CANDIDATE_REASONS, whether or not they had the rest
+        self.candidates = {reason: 0 for reason in CANDIDATE_REASONS}
+        # Nodes with all of them
+        self.orphans = 0
+        # Orphans which had changed or gone by the time they were deleted
+        self.deletes_failed = 0
+        self.read_latency = LatencyHistogram()
+
+    def count_node(
+        self,
+        reasons: Sequence[str],
+    ) -> None:
+        self.nodes_scanned += 1
+        for reason in reasons:
+            self.candidates[reason] += 1
+        if len(reasons) == len(CANDIDATE_REASONS):
+            self.orphans += 1
+
+
+ReportValue = Union[None, bool, int, float, str, Dict[str, int], Dict[str, float]]
+
+
+def get_report_entry(
+    result: CleanNerveClusterResult,
+    stats: ScanStats,
+    simulate: bool,
+    timestamp: float,
+) -> Dict[str, ReportValue]:
+    return {
+        "timestamp": timestamp,
+        "cluster_location": result["cluster_location"],
+        "simulate": simulate,
+        "connected": result["connected"],
+        "error": result["error"],
+        "services_scanned": stats.services_scanned,
+        "services_skipped": stats.services_skipped,
+        "nodes_scanned": stats.nodes_scanned,
+        "candidates": dict(stats.candidates),
+        "orphans": stats.orphans,
+        # In simulate mode, how many would have been removed
+        "removed": result["removed_count"],
+        "removed_by_root": dict(result["removed_counts"]),
+        "deletes_failed": stats.deletes_failed,
+        "read_latency_s": {
+            "sum": stats.read_latency.sum,
+            "count": stats.read_latency.count,
+            **{f"le_{bucket}": count for bucket, count in stats.read_latency.get_cumulative_counts()},
+        },
+    }
+
+
+def format_json_report(
+    results: Sequence[CleanNerveClusterResult],
+    stats: Mapping[str, ScanStats],
+    simulate: bool,
+    timestamp: float,
+) -> str:
+    return "".join(
+        json.dumps(get_report_entry(result, stats[result["cluster_location"]], simulate, timestamp), sort_keys=True)
+        + "\n"
+        for result in results
+    )
+
+
+def _format_labels(
+    labels: Mapping[str, str],
+) -> str:
+    return ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+
+def format_prometheus_report(
+    results: Sequence[CleanNerveClusterResult],
+    stats: Mapping[str, ScanStats],
+    simulate: bool,
+    timestamp: float,
+) -> str:
+    # metric name -> (type, help, samples), in the order first added
+    metrics: Dict[str, Tuple[str, str, List[str]]] = {}
+
+    def add(
+        name: str,
+        metric_type: str,
+        help_text: str,
+        labels: Mapping[str, str],
+        value: float,
+        suffix: str = "",
+    ) -> None:
+        samples = metrics.setdefault(name, (metric_type, help_text, []))[2]
+        samples.append(f"clean_nerve_{name}{suffix}{{{_format_labels(labels)}}} {value}")
+
+    for result in sorted(results, key=lambda r: r["cluster_location"]):
+        cluster_stats = stats[result["cluster_location"]]
+        labels = {"cluster_location": result["cluster_location"]}
+        add("last_run_timestamp_seconds", "gauge", "When clean_nerve last ran.", labels, timestamp)
+        add("simulate", "gauge", "Whether the last run was in simulate mode.", labels, int(simulate))
+        add("connected", "gauge", "Whether the cluster could be connected to.", labels, int(result["connected"]))
+        add("error", "gauge", "Whether the cluster failed to be cleaned.", labels, int(result["error"] is not None))
+        add("services_scanned", "gauge", "Services whose instances were read.", labels, cluster_stats.services_scanned)
+        add("services_skipped", "gauge", "Services skipped as unchanged.", labels, cluster_stats.services_skipped)
+        add("nodes_scanned", "gauge", "Instance nodes read.", labels, cluster_stats.nodes_scanned)
+        for reason, count in cluster_stats.candidates.items():
+            add(
+                "candidates",
+                "gauge",
+                "Instance nodes with each sign of being orphaned.",
+                {**labels, "reason": reason},
+                count,
+            )
+        add("orphans", "gauge", "Instance nodes with every sign of being orphaned.", labels, cluster_stats.orphans)
+        for root, count in result["removed_counts"].items():
+            add(
+                "removed",
+                "gauge",
+                "Orphans removed, or in simulate mode that would have been.",
+                {**labels, "root": root},
+                count,
+            )
+        add(
+            "deletes_failed",
+            "gauge",
+            "Orphans which had changed or gone by the time they were deleted.",
+            labels,
+            cluster_stats.deletes_failed,
+        )
+
+        latency = cluster_stats.read_latency
+        latency_help = "ZooKeeper read latency."
+        for bucket, count in latency.get_cumulative_counts():
+            add("zk_read_latency_seconds", "histogram", latency_help, {**labels, "le": bucket}, count, "_bucket")
+        add("zk_read_latency_seconds", "histogram", latency_help, labels, latency.sum, "_sum")
+        add("zk_read_latency_seconds", "histogram", latency_help, labels, latency.count, "_count")
+
+    lines = []
+    for metric_name, (metric_type, help_text, samples) in metrics.items():
+        lines.append(f"# HELP clean_nerve_{metric_name} {help_text}")
+        lines.append(f"# TYPE clean_nerve_{metric_name} {metric_type}")
+        lines.extend(samples)
+    return "".join(line + "\n" for line in lines)
+
+
+def write_report(
+    report_file: str,
+    report_format: str,
+    results: Sequence[CleanNerveClusterResult],
+    stats: Mapping[str, ScanStats],
+    simulate: bool,
+) -> None:
+    timestamp = time.time()
+    if report_format == "json":
+        with open(report_file, "a") as fp:
+            fp.write(format_json_report(results, stats, simulate, timestamp))
+        return
+
+    # The textfile collector may read it at any time, so swap it into place
+    tmp_path = f"{report_file}.tmp"
+    with open(tmp_path, "w") as fp:
+        fp.write(format_prometheus_report(results, stats, simulate, timestamp))
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, report_file)
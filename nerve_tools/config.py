@@ -1,5 +1,6 @@
 from typing import Dict
 from typing import Iterable
+from typing import List
 from typing import Mapping
 from typing import Optional
 from typing import Tuple
@@ -68,3 +69,63 @@ class ListenerAddress(TypedDict):
 class ListenerConfig(TypedDict):
     name: str
     local_address: Dict[str, ListenerAddress]
+
+
+class EnvoyHealthStatus(TypedDict, total=False):
+    # Omitted if UNKNOWN, which Envoy treats as healthy
+    eds_health_status: str
+    failed_active_health_check: bool
+    failed_outlier_check: bool
+    failed_active_degraded_check: bool
+    pending_dynamic_removal: bool
+    excluded_via_immediate_hc_fail: bool
+    active_hc_timeout: bool
+
+
+class EnvoyHostStatus(TypedDict, total=False):
+    address: Dict[str, ListenerAddress]
+    health_status: EnvoyHealthStatus
+
+
+class EnvoyClusterStatus(TypedDict, total=False):
+    name: str
+    host_statuses: List[EnvoyHostStatus]
+
+
+class UpdownServiceConfig(TypedDict):
+    # The settings updown_service needs for one service, from its yelpsoa
+    # configs, read once per run
+    # In the mesh (with a proxy_port, even if None as a discovery-only service
+    # has) and not opted out with no_updown_service
+    managed: bool
+    updown_timeout_s: int
+    healthcheck_uri: str
+    healthcheck_port: Optional[int]
+    healthcheck_mode: str
+    healthcheck_timeout_s: float
+
+
+class ZKTopologyIndex(TypedDict):
+    version: int
+    # relative path -> st_mtime_ns of every file and directory the index was built from
+    manifest: Dict[str, int]
+    # cluster type -> cluster location -> ["host:port", ...]
+    topologies: Dict[str, Dict[str, List[str]]]
+    # cluster type -> locations whose topology file is a symlink (e.g. 'local')
+    symlinks: Dict[str, List[str]]
+
+
+class LabelsBundleFile(TypedDict):
+    version: int
+    # name of the loose label file -> labels it contained
+    labels: Dict[str, Dict[str, str]]
+
+
+class CleanNerveClusterResult(TypedDict):
+    cluster_location: str
+    connected: bool
+    removed_count: int
+    # root -> nodes removed from under it, for the roots which exist
+    removed_counts: Dict[str, int]
+    # Set if the cluster could not be connected to or fully cleaned
+    error: Optional[str]
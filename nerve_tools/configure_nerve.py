@@ -7,7 +7,7 @@ changed."""
 import argparse
 import filecmp
 import json
-import multiprocessing
+import logging
 import os
 import os.path
 import shutil
@@ -15,15 +15,8 @@ import signal
 import subprocess
 import sys
 import time
+import zlib
 from glob import glob
-
-import yaml
-
-try:
-    from yaml import CSafeLoader as Loader  # type: ignore
-except ImportError:
-    from yaml import SafeLoader as Loader  # type: ignore
-
 from typing import Dict
 from typing import Iterable
 from typing import List
@@ -34,26 +27,29 @@ from typing import Sequence
 from typing import Tuple
 from typing import cast
 
-from environment_tools.type_utils import compare_types
-from environment_tools.type_utils import convert_location_type
-from environment_tools.type_utils import get_current_location
 from nerve_tools.config import CheckDict
 from nerve_tools.config import NerveConfig
 from nerve_tools.config import ServiceInfo
 from nerve_tools.config import SubConfiguration
+from nerve_tools.envoy import LazyEnvoyIngressListeners
 from nerve_tools.envoy import generate_envoy_subsubconfiguration
-from nerve_tools.envoy import get_envoy_ingress_listeners
 from nerve_tools.envoy import get_envoy_service_info
+from nerve_tools.labels import DEFAULT_LABEL_DIR
+from nerve_tools.labels import load_labels_bundle
 from nerve_tools.util import get_host_ip
 from nerve_tools.util import get_hostname
+from nerve_tools.util import get_yaml_loader
+from nerve_tools.zk_topology import get_indexed_zk_topology
+from nerve_tools.zk_topology import load_zk_topology_index
 
-# Used to determine the weight
-try:
-    CPUS = max(multiprocessing.cpu_count(), 10)
-except NotImplementedError:
-    CPUS = 10
+# Used to determine the weight. os.cpu_count() rather than multiprocessing,
+# which is comparatively expensive to import.
+CPUS = max(os.cpu_count() or 10, 10)
 
-DEFAULT_LABEL_DIR = "/etc/nerve/labels.d/"
+# Fraction by which each registration's check_interval may be stretched so
+# that healthchecks for different registrations do not fire in lockstep.
+DEFAULT_CHECK_INTERVAL_JITTER = 0.0
+LOG_FORMAT = "%(levelname)s %(message)s"
 
 
 def get_named_zookeeper_topology(
@@ -62,9 +58,15 @@ def get_named_zookeeper_topology(
     zk_topology_dir: str,
 ) -> Iterable[str]:
     """Use CEP 355 discovery to find zookeeper topologies"""
+    index = load_zk_topology_index(zk_topology_dir)
+    if index is not None:
+        return get_indexed_zk_topology(index, cluster_type, cluster_location)
+
+    import yaml
+
     zk_topology_path = os.path.join(zk_topology_dir, cluster_type, cluster_location + ".yaml")
     with open(zk_topology_path) as fp:
-        zk_topology = yaml.load(fp, Loader=Loader)
+        zk_topology = yaml.load(fp, Loader=get_yaml_loader())
     return ["%s:%d" % (entry[0], entry[1]) for entry in zk_topology]
 
 
@@ -74,11 +76,20 @@ def get_labels_by_service_and_port(
     labels_dir: str = DEFAULT_LABEL_DIR,
 ) -> MutableMapping[str, str]:
     custom_labels: Dict[str, str] = {}
+    prefix = service_name + str(port)
+
+    # Labels from the bundle come first so that loose files can override them
+    bundle = load_labels_bundle(labels_dir)
+    if bundle is not None:
+        custom_labels.update(bundle.get_labels(prefix))
+
     try:
-        path = os.path.join(labels_dir, service_name + str(port) + "*")
+        path = os.path.join(labels_dir, prefix + "*")
         for label_file in glob(path):
+            import yaml
+
             with open(label_file) as f:
-                custom_labels.update(yaml.load(f, Loader=Loader))
+                custom_labels.update(yaml.load(f, Loader=get_yaml_loader()))
     except Exception:
         pass
     return custom_labels
@@ -95,7 +106,15 @@ def generate_subconfiguration(
     zk_cluster_type: str,
     labels_dir: str,
     envoy_service_info: Optional[ServiceInfo],
+    envoy_ingress_listeners: Optional[Mapping[Tuple[str, str, int], int]] = None,
 ) -> SubConfiguration:
+    """If envoy_service_info isn't given, it's looked up in
+    envoy_ingress_listeners once the service is known to be registered
+    somewhere, so that lazily-loaded listeners are only fetched if needed."""
+    # environment_tools is slow to import, so only do so once we know we need it
+    from environment_tools.type_utils import compare_types
+    from environment_tools.type_utils import convert_location_type
+    from environment_tools.type_utils import get_current_location
 
     service_port = service_info["port"]
     # if this is a k8s pod the dict will have the pod IP and we have
@@ -219,6 +238,14 @@ def generate_subconfiguration(
             if paasta_instance:
                 subconfig[key]["labels"]["paasta_instance"] = paasta_instance
 
+            if envoy_service_info is None and envoy_ingress_listeners is not None:
+                envoy_service_info = get_envoy_service_info(
+                    service_name=service_name,
+                    service_info=service_info,
+                    envoy_ingress_listeners=envoy_ingress_listeners,
+                )
+                # Looked up once is enough, whether or not it was found
+                envoy_ingress_listeners = None
             if envoy_service_info:
                 envoy_key = f"{service_name}.{zk_location}:{service_ip}.{service_port}"
                 subconfig[envoy_key] = generate_envoy_subsubconfiguration(
@@ -238,6 +265,51 @@ def generate_subconfiguration(
     return subconfig
 
 
+def get_healthcheck_qps(
+    services: SubConfiguration,
+) -> float:
+    """Return the number of requests per second that nerve will send to
+    hacheck for the given registrations."""
+    return sum(len(list(config.get("checks", []))) / config["check_interval"] for config in services.values())
+
+
+def _get_jitter_fraction(
+    key: str,
+) -> float:
+    """Map a registration key onto [0, 1) so that the jitter applied to it is
+    stable across runs (and therefore doesn't cause spurious nerve reloads)."""
+    return zlib.crc32(key.encode()) / 2**32
+
+
+def apply_healthcheck_budget(
+    services: SubConfiguration,
+    hacheck_qps_budget: Optional[float],
+    check_interval_jitter: float,
+) -> None:
+    """Stretch the check_interval of every registration so that the total
+    hacheck load stays within hacheck_qps_budget, then spread the intervals out
+    by up to check_interval_jitter (a fraction of the interval).
+
+    Intervals are only ever lengthened, so the jitter can never push the load
+    back over the budget.
+    """
+    qps = get_healthcheck_qps(services)
+    logging.info(f"Registrations imply {qps:.2f} hacheck requests per second")
+
+    stretch = 1.0
+    if hacheck_qps_budget and qps > hacheck_qps_budget:
+        stretch = qps / hacheck_qps_budget
+        logging.info(f"Stretching check intervals by {stretch:.2f}x to stay within {hacheck_qps_budget} qps")
+
+    if stretch == 1.0 and not check_interval_jitter:
+        return
+
+    for key, subsubconfig in services.items():
+        check_interval = subsubconfig["check_interval"] * stretch
+        check_interval *= 1.0 + check_interval_jitter * _get_jitter_fraction(key)
+        subsubconfig["check_interval"] = round(check_interval, 3)
+
+
 def generate_configuration(
     services: Iterable[Tuple[str, ServiceInfo]],
     heartbeat_path: str,
@@ -247,6 +319,8 @@ def generate_configuration(
     zk_cluster_type: str,
     labels_dir: str,
     envoy_ingress_listeners: Mapping[Tuple[str, str, int], int],
+    hacheck_qps_budget: Optional[float] = None,
+    check_interval_jitter: float = DEFAULT_CHECK_INTERVAL_JITTER,
 ) -> NerveConfig:
     nerve_config: NerveConfig = {
         "instance_id": get_hostname(),
@@ -260,7 +334,6 @@ def generate_configuration(
         service_name: str,
         service_info: ServiceInfo,
         service_weight: int,
-        envoy_service_info: Optional[ServiceInfo],
     ) -> None:
         nerve_config["services"].update(
             generate_subconfiguration(
@@ -273,7 +346,8 @@ def generate_configuration(
                 zk_location_type=zk_location_type,
                 zk_cluster_type=zk_cluster_type,
                 labels_dir=labels_dir,
-                envoy_service_info=envoy_service_info,
+                envoy_service_info=None,
+                envoy_ingress_listeners=envoy_ingress_listeners,
             )
         )
 
@@ -282,11 +356,13 @@ def generate_configuration(
             service_name=service_name,
             service_info=cast(ServiceInfo, service_info),
             service_weight=service_info.get("weight", 10),
-            envoy_service_info=get_envoy_service_info(
-                service_name=service_name,
-                service_info=cast(ServiceInfo, service_info),
-                envoy_ingress_listeners=envoy_ingress_listeners,
-            ),
+        )
+
+    if hacheck_qps_budget or check_interval_jitter:
+        apply_healthcheck_budget(
+            services=nerve_config["services"],
+            hacheck_qps_budget=hacheck_qps_budget,
+            check_interval_jitter=check_interval_jitter,
         )
 
     return nerve_config
@@ -348,6 +424,24 @@ def parse_args(
     )
     parser.add_argument("--zk-cluster-type", type=str, default="infrastructure")
     parser.add_argument("--hacheck-port", type=int, default=6666)
+    parser.add_argument(
+        "--hacheck-qps-budget",
+        type=float,
+        help="Maximum healthcheck requests per second nerve may send to hacheck; "
+        "check intervals are stretched proportionally to stay within it.",
+    )
+    parser.add_argument(
+        "--check-interval-jitter",
+        type=float,
+        default=DEFAULT_CHECK_INTERVAL_JITTER,
+        help="Stretch each check interval by a deterministic per-registration fraction "
+        "of up to this much, so that healthchecks are not synchronized (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--report-hacheck-qps",
+        action="store_true",
+        help="Log how many healthcheck requests per second the generated config will send to hacheck.",
+    )
     parser.add_argument(
         "--labels-dir",
         type=str,
@@ -365,6 +459,7 @@ def parse_args(
 
 def main() -> None:
     opts = parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 
     new_config = generate_configuration(
         services=call_paasta_dump_locally_running_services(),
@@ -374,8 +469,13 @@ def main() -> None:
         zk_location_type=opts.zk_location_type,
         zk_cluster_type=opts.zk_cluster_type,
         labels_dir=opts.labels_dir,
-        envoy_ingress_listeners=get_envoy_ingress_listeners(opts.envoy_admin_port),
+        envoy_ingress_listeners=LazyEnvoyIngressListeners(opts.envoy_admin_port),
+        hacheck_qps_budget=opts.hacheck_qps_budget,
+        check_interval_jitter=opts.check_interval_jitter,
     )
+    if opts.report_hacheck_qps:
+        qps = get_healthcheck_qps(new_config["services"])
+        logging.info(f"Generated config implies {qps:.2f} hacheck requests per second")
 
     # Must use os.rename on files in the same filesystem to ensure that
     # config is swapped atomically, so we need to create the temp file in
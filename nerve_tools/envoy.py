@@ -1,30 +1,53 @@
 import copy
+import json
 import logging
 import re
+import threading
+from typing import TYPE_CHECKING
 from typing import Dict
 from typing import Iterable
+from typing import Iterator
 from typing import Mapping
 from typing import Optional
 from typing import Tuple
 from typing import cast
 
-import requests
 from nerve_tools.config import CheckDict
+from nerve_tools.config import EnvoyClusterStatus
+from nerve_tools.config import EnvoyHostStatus
 from nerve_tools.config import ListenerConfig
 from nerve_tools.config import ServiceInfo
 from nerve_tools.config import SubSubConfiguration
 from nerve_tools.util import get_host_ip
 
+if TYPE_CHECKING:
+    import requests
+
 INGRESS_LISTENER_REGEX = re.compile(
     r"^(?P<service_name>\S+\.\S+)\.(?P<service_ip>\d+\.\d+\.\d+\.\d+)\.(?P<service_port>\d+)\.ingress_listener$"
 )
 
 MESOS_SERVICE_IP = "0.0.0.0"
 
+DEFAULT_ENVOY_ADMIN_TIMEOUT_S = 1.0
+
+# A host with any of these EDS health statuses, or health flags set, gets no
+# traffic from Envoy
+UNROUTABLE_EDS_HEALTH_STATUSES = {"UNHEALTHY", "DRAINING", "TIMEOUT"}
+UNROUTABLE_HEALTH_FLAGS = (
+    "failed_active_health_check",
+    "failed_outlier_check",
+    "pending_dynamic_removal",
+    "excluded_via_immediate_hc_fail",
+    "active_hc_timeout",
+)
+
 
 def _get_envoy_listeners_from_admin(
     admin_port: int,
 ) -> Mapping[str, Iterable[ListenerConfig]]:
+    import requests
+
     try:
         return requests.get(f"http://localhost:{admin_port}/listeners?format=json").json()
     except Exception as e:
@@ -65,6 +88,40 @@ def get_envoy_ingress_listeners(
     return envoy_listeners
 
 
+class LazyEnvoyIngressListeners(Mapping[Tuple[str, str, int], int]):
+    """The mapping returned by get_envoy_ingress_listeners, only fetched from
+    the Envoy admin the first time it is actually looked at.
+
+    Fetching and parsing the full listener dump is by far the most expensive
+    part of configure_nerve on hosts without many mesh-routed services, and is
+    pointless if none of the local services could have an ingress listener.
+    """
+
+    def __init__(
+        self,
+        admin_port: Optional[int],
+    ) -> None:
+        self._admin_port = admin_port
+        self._listeners: Optional[Mapping[Tuple[str, str, int], int]] = None
+
+    def _get_listeners(self) -> Mapping[Tuple[str, str, int], int]:
+        if self._listeners is None:
+            self._listeners = get_envoy_ingress_listeners(self._admin_port)
+        return self._listeners
+
+    def __getitem__(
+        self,
+        key: Tuple[str, str, int],
+    ) -> int:
+        return self._get_listeners()[key]
+
+    def __iter__(self) -> Iterator[Tuple[str, str, int]]:
+        return iter(self._get_listeners())
+
+    def __len__(self) -> int:
+        return len(self._get_listeners())
+
+
 def get_envoy_service_info(
     service_name: str,
     service_info: ServiceInfo,
@@ -166,3 +223,100 @@ def generate_envoy_subsubconfiguration(
         labels=labels,
         weight=weight,
     )
+
+
+def find_envoy_cluster_status(
+    clusters_json: str,
+    cluster: str,
+) -> Optional[EnvoyClusterStatus]:
+    """Return the status of the named cluster from the Envoy admin's
+    /clusters?format=json output, or None if it isn't there.
+
+    That output covers every cluster, so rather than parsing all of it, find
+    where the target cluster's status starts (Envoy writes its name first) and
+    decode just that.  Only if that fails is the whole thing parsed.
+    """
+    decoder = json.JSONDecoder()
+    start = re.compile(r'\{\s*"name":\s*' + re.escape(json.dumps(cluster)) + r"\s*[,}]")
+    for match in start.finditer(clusters_json):
+        try:
+            status, _ = decoder.raw_decode(clusters_json, match.start())
+        except ValueError:
+            break
+        if status.get("name") == cluster and "host_statuses" in status:
+            return cast(EnvoyClusterStatus, status)
+
+    try:
+        cluster_statuses = json.loads(clusters_json).get("cluster_statuses", [])
+    except ValueError:
+        return None
+    for status in cluster_statuses:
+        if status.get("name") == cluster:
+            return cast(EnvoyClusterStatus, status)
+    return None
+
+
+def get_envoy_host_address(
+    host_status: EnvoyHostStatus,
+) -> Optional[str]:
+    try:
+        return host_status["address"]["socket_address"]["address"]
+    except KeyError:
+        return None
+
+
+def is_envoy_host_routable(
+    host_status: EnvoyHostStatus,
+) -> bool:
+    """Return whether Envoy would send the host any traffic."""
+    health_status = host_status.get("health_status", {})
+    if health_status.get("eds_health_status") in UNROUTABLE_EDS_HEALTH_STATUSES:
+        return False
+    return not any(health_status.get(flag) for flag in UNROUTABLE_HEALTH_FLAGS)
+
+
+class EnvoyAdminClient:
+    """Reads cluster status from the local Envoy admin, over one keep-alive
+    connection shared (one request at a time) between threads."""
+
+    def __init__(
+        self,
+        port: int,
+        host: str = "127.0.0.1",
+        timeout_s: float = DEFAULT_ENVOY_ADMIN_TIMEOUT_S,
+    ) -> None:
+        self.port = port
+        self.host = host
+        self.timeout_s = timeout_s
+        self._session: Optional["requests.Session"] = None
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def get_cluster_status(
+        self,
+        cluster: str,
+    ) -> Optional[EnvoyClusterStatus]:
+        """Return the named cluster's status, or None if it isn't configured
+        or the admin couldn't be reached."""
+        import requests
+
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+            try:
+                response = self._session.get(
+                    f"http://{self.host}:{self.port}/clusters",
+                    params={"format": "json"},
+                    timeout=self.timeout_s,
+                )
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                logging.warning(f"Unable to get envoy clusters: {e}")
+                return None
+            clusters_json = response.text
+        return find_envoy_cluster_status(clusters_json, cluster)
@@ -0,0 +1,123 @@
+"""Control and query the local hacheck's spool, which decides whether its
+healthchecks of a service pass regardless of the service's own health.
+
+The spool is driven over hacheck's HTTP API, on a single keep-alive
+connection, falling back to the hadown/haup/hastatus binaries if that
+fails (e.g. an older hacheck without the API).
+"""
+
+import os
+import subprocess
+import sys
+from typing import TYPE_CHECKING
+from typing import List
+from typing import Optional
+
+if TYPE_CHECKING:
+    import requests
+
+DEFAULT_HACHECK_HOST = "127.0.0.1"
+DEFAULT_HACHECK_PORT = 6666
+DEFAULT_HACHECK_TIMEOUT_S = 2.0
+
+HACHECK_COMMANDS = {
+    "down": "/usr/bin/hadown",
+    "up": "/usr/bin/haup",
+}
+HASTATUS_COMMAND = "/usr/bin/hastatus"
+
+# hacheck's spool status endpoint answers 503 for a downed service
+SPOOL_DOWN_STATUS_CODE = 503
+
+
+def _get_command_args(
+    service: str,
+    port: Optional[int],
+) -> List[str]:
+    args = [service]
+    if port is not None:
+        args.extend(["-P", str(port)])
+    return args
+
+
+class HacheckClient:
+    def __init__(
+        self,
+        host: str = DEFAULT_HACHECK_HOST,
+        port: int = DEFAULT_HACHECK_PORT,
+        timeout_s: float = DEFAULT_HACHECK_TIMEOUT_S,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.timeout_s = timeout_s
+        self._session: Optional["requests.Session"] = None
+
+    @property
+    def session(self) -> "requests.Session":
+        if self._session is None:
+            import requests
+
+            self._session = requests.Session()
+        return self._session
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _get_spool_url(
+        self,
+        service: str,
+        port: Optional[int],
+    ) -> str:
+        return f"http://{self.host}:{self.port}/spool/{service}/{port or 0}/status"
+
+    def set_state(
+        self,
+        service: str,
+        state: str,
+        port: Optional[int] = None,
+    ) -> None:
+        """Up or down service (only on the given port, if there is one)."""
+        import requests
+
+        try:
+            response = self.session.post(
+                self._get_spool_url(service, port),
+                data={"status": state, "reason": "updown_service"},
+                timeout=self.timeout_s,
+            )
+            response.raise_for_status()
+            return
+        except requests.exceptions.RequestException:
+            pass
+
+        command = HACHECK_COMMANDS[state]
+        try:
+            subprocess.check_call([command] + _get_command_args(service, port))
+        except Exception:
+            print("Error running %s" % command, file=sys.stderr)
+
+    def is_up(
+        self,
+        service: str,
+        port: Optional[int] = None,
+    ) -> bool:
+        """Return whether service is up in the spool."""
+        import requests
+
+        try:
+            response = self.session.get(self._get_spool_url(service, port), timeout=self.timeout_s)
+            if response.status_code == SPOOL_DOWN_STATUS_CODE:
+                return False
+            response.raise_for_status()
+            return True
+        except requests.exceptions.RequestException:
+            pass
+
+        try:
+            with open(os.devnull, "w") as devnull:
+                subprocess.check_call([HASTATUS_COMMAND] + _get_command_args(service, port), stdout=devnull)
+        except Exception:
+            return False
+        return True
@@ -0,0 +1,101 @@
+"""Wait for files in a directory to change.
+
+Uses Linux's inotify (through ctypes, so there is nothing extra to install)
+where it is available, and otherwise falls back to sleeping, leaving the
+caller to poll.
+"""
+
+import os
+import select
+import time
+from types import TracebackType
+from typing import Optional
+from typing import Type
+
+# From <sys/inotify.h>.  Only events signalling that a file has been
+# completely written (or moved into place, or removed) are watched for, so
+# that a waiter is not woken to find a half-written file.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+
+def _add_inotify_watch(
+    path: str,
+    mask: int,
+) -> Optional[int]:
+    """Return an inotify file descriptor watching path, or None if inotify
+    isn't available or path can't be watched."""
+    import ctypes
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return None
+    if inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class DirectoryWatcher:
+    def __init__(
+        self,
+        path: Optional[str],
+    ) -> None:
+        """Watch path, or with no path, just poll."""
+        self.path = path
+        self._fd = _add_inotify_watch(path, WATCH_MASK) if path is not None else None
+
+    @property
+    def polling(self) -> bool:
+        return self._fd is None
+
+    def wait(
+        self,
+        timeout: float,
+    ) -> bool:
+        """Wait up to timeout seconds for a file in the directory to change,
+        returning whether one did.  When polling, always waits the full
+        timeout and returns False."""
+        if self._fd is None:
+            time.sleep(timeout)
+            return False
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+        # Consume every queued event; one change is as good as several
+        while True:
+            try:
+                if not os.read(self._fd, 65536):
+                    break
+            except BlockingIOError:
+                break
+        return True
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self) -> "DirectoryWatcher":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
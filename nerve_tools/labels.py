@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""Build and read consolidated custom label bundles.
+
+Custom nerve labels are traditionally stored as one small YAML file per
+service and port in the labels directory, named '<service><port>*'. Hosts
+with many labelled services can instead have all of them in a single JSON
+bundle, keyed by the name of the file each set of labels would otherwise
+live in, which configure_nerve reads with a single open().
+"""
+
+import argparse
+import bisect
+import functools
+import json
+import os
+import sys
+from typing import Dict
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+
+from nerve_tools.config import LabelsBundleFile
+from nerve_tools.util import get_yaml_loader
+
+DEFAULT_LABEL_DIR = "/etc/nerve/labels.d/"
+
+# A dotfile, so that it never matches the '<service><port>*' glob used for
+# the loose label files.
+LABELS_BUNDLE_FILENAME = ".bundle.json"
+LABELS_BUNDLE_VERSION = 1
+
+
+class LabelsBundle:
+    def __init__(
+        self,
+        labels: Mapping[str, Mapping[str, str]],
+    ) -> None:
+        self._labels = labels
+        self._keys = sorted(labels)
+
+    def get_labels(
+        self,
+        prefix: str,
+    ) -> Dict[str, str]:
+        """Merge the labels of every key starting with prefix, in key order,
+        mirroring how the loose files matching '<prefix>*' are merged."""
+        custom_labels: Dict[str, str] = {}
+        start = bisect.bisect_left(self._keys, prefix)
+        for key in self._keys[start:]:
+            if not key.startswith(prefix):
+                break
+            custom_labels.update(self._labels[key])
+        return custom_labels
+
+
+def get_labels_bundle_path(
+    labels_dir: str,
+) -> str:
+    return os.path.join(labels_dir, LABELS_BUNDLE_FILENAME)
+
+
+@functools.lru_cache(maxsize=None)
+def load_labels_bundle(
+    labels_dir: str,
+) -> Optional[LabelsBundle]:
+    try:
+        with open(get_labels_bundle_path(labels_dir)) as fp:
+            bundle: LabelsBundleFile = json.load(fp)
+        if bundle["version"] != LABELS_BUNDLE_VERSION:
+            return None
+        return LabelsBundle(bundle["labels"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def build_labels_bundle(
+    labels_dir: str,
+) -> LabelsBundleFile:
+    """Collect every loose label file in labels_dir into a bundle."""
+    import yaml
+
+    bundle: LabelsBundleFile = {
+        "version": LABELS_BUNDLE_VERSION,
+        "labels": {},
+    }
+    for filename in sorted(os.listdir(labels_dir)):
+        path = os.path.join(labels_dir, filename)
+        if filename.startswith(".") or not os.path.isfile(path):
+            continue
+        try:
+            with open(path) as f:
+                labels = yaml.load(f, Loader=get_yaml_loader())
+        except Exception as e:
+            print(f"Skipping {path}: {e}", file=sys.stderr)
+            continue
+        if labels:
+            # As loaded, just as configure_nerve would use them from the loose file
+            bundle["labels"][filename] = labels
+    return bundle
+
+
+def write_labels_bundle(
+    bundle: LabelsBundleFile,
+    bundle_path: str,
+) -> None:
+    tmp_path = f"{bundle_path}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(bundle, fp, sort_keys=True, separators=(",", ":"))
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, bundle_path)
+
+
+def remove_loose_label_files(
+    bundle: LabelsBundleFile,
+    labels_dir: str,
+) -> None:
+    """Remove the loose label files in labels_dir that bundle was built from,
+    so that configure_nerve doesn't also read them."""
+    for filename in bundle["labels"]:
+        try:
+            os.remove(os.path.join(labels_dir, filename))
+        except FileNotFoundError:
+            pass
+
+
+def parse_args(
+    args: Sequence[str],
+) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build a nerve custom labels bundle from a labels directory")
+    parser.add_argument(
+        "--labels-dir",
+        type=str,
+        default=DEFAULT_LABEL_DIR,
+        help="Directory containing custom labels for nerve services (default: %(default)s).",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help=f"Where to write the bundle (default: <labels-dir>/{LABELS_BUNDLE_FILENAME}, which is where "
+        "configure_nerve looks).",
+    )
+    parser.add_argument(
+        "--remove-loose-files",
+        action="store_true",
+        help="Once the bundle is written, remove the loose label files it was built from. Otherwise configure_nerve "
+        "still reads them too, as they override the bundle.",
+    )
+    return parser.parse_args(args)
+
+
+def main() -> None:
+    opts = parse_args(sys.argv[1:])
+    bundle = build_labels_bundle(opts.labels_dir)
+    write_labels_bundle(bundle, opts.output or get_labels_bundle_path(opts.labels_dir))
+    if opts.remove_loose_files:
+        remove_loose_label_files(bundle, opts.labels_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,20 +3,45 @@
 import argparse
 import os
 import socket
-import subprocess
 import sys
+import threading
 import time
-from pathlib import Path
-
-import requests
-import yaml
-from paasta_tools.long_running_service_tools import load_service_namespace_config
-from requests.exceptions import RequestException
-from service_configuration_lib import read_service_configuration
+from typing import TYPE_CHECKING
+from typing import Collection
+from typing import Dict
+from typing import FrozenSet
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Union
+from typing import cast
+
+from nerve_tools.config import UpdownServiceConfig
+from nerve_tools.envoy import EnvoyAdminClient
+from nerve_tools.envoy import get_envoy_host_address
+from nerve_tools.envoy import is_envoy_host_routable
+from nerve_tools.hacheck import DEFAULT_HACHECK_PORT
+from nerve_tools.hacheck import HacheckClient
+from nerve_tools.util import get_yaml_loader
+from nerve_tools.zk_topology import DEFAULT_ZK_TOPOLOGY_DIR
+from nerve_tools.zk_topology import ZK_DEFAULT_CLUSTER_TYPE
+from nerve_tools.zk_topology import ZK_LOCAL_CLUSTER_LOCATION
+
+if TYPE_CHECKING:
+    import kazoo.client
+    import requests
+
+    from nerve_tools.zk_registrations import RegistrationWatcher
 
 # Maximum amount of time to run before returning
 DEFAULT_TIMEOUT_S = 300
 
+# How long a local healthcheck may take, if the service doesn't say
+DEFAULT_HEALTHCHECK_TIMEOUT_S = 1.0
+
 # Even though a service has entered the expected state in our local HAProxy
 # instance, there may still be a short delay before all remote HAProxy instances
 # also pick up this change.  So we add an additional delay before returning.
@@ -24,6 +49,11 @@ DEFAULT_TIMEOUT_S = 300
 # before we shut them down.
 DEFAULT_WAIT_TIME_S = 5
 
+# Convergence is checked for every ENVOY_MIN_POLL_INTERVAL_S at first, so that
+# a quick one is noticed quickly, backing off by ENVOY_POLL_BACKOFF after each
+# check to at most every ENVOY_POLL_INTERVAL_S
+ENVOY_MIN_POLL_INTERVAL_S = 0.05
+ENVOY_POLL_BACKOFF = 2.0
 ENVOY_POLL_INTERVAL_S = 1
 
 
@@ -63,54 +93,159 @@ def get_args() -> argparse.Namespace:
         type=int,
         help="Additional number of seconds to wait for convergence (default: %(default)s)",
     )
+    parser.add_argument(
+        "--adaptive-wait",
+        action="store_true",
+        help=(
+            "When downing, rather than always waiting --wait-time after convergence, only wait (for at most that "
+            "long) until the service's ports have no connections left.  Only done if the service can be seen "
+            "listening on them, from this network namespace"
+        ),
+    )
     parser.add_argument(
         "-x",
         "--wait-only",
         action="store_true",
         help="Wait for the specified state without reconfiguring hacheck",
     )
+    parser.add_argument(
+        "--hacheck-port",
+        type=int,
+        default=DEFAULT_HACHECK_PORT,
+        help="Port of the local hacheck's HTTP API (default: %(default)s)",
+    )
     parser.add_argument("--envoy-eds-dir", help="if set, check for mesh convergence by looking at envoy")
     parser.add_argument(
-        "service",
+        "--envoy-admin-port",
+        type=int,
+        help=(
+            "if set, check for mesh convergence by asking the local envoy admin for the health of its endpoints "
+            "(rather than reading --envoy-eds-dir)"
+        ),
+    )
+    parser.add_argument(
+        "--check-zk",
+        action="store_true",
+        help=(
+            "if set, check for convergence by watching the service's registrations in the local ZooKeeper cluster "
+            "(rather than looking at envoy)"
+        ),
+    )
+    parser.add_argument("--zk-topology-dir", default=DEFAULT_ZK_TOPOLOGY_DIR, help="(default: %(default)s)")
+    parser.add_argument("--zk-cluster-type", default=ZK_DEFAULT_CLUSTER_TYPE, help="(default: %(default)s)")
+    parser.add_argument(
+        "--zk-cluster-location",
+        default=ZK_LOCAL_CLUSTER_LOCATION,
+        help="ZooKeeper cluster the services register in (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--all-local",
+        action="store_true",
+        help="Control every service running on this host, rather than those given",
+    )
+    parser.add_argument(
+        "services",
+        metavar="service",
+        nargs="*",
         type=service_name,
         help=(
-            "Service name, including namespace and optionally port: "
+            "Service names, including namespace and optionally port: "
             "service_name.service_instance[:port] e.g. 'service_one.main' or "
             "'service_one.main:30021'"
         ),
     )
     parser.add_argument("state", choices=["up", "down"], help="desired state")
     args = parser.parse_args()
-    if ":" in args.service:
-        service, port = args.service.split(":")
-        args.service, args.port = service, int(port)
-    else:
-        args.service, args.port = args.service, None
+    if args.all_local == bool(args.services):
+        parser.error("give either one or more services or --all-local")
+
+    services: List[Tuple[str, Optional[int]]] = []
+    for service in args.services:
+        if ":" in service:
+            service, port = service.split(":")
+            services.append((service, int(port)))
+        else:
+            services.append((service, None))
+    args.services = services
     return args
 
 
+def get_local_services() -> List[Tuple[str, Optional[int]]]:
+    """Return (service, port) for every service instance running on this host."""
+    from nerve_tools.configure_nerve import call_paasta_dump_locally_running_services
+
+    return sorted(
+        {(service, service_info.get("port")) for service, service_info in call_paasta_dump_locally_running_services()},
+        key=lambda service_port: (service_port[0], service_port[1] or 0),
+    )
+
+
 def reconfigure_hacheck(
     service: str,
     state: str,
-    port: int,
+    port: Optional[int],
+    hacheck: HacheckClient,
 ) -> None:
-    if state == "down":
-        hacheck_command = "/usr/bin/hadown"
-    else:
-        hacheck_command = "/usr/bin/haup"
+    hacheck.set_state(service, state, port)
 
-    command = [hacheck_command, service]
-    if port is not None:
-        command.extend(["-P", str(port)])
 
+def get_my_ip_address() -> str:
+    return socket.gethostbyname(socket.getfqdn())
+
+
+# The endpoint addresses last read from each EDS file, keyed by its path, along
+# with the file's (mtime, size, inode) when they were, so that it is only
+# parsed again if it has changed.  Keeping only the latest per path bounds
+# this by the number of services, however often their files are rewritten.
+_eds_endpoint_addresses: Dict[str, Tuple[Tuple[int, int, int], FrozenSet[str]]] = {}
+_eds_endpoint_addresses_lock = threading.Lock()
+
+
+def _load_eds_endpoint_addresses(
+    path: str,
+) -> FrozenSet[str]:
+    import yaml
+
+    with open(path) as fp:
+        eds_config = yaml.load(fp, Loader=get_yaml_loader())
+
+    # we only have egress clusters and will always have one entry in the resources list
+    # (even if there's no endpoints) so we can just unconditionally reach in and grab
+    # the endpoint list without doing any further checks
+    return frozenset(
+        lb_endpoint["endpoint"]["address"]["socket_address"]["address"]
+        for entry in eds_config["resources"][0]["endpoints"]
+        for lb_endpoint in entry.get("lb_endpoints") or []
+    )
+
+
+def get_eds_endpoint_addresses(
+    service: str,
+    envoy_eds_dir: str,
+) -> Optional[FrozenSet[str]]:
+    """Return the addresses of every endpoint of service in its Envoy EDS
+    file, or None if there is no such file."""
+    path = os.path.join(envoy_eds_dir, service, f"{service}.yaml")
     try:
-        subprocess.check_call(command)
-    except Exception:
-        print("Error running %s" % hacheck_command, file=sys.stderr)
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
 
+    with _eds_endpoint_addresses_lock:
+        cached = _eds_endpoint_addresses.get(path)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1]
+
+    addresses = _load_eds_endpoint_addresses(path)
+    with _eds_endpoint_addresses_lock:
+        _eds_endpoint_addresses[path] = (stat_key, addresses)
+    return addresses
 
-def get_my_ip_address() -> str:
-    return socket.gethostbyname(socket.getfqdn())
+
+class NoBackendsError(Exception):
+    """The service has no backends at all in the mesh, so will never enter
+    any state there."""
 
 
 def check_envoy_state(
@@ -124,165 +259,480 @@ def check_envoy_state(
     If the expected_state is 'down', then return 'true' iff the local service
     instance is NOT available in the local Envoy EDS config
     """
-    raw_endpoint_file = Path(envoy_eds_dir) / service / f"{service}.yaml"
-    if not raw_endpoint_file.exists():
+    addresses = get_eds_endpoint_addresses(service, envoy_eds_dir)
+    if addresses is None:
         # not much we can do if this file doesn't exist
         return False
 
-    # we only have egress clusters and will always have one entry in the resources list
-    # (even if there's no endpoints) so we can just unconditionally reach in and grab
-    # the endpoint list without doing any further checks
-    endpoints = []
-    for entry in yaml.safe_load(raw_endpoint_file.read_text())["resources"][0]["endpoints"]:
-        if entry.get("lb_endpoints"):
-            endpoints.extend(entry["lb_endpoints"])
-
     host = get_my_ip_address()
 
-    if len(endpoints) == 0:
-        msg = "No backends present in the service mesh, have you added any?"
-        print(msg, file=sys.stderr)
-        sys.exit(1)
-
-    entries = [
-        # yup, this is very aesthetic...
-        endpoint
-        for endpoint in endpoints
-        if host in endpoint["endpoint"]["address"]["socket_address"]["address"]
-    ]
+    if len(addresses) == 0:
+        raise NoBackendsError(service)
 
-    if len(entries) == 0:
+    if host not in addresses:
         # We did not find our host
         return expected_state == "down"
     else:
         # there's no concept of states - you're either up (present as an endpoint)
         # or you're down (not present as an endpoint)
-        # TODO: take into account outlier ejection?
+        # (check_envoy_admin_state takes health and outlier ejection into account)
         return expected_state == "up"
 
 
+def check_envoy_admin_state(
+    service: str,
+    expected_state: str,
+    envoy_admin: EnvoyAdminClient,
+) -> bool:
+    """Like check_envoy_state, but asking the local Envoy admin, which also
+    knows whether the local instance is being sent traffic: it is only 'up'
+    if Envoy considers it healthy and hasn't ejected it as an outlier."""
+    cluster_status = envoy_admin.get_cluster_status(service)
+    if cluster_status is None:
+        return False
+
+    host_statuses = cluster_status.get("host_statuses", [])
+    if len(host_statuses) == 0:
+        raise NoBackendsError(service)
+
+    host = get_my_ip_address()
+    routable = any(
+        is_envoy_host_routable(host_status)
+        for host_status in host_statuses
+        if get_envoy_host_address(host_status) == host
+    )
+    return routable == (expected_state == "up")
+
+
+def check_zk_state(
+    expected_state: str,
+    registrations: "RegistrationWatcher",
+) -> bool:
+    """Return whether the local service instance is registered in ZooKeeper
+    if the expected_state is 'up', or isn't if it's 'down'.  Once it is
+    (de)registered there, every synapse and Envoy will soon follow."""
+    registered = get_my_ip_address() in registrations.get_registered_hosts()
+    return registered == (expected_state == "up")
+
+
+# A requests.Session isn't safe to share between threads, so each thread
+# (i.e. each service being waited for) gets its own
+_healthcheck_sessions = threading.local()
+
+
+def _get_healthcheck_session() -> "requests.Session":
+    """One session for every healthcheck made by this thread, so that polling
+    a service reuses a kept-alive connection to it."""
+    session: Optional["requests.Session"] = getattr(_healthcheck_sessions, "session", None)
+    if session is None:
+        import requests
+
+        session = _healthcheck_sessions.session = requests.Session()
+    return session
+
+
 def check_local_healthcheck(
     service_name: str,
+    service_config: Optional[UpdownServiceConfig] = None,
 ) -> bool:
-    """Makes a local HTTP healthcheck call to the service and returns True if
-    it gets a 2XX response, else returns False.
+    """Makes a local HTTP healthcheck call (or for a tcp service, opens a
+    connection) to the service and returns True if it gets a 2XX response (or
+    connects), else returns False.  Either must succeed within the service's
+    healthcheck_timeout_s.
 
     :param service_name: a string like 'service_one.main'
-    :return: Whether healthcheck call was successful for a http service.
-    Returns false for a tcp service.
+    :param service_config: the service's config, if already loaded
+    :return: Whether healthcheck call was successful.
     :rtype: boolean
     """
-    srv_name, namespace = service_name.split(".")
-    srv_config = read_service_configuration(srv_name)
-    smartstack_config = srv_config.get("smartstack", {})
-    namespace_config = smartstack_config.get(namespace, {})
+    import requests
+
+    if service_config is None:
+        service_config = load_service_config(service_name)
 
-    healthcheck_uri = namespace_config.get("healthcheck_uri", "/status")
-    healthcheck_port = namespace_config.get("healthcheck_port", srv_config.get("port"))
-    healthcheck_mode = namespace_config.get("mode", "http")
+    healthcheck_uri = service_config["healthcheck_uri"]
+    healthcheck_port = service_config["healthcheck_port"]
+    healthcheck_mode = service_config["healthcheck_mode"]
+    timeout_s = service_config["healthcheck_timeout_s"]
 
-    # TODO: Add support for TCP healthcheck using hacheck - Ref. RB: 109478
-    if healthcheck_mode == "http" and healthcheck_port:
+    if not healthcheck_port:
+        return False
+
+    if healthcheck_mode == "tcp":
+        try:
+            socket.create_connection(("127.0.0.1", healthcheck_port), timeout=timeout_s).close()
+            return True
+        except OSError as e:
+            print("Connecting to port {}, got - {}".format(healthcheck_port, str(e)), file=sys.stderr)
+    elif healthcheck_mode == "http":
         try:
             url = "http://{host}:{port}{uri}".format(host="127.0.0.1", port=healthcheck_port, uri=healthcheck_uri)
-            requests.get(url).raise_for_status()
+            _get_healthcheck_session().get(url, timeout=timeout_s).raise_for_status()
             return True
-        except RequestException as e:
+        except requests.exceptions.RequestException as e:
             print("Calling {}, got - {}".format(url, str(e)), file=sys.stderr)
 
     return False
 
 
-def wait_for_envoy_state(
+# /proc/net/tcp's codes for the ESTABLISHED and LISTEN states
+TCP_ESTABLISHED = "01"
+TCP_LISTEN = "0A"
+PROC_NET_TCP_PATHS = ("/proc/net/tcp", "/proc/net/tcp6")
+
+# With --adaptive-wait, how often to count connections, and for how long there
+# must have been none before the service is considered drained (to allow for
+# remote proxies which haven't quite caught up).  However quickly it drains,
+# at least DRAIN_MIN_WAIT_S (or the whole wait, if that's shorter) is waited.
+DRAIN_POLL_INTERVAL_S = 0.05
+DRAIN_QUIET_PERIOD_S = 0.25
+DRAIN_MIN_WAIT_S = 1.0
+
+
+def get_established_connection_count(
+    ports: Collection[int],
+    proc_net_tcp_paths: Sequence[str] = PROC_NET_TCP_PATHS,
+) -> Optional[int]:
+    """Return the number of established connections to any of ports on this
+    host (in this network namespace), or None if something isn't seen to be
+    listening on every one of them (e.g. it's in another network namespace),
+    in which case no connections doesn't mean drained."""
+    count = 0
+    listening: Set[int] = set()
+    for path in proc_net_tcp_paths:
+        try:
+            with open(path) as fp:
+                next(fp, None)  # header
+                for line in fp:
+                    fields = line.split()
+                    port = int(fields[1].rpartition(":")[2], 16)
+                    if port not in ports:
+                        continue
+                    if fields[3] == TCP_ESTABLISHED:
+                        count += 1
+                    elif fields[3] == TCP_LISTEN:
+                        listening.add(port)
+        except FileNotFoundError:
+            continue
+    if not listening.issuperset(ports):
+        return None
+    return count
+
+
+def wait_for_connections_to_drain(
+    ports: Collection[int],
+    max_wait_s: float,
+) -> float:
+    """Wait (for at most max_wait_s, and at least DRAIN_MIN_WAIT_S) until there
+    have been no connections to ports for DRAIN_QUIET_PERIOD_S, returning how
+    long it took.  If the connections can't be counted, waits the whole
+    max_wait_s."""
+    start = time.monotonic()
+    deadline = start + max_wait_s
+    min_deadline = start + min(DRAIN_MIN_WAIT_S, max_wait_s)
+    drained_since = None
+    while True:
+        now = time.monotonic()
+        if get_established_connection_count(ports) != 0:
+            drained_since = None
+        elif drained_since is None:
+            drained_since = now
+        if drained_since is not None and now - drained_since >= DRAIN_QUIET_PERIOD_S and now >= min_deadline:
+            break
+        if now >= deadline:
+            break
+        time.sleep(min(DRAIN_POLL_INTERVAL_S, deadline - now))
+    return time.monotonic() - start
+
+
+# How waiting for a service to enter a state can end
+ENTERED_STATE = "entered state '{state}'"
+HEALTHY_WITH_ALL_DOWN = "healthy, with the 'all' service down"
+TIMED_OUT = "failed to enter state '{state}'"
+NO_BACKENDS = "has no backends in the service mesh"
+STOPPED = "stopped waiting to enter state '{state}'"
+FAILED = (TIMED_OUT, NO_BACKENDS, STOPPED)
+
+
+def _wait_for_service_envoy_state(
     service: str,
     expected_state: str,
+    deadline: float,
+    envoy_eds_dir: Optional[str],
+    envoy_admin: Optional[EnvoyAdminClient],
+    zk: Optional["kazoo.client.KazooClient"],
+    all_down: bool,
+    service_config: Optional[UpdownServiceConfig],
+    stop: threading.Event,
+) -> Tuple[str, float]:
+    """Wait until deadline (by time.monotonic), or stop is set, for the
+    specified service to enter the given state in Envoy, returning how the
+    wait ended and how long it took.
+
+    Rather than only polling (on a backoff schedule), block on changes to
+    the service's EDS directory, so that convergence is noticed as soon as its
+    EDS file is rewritten.  Polling continues (and is all that's done, if the
+    directory can't be watched) for the healthcheck check.  If envoy_admin is
+    given, the Envoy admin is polled instead; if zk is, the service's
+    registrations there are watched instead.
+    """
+    from nerve_tools.inotify import DirectoryWatcher
+
+    registrations: Optional["RegistrationWatcher"] = None
+    if zk is not None:
+        from nerve_tools.zk_registrations import RegistrationWatcher
+
+        registrations = RegistrationWatcher(zk, service)
+    watch_dir = None
+    if envoy_eds_dir and envoy_admin is None and registrations is None:
+        watch_dir = os.path.join(envoy_eds_dir, service)
+
+    start = time.monotonic()
+    poll_interval_s = ENVOY_MIN_POLL_INTERVAL_S
+    with DirectoryWatcher(watch_dir) as directory_watcher:
+        watcher: Union[DirectoryWatcher, "RegistrationWatcher"] = registrations or directory_watcher
+        while time.monotonic() < deadline:
+            if stop.is_set():
+                return STOPPED, time.monotonic() - start
+
+            # If we are asking to up a service on a machine that has the "all"
+            # service downed, return a success providing that the service itself
+            # is healthy
+            if expected_state == "up" and all_down:
+                if check_local_healthcheck(service, service_config):
+                    return HEALTHY_WITH_ALL_DOWN, time.monotonic() - start
+
+            try:
+                if registrations is not None:
+                    entered_state = check_zk_state(expected_state, registrations)
+                elif envoy_admin is not None:
+                    entered_state = check_envoy_admin_state(service, expected_state, envoy_admin)
+                else:
+                    entered_state = check_envoy_state(service, expected_state, cast(str, envoy_eds_dir))
+            except NoBackendsError:
+                return NO_BACKENDS, time.monotonic() - start
+            if entered_state:
+                return ENTERED_STATE, time.monotonic() - start
+
+            sys.stdout.write(".")
+            sys.stdout.flush()
+
+            # Checks can take a while themselves, so never wait past the deadline
+            watcher.wait(max(0.0, min(poll_interval_s, deadline - time.monotonic())))
+            poll_interval_s = min(poll_interval_s * ENVOY_POLL_BACKOFF, ENVOY_POLL_INTERVAL_S)
+
+    return TIMED_OUT, time.monotonic() - start
+
+
+def wait_for_envoy_state(
+    services: Sequence[str],
+    expected_state: str,
     timeout: int,
     wait_time: int,
-    envoy_eds_dir: str,
+    envoy_eds_dir: Optional[str],
+    hacheck: Optional[HacheckClient] = None,
+    envoy_admin: Optional[EnvoyAdminClient] = None,
+    zk: Optional["kazoo.client.KazooClient"] = None,
+    service_configs: Optional[Mapping[str, UpdownServiceConfig]] = None,
+    drain_ports: Optional[Collection[int]] = None,
 ) -> int:
-    """Wait for the specified service to enter the given state in Envoy."""
-    # This isn't precise, but it's easy to test :)
-    iterations = int(timeout / ENVOY_POLL_INTERVAL_S)
-    n = 0
-
-    for n in range(iterations):
-        # If we are asking to up a service on a machine that has the "all"
-        # service downed, return a success providing that the service itself
-        # is healthy
-        if expected_state == "up":
-            try:
-                with open(os.devnull, "w") as devnull:
-                    subprocess.check_call(["/usr/bin/hastatus", "all"], stdout=devnull)
-            except Exception:
-                if check_local_healthcheck(service):
-                    return 0
-
-        if check_envoy_state(service, expected_state, envoy_eds_dir):
-            print("{}Service entered state '{}'".format("\n" if n > 0 else "", expected_state))
-            print(f"Sleeping for an additional {wait_time}s")
-            time.sleep(wait_time)
-            return 0
-
-        sys.stdout.write(".")
-        sys.stdout.flush()
+    """Wait for the specified services to enter the given state in Envoy,
+    as seen in its EDS files in envoy_eds_dir or, if given, by envoy_admin;
+    or if zk is given, to be (de)registered in ZooKeeper.
+
+    The services are waited for concurrently, all within timeout, and once
+    they have, wait_time is waited (once) for the rest of the mesh to catch up.
+    If they are being downed and drain_ports are given, that's cut short once
+    the last connection to them has closed.
+    """
+    from concurrent.futures import FIRST_COMPLETED
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures import wait
+
+    deadline = time.monotonic() + timeout
+    # Whether the host as a whole is downed won't change while we wait, so
+    # only ask once
+    all_down = expected_state == "up" and not (hacheck or HacheckClient()).is_up("all")
+    # Set once the outcome is known to be a failure, so that the other
+    # services aren't waited for to no end
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=len(services), thread_name_prefix="updown_service") as executor:
+        futures = {
+            executor.submit(
+                _wait_for_service_envoy_state,
+                service,
+                expected_state,
+                deadline,
+                envoy_eds_dir,
+                envoy_admin,
+                zk,
+                all_down,
+                (service_configs or {}).get(service),
+                stop,
+            ): service
+            for service in services
+        }
+        results: Dict[str, Tuple[str, float]] = {}
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[futures[future]] = future.result()
+                    if results[futures[future]][0] == NO_BACKENDS:
+                        stop.set()
+        except BaseException:
+            # e.g. a wait failing unexpectedly, or being interrupted; either
+            # way, don't hold up raising it until the others have timed out
+            stop.set()
+            raise
+
+    print()
+    for service in services:
+        outcome, elapsed_s = results[service]
+        print(f"{service}: {outcome.format(state=expected_state)} after {elapsed_s:.2f}s")
+    outcomes = {service: outcome for service, (outcome, _) in results.items()}
+
+    if NO_BACKENDS in outcomes.values():
+        print("No backends present in the service mesh, have you added any?", file=sys.stderr)
+        return 1
 
-        time.sleep(ENVOY_POLL_INTERVAL_S)
-    else:
-        print("{}Service failed to enter state '{}'".format("\n" if n > 0 else "", expected_state))
+    failed = [service for service, outcome in outcomes.items() if outcome in FAILED]
+    if failed:
+        print(f"{len(failed)} of {len(services)} services failed to enter state '{expected_state}'")
         if expected_state == "up":
             print("*** Please manually check your service's healthcheck endpoint. ***")
             print("*** If your service is healthy, then please talk to #paasta. ***")
         return 1
 
+    # Only needed if the mesh had something to catch up with
+    if ENTERED_STATE in outcomes.values():
+        if expected_state == "down" and drain_ports is not None:
+            ports = ", ".join(str(port) for port in sorted(drain_ports))
+            print(f"Waiting up to {wait_time}s for connections to ports {ports} to drain")
+            drained_s = wait_for_connections_to_drain(drain_ports, wait_time)
+            print(f"Waited an additional {drained_s:.2f}s")
+        else:
+            print(f"Sleeping for an additional {wait_time}s")
+            time.sleep(wait_time)
+    return 0
 
-def _should_manage_service(
+
+def load_service_config(
     service_name: str,
-) -> bool:
+) -> UpdownServiceConfig:
+    """Read (once) everything updown_service needs to know about a service
+    from its yelpsoa configs."""
+    from paasta_tools.long_running_service_tools import load_service_namespace_config
+    from service_configuration_lib import read_service_configuration
+
     srv_name, namespace = service_name.split(".")
-    service_config = load_service_namespace_config(srv_name, namespace)
+    namespace_config = load_service_namespace_config(srv_name, namespace)
     classic_config = read_service_configuration(srv_name)
+    classic_namespace_config = classic_config.get("smartstack", {}).get(namespace, {})
 
     # None is a valid value of proxy_port indicating a discovery only service
-    should_manage = service_config.get("proxy_port", -1) != -1
+    in_mesh = namespace_config.get("proxy_port", -1) != -1
     blacklisted = classic_config.get("no_updown_service")
 
-    return should_manage and not blacklisted
+    return {
+        "managed": bool(in_mesh and not blacklisted),
+        "updown_timeout_s": namespace_config.get("updown_timeout_s", DEFAULT_TIMEOUT_S),
+        "healthcheck_uri": classic_namespace_config.get("healthcheck_uri", "/status"),
+        "healthcheck_port": classic_namespace_config.get("healthcheck_port", classic_config.get("port")),
+        "healthcheck_mode": classic_namespace_config.get("mode", "http"),
+        "healthcheck_timeout_s": namespace_config.get("healthcheck_timeout_s", DEFAULT_HEALTHCHECK_TIMEOUT_S),
+    }
+
+
+def _should_manage_service(
+    service_name: str,
+    service_config: Optional[UpdownServiceConfig] = None,
+) -> bool:
+    if service_config is None:
+        service_config = load_service_config(service_name)
+    return service_config["managed"]
 
 
 def _get_timeout_s(
     service_name: str,
-    timeout: int,
+    timeout: Optional[int],
+    service_config: Optional[UpdownServiceConfig] = None,
 ) -> int:
     if timeout is not None:
         return timeout
 
-    srv_name, namespace = service_name.split(".")
-    namespace_configuration = load_service_namespace_config(srv_name, namespace)
-    timeout_s = namespace_configuration.get("updown_timeout_s", DEFAULT_TIMEOUT_S)
-    return timeout_s
+    if service_config is None:
+        service_config = load_service_config(service_name)
+    return service_config["updown_timeout_s"]
+
+
+def get_drain_ports(
+    services: Sequence[Tuple[str, Optional[int]]],
+) -> Optional[Set[int]]:
+    """Return the ports whose connections show whether services have
+    drained, or None if that can't be told for every one of them."""
+    unknown = [service for service, port in services if port is None]
+    if unknown:
+        print(f"Not waiting adaptively, as the ports of {', '.join(unknown)} aren't known")
+        return None
+    return {port for _, port in services if port is not None}
 
 
 def main() -> None:
     args = get_args()
-    should_check = _should_manage_service(args.service)
-    timeout_s = _get_timeout_s(args.service, args.timeout)
-
-    if not should_check:
-        print(f"{args.service} is not available in the service mesh, doing nothing")
+    services = get_local_services() if args.all_local else args.services
+
+    # Read each service's config once, for every helper to share
+    service_configs = {
+        service: load_service_config(service) for service in sorted({service for service, _ in services})
+    }
+
+    managed_services = []
+    for service, port in services:
+        if _should_manage_service(service, service_configs[service]):
+            managed_services.append((service, port))
+        else:
+            print(f"{service} is not available in the service mesh, doing nothing")
+    if not managed_services:
         sys.exit(0)
 
+    # Everything is waited for at once, so wait as long as the slowest needs
+    timeout_s = max(
+        _get_timeout_s(service, args.timeout, service_configs[service]) for service, _ in managed_services
+    )
+
+    hacheck = HacheckClient(port=args.hacheck_port)
     if not args.wait_only:
-        reconfigure_hacheck(args.service, args.state, args.port)
+        for service, port in managed_services:
+            reconfigure_hacheck(service, args.state, port, hacheck)
 
     result = 0
-    if args.envoy_eds_dir:
+    envoy_admin = EnvoyAdminClient(args.envoy_admin_port) if args.envoy_admin_port else None
+    zk = None
+    if args.check_zk:
+        from nerve_tools.zk_registrations import connect_to_zk
+
+        zk = connect_to_zk(args.zk_topology_dir, args.zk_cluster_type, args.zk_cluster_location)
+    if args.envoy_eds_dir or envoy_admin is not None or zk is not None:
         result = wait_for_envoy_state(
-            service=args.service,
+            services=sorted({service for service, _ in managed_services}),
             expected_state=args.state,
             timeout=timeout_s,
             wait_time=args.wait_time,
             envoy_eds_dir=args.envoy_eds_dir,
+            hacheck=hacheck,
+            envoy_admin=envoy_admin,
+            zk=zk,
+            service_configs=service_configs,
+            drain_ports=get_drain_ports(managed_services) if args.adaptive_wait else None,
         )
+    hacheck.close()
+    if envoy_admin is not None:
+        envoy_admin.close()
+    if zk is not None:
+        zk.stop()
+        zk.close()
     sys.exit(result)
 
 
@@ -1,4 +1,10 @@
 import socket
+from typing import TYPE_CHECKING
+from typing import Type
+from typing import Union
+
+if TYPE_CHECKING:
+    import yaml
 
 
 def get_hostname() -> str:
@@ -7,3 +13,13 @@ def get_hostname() -> str:
 
 def get_host_ip() -> str:
     return socket.gethostbyname(get_hostname())
+
+
+def get_yaml_loader() -> "Union[Type[yaml.CSafeLoader], Type[yaml.SafeLoader]]":
+    """Import yaml on first use (it is slow to import and only needed on some
+    code paths), preferring the much faster libyaml loader when available."""
+    try:
+        from yaml import CSafeLoader as Loader  # type: ignore
+    except ImportError:
+        from yaml import SafeLoader as Loader  # type: ignore
+    return Loader
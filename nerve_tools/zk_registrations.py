@@ -0,0 +1,113 @@
+"""Watch where a service is registered by nerve in ZooKeeper, the source of
+truth every synapse and Envoy in the cluster discovers it from.
+"""
+
+import json
+import threading
+from typing import TYPE_CHECKING
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+
+from nerve_tools.zk_topology import DEFAULT_ROOTS
+from nerve_tools.zk_topology import DEFAULT_ZK_TOPOLOGY_DIR
+from nerve_tools.zk_topology import ZK_DEFAULT_CLUSTER_TYPE
+from nerve_tools.zk_topology import ZK_LOCAL_CLUSTER_LOCATION
+
+if TYPE_CHECKING:
+    import kazoo.client
+    from kazoo.protocol.states import WatchedEvent
+
+DEFAULT_ZK_CONNECT_TIMEOUT_S = 10.0
+
+
+def connect_to_zk(
+    zk_topology_dir: str = DEFAULT_ZK_TOPOLOGY_DIR,
+    cluster_type: str = ZK_DEFAULT_CLUSTER_TYPE,
+    cluster_location: str = ZK_LOCAL_CLUSTER_LOCATION,
+    timeout: float = DEFAULT_ZK_CONNECT_TIMEOUT_S,
+) -> "kazoo.client.KazooClient":
+    import kazoo.client
+
+    from nerve_tools.configure_nerve import get_named_zookeeper_topology
+
+    zk_topology = get_named_zookeeper_topology(cluster_type, cluster_location, zk_topology_dir)
+    zk = kazoo.client.KazooClient(hosts=",".join(zk_topology), read_only=True)
+    zk.start(timeout=timeout)
+    return zk
+
+
+def get_registered_host(
+    data: bytes,
+) -> Optional[str]:
+    try:
+        return json.loads(data).get("host")
+    except (ValueError, AttributeError):
+        return None
+
+
+class RegistrationWatcher:
+    """Tracks the hosts a service is registered from, under each of roots.
+
+    Instance nodes are only read when first seen, and any change to the
+    instances (or the service's node appearing) wakes wait().
+    """
+
+    def __init__(
+        self,
+        zk: "kazoo.client.KazooClient",
+        service: str,
+        roots: Sequence[str] = DEFAULT_ROOTS,
+    ) -> None:
+        self.zk = zk
+        self.service = service
+        self.roots = roots
+        # instance node path -> the host it registers, if it could be read
+        self._hosts: Dict[str, Optional[str]] = {}
+        self._changed = threading.Event()
+
+    def _on_change(
+        self,
+        event: "WatchedEvent",
+    ) -> None:
+        self._changed.set()
+
+    def get_registered_hosts(self) -> Set[str]:
+        from kazoo.exceptions import NoNodeError
+
+        # Cleared first, so that changes from here on wake the next wait()
+        self._changed.clear()
+
+        paths: List[str] = []
+        for root in self.roots:
+            service_path = f"{root}/{self.service}"
+            try:
+                children = self.zk.get_children(service_path, watch=self._on_change)
+            except NoNodeError:
+                # Be told when it's created instead
+                if self.zk.exists(service_path, watch=self._on_change) is None:
+                    continue
+                children = self.zk.get_children(service_path, watch=self._on_change)
+            paths.extend(f"{service_path}/{child}" for child in children)
+
+        pending = [(path, self.zk.get_async(path)) for path in paths if path not in self._hosts]
+        for path, result in pending:
+            try:
+                data, _ = result.get()
+            except NoNodeError:
+                # Gone again already
+                continue
+            self._hosts[path] = get_registered_host(data)
+
+        self._hosts = {path: self._hosts[path] for path in paths if path in self._hosts}
+        return {host for host in self._hosts.values() if host is not None}
+
+    def wait(
+        self,
+        timeout: float,
+    ) -> bool:
+        """Wait up to timeout seconds for the registrations to change,
+        returning whether they did."""
+        return self._changed.wait(timeout)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""Compile the CEP 355 zookeeper_discovery tree into a single index file.
+
+configure_nerve and clean_nerve would otherwise glob and parse every topology
+file on each run. The index records the mtime of every file and directory it
+was built from, so readers can cheaply tell when it is stale and fall back to
+parsing the YAML files themselves.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from nerve_tools.config import ZKTopologyIndex
+from nerve_tools.util import get_yaml_loader
+
+DEFAULT_ZK_TOPOLOGY_DIR = "/nail/etc/zookeeper_discovery"
+
+# CEP 355 Zookeepers
+ZK_DEFAULT_CLUSTER_TYPE = "infrastructure"
+# The topology of the cluster this host registers in
+ZK_LOCAL_CLUSTER_LOCATION = "local"
+
+SMARTSTACK_ROOT = "/smartstack/global"
+ENVOY_ROOT = "/envoy/global"
+# Where configure_nerve has nerve register services
+DEFAULT_ROOTS = [SMARTSTACK_ROOT, ENVOY_ROOT]
+
+# Bump whenever the layout of ZKTopologyIndex changes so that old indexes
+# are ignored rather than misread.
+ZK_TOPOLOGY_INDEX_VERSION = 1
+
+
+def get_zk_topology_index_path(
+    zk_topology_dir: str,
+) -> str:
+    # The index lives next to (rather than inside) the topology directory so
+    # that writing it doesn't change the mtime of the tree it describes.
+    return zk_topology_dir.rstrip("/") + ".index.json"
+
+
+def get_zk_topology_manifest(
+    zk_topology_dir: str,
+) -> Dict[str, int]:
+    """Return the mtime of the topology directory, every cluster type
+    directory and every topology file within it, keyed by relative path."""
+    manifest = {".": os.stat(zk_topology_dir).st_mtime_ns}
+    for cluster_type_entry in os.scandir(zk_topology_dir):
+        if not cluster_type_entry.is_dir():
+            continue
+        manifest[cluster_type_entry.name] = cluster_type_entry.stat().st_mtime_ns
+        for entry in os.scandir(cluster_type_entry.path):
+            if entry.name.endswith(".yaml"):
+                # Follow symlinks so that retargeting 'local.yaml' is noticed
+                try:
+                    mtime_ns = entry.stat().st_mtime_ns
+                except FileNotFoundError:
+                    # A dangling symlink, which is no topology at all (until
+                    # it's retargeted, adding it to the manifest)
+                    continue
+                manifest[f"{cluster_type_entry.name}/{entry.name}"] = mtime_ns
+    return manifest
+
+
+def compile_zk_topology_index(
+    zk_topology_dir: str,
+) -> ZKTopologyIndex:
+    import yaml
+
+    manifest = get_zk_topology_manifest(zk_topology_dir)
+    index: ZKTopologyIndex = {
+        "version": ZK_TOPOLOGY_INDEX_VERSION,
+        "manifest": manifest,
+        "topologies": {},
+        "symlinks": {},
+    }
+
+    for relative_path in sorted(manifest):
+        if not relative_path.endswith(".yaml"):
+            continue
+        cluster_type, filename = relative_path.split("/")
+        cluster_location = filename[: -len(".yaml")]
+        path = os.path.join(zk_topology_dir, relative_path)
+
+        try:
+            with open(path) as fp:
+                zk_topology = yaml.load(fp, Loader=get_yaml_loader())
+            hosts = ["%s:%d" % (entry[0], entry[1]) for entry in zk_topology]
+        except Exception as e:
+            print(f"Skipping {path}: {e}", file=sys.stderr)
+            continue
+
+        index["topologies"].setdefault(cluster_type, {})[cluster_location] = hosts
+        if os.path.islink(path):
+            index["symlinks"].setdefault(cluster_type, []).append(cluster_location)
+
+    return index
+
+
+def write_zk_topology_index(
+    index: ZKTopologyIndex,
+    index_path: str,
+) -> None:
+    # Swap the new index into place atomically so readers never see a
+    # partially written file
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(index, fp, sort_keys=True, separators=(",", ":"))
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, index_path)
+
+
+# The index last read from each index file, keyed by its path, along with the
+# file's (mtime, size, inode) when it was, so that it is only parsed again once
+# it's been rewritten.
+_zk_topology_indexes: Dict[str, Tuple[Tuple[int, int, int], ZKTopologyIndex]] = {}
+
+# How often the index for a topology directory is checked against the YAML
+# files, and the time (by time.monotonic) it last was, with the outcome
+ZK_TOPOLOGY_INDEX_CHECK_INTERVAL_S = 60.0
+_checked_zk_topology_indexes: Dict[str, Tuple[float, Optional[ZKTopologyIndex]]] = {}
+
+
+def _read_zk_topology_index(
+    index_path: str,
+) -> ZKTopologyIndex:
+    st = os.stat(index_path)
+    stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    cached = _zk_topology_indexes.get(index_path)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1]
+
+    with open(index_path) as fp:
+        index: ZKTopologyIndex = json.load(fp)
+    _zk_topology_indexes[index_path] = (stat_key, index)
+    return index
+
+
+def _check_zk_topology_index(
+    zk_topology_dir: str,
+) -> Optional[ZKTopologyIndex]:
+    try:
+        index = _read_zk_topology_index(get_zk_topology_index_path(zk_topology_dir))
+        if index["version"] != ZK_TOPOLOGY_INDEX_VERSION:
+            return None
+        if index["manifest"] != get_zk_topology_manifest(zk_topology_dir):
+            return None
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return index
+
+
+def load_zk_topology_index(
+    zk_topology_dir: str,
+) -> Optional[ZKTopologyIndex]:
+    """Load the compiled index for zk_topology_dir.
+
+    Returns None if there is no index, or if it is unreadable, from another
+    version of nerve-tools, or stale with respect to the YAML files.  That's
+    only checked every ZK_TOPOLOGY_INDEX_CHECK_INTERVAL_S, so that lookups are
+    cheap, while long-running callers (like clean_nerve --daemon) still
+    notice changes to the topology.
+    """
+    now = time.monotonic()
+    checked = _checked_zk_topology_indexes.get(zk_topology_dir)
+    if checked is not None and now - checked[0] < ZK_TOPOLOGY_INDEX_CHECK_INTERVAL_S:
+        return checked[1]
+
+    index = _check_zk_topology_index(zk_topology_dir)
+    _checked_zk_topology_indexes[zk_topology_dir] = (now, index)
+    return index
+
+
+def get_indexed_zk_topology(
+    index: ZKTopologyIndex,
+    cluster_type: str,
+    cluster_location: str,
+) -> List[str]:
+    """Look up a topology in the index.  Raises KeyError if the topology file
+    does not exist, just as opening it would raise an OSError."""
+    return index["topologies"][cluster_type][cluster_location]
+
+
+def parse_args(
+    args: Sequence[str],
+) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compile the zookeeper_discovery tree into a single index file")
+    parser.add_argument(
+        "--zk-topology-dir",
+        type=str,
+        default=DEFAULT_ZK_TOPOLOGY_DIR,
+        help="Directory to compile (default: %(default)s).",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="Where to write the index (default: <zk-topology-dir>.index.json, which is where readers look).",
+    )
+    return parser.parse_args(args)
+
+
+def main() -> None:
+    opts = parse_args(sys.argv[1:])
+    index = compile_zk_topology_index(opts.zk_topology_dir)
+    write_zk_topology_index(index, opts.output or get_zk_topology_index_path(opts.zk_topology_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,9 @@ setup(
     install_requires=get_install_requires(),
     entry_points={
         "console_scripts": [
+            "build_nerve_labels_bundle=nerve_tools.labels:main",
             "clean_nerve=nerve_tools.clean_nerve:main",
+            "compile_zk_topology_index=nerve_tools.zk_topology:main",
             "configure_nerve=nerve_tools.configure_nerve:main",
             "updown_service=nerve_tools.updown_service:main",
         ],
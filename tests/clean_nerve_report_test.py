@@ -0,0 +1,102 @@
+import json
+from unittest import mock
+
+from nerve_tools import clean_nerve_report
+
+
+def _result(cluster_location):
+    return {
+        "cluster_location": cluster_location,
+        "connected": True,
+        "removed_count": 2,
+        "removed_counts": {"/smartstack/global": 2, "/envoy/global": 0},
+        "error": None,
+    }
+
+
+def _stats():
+    stats = clean_nerve_report.ScanStats()
+    stats.services_scanned = 3
+    stats.count_node(["no_children"])
+    stats.count_node(["empty_data", "no_ephemeral_owner", "no_children"])
+    stats.read_latency.observe(0.0007)
+    stats.read_latency.observe(0.003)
+    return stats
+
+
+def test_get_candidate_reasons():
+    in_use = mock.Mock(ephemeralOwner=1, numChildren=0)
+    assert clean_nerve_report.get_candidate_reasons(b"{}", in_use) == ["no_children"]
+    orphan = mock.Mock(ephemeralOwner=0, numChildren=0)
+    assert clean_nerve_report.get_candidate_reasons(b"", orphan) == clean_nerve_report.CANDIDATE_REASONS
+
+
+def test_latency_histogram():
+    histogram = clean_nerve_report.LatencyHistogram(buckets=[0.001, 0.01])
+    for seconds in [0.0005, 0.001, 0.005, 0.5]:
+        histogram.observe(seconds)
+
+    assert histogram.get_cumulative_counts() == [("0.001", 2), ("0.01", 3), ("+Inf", 4)]
+    assert histogram.count == 4
+
+
+@mock.patch("nerve_tools.clean_nerve_report.time.monotonic", side_effect=[10.0, 10.25])
+def test_latency_histogram_time(mock_monotonic):
+    histogram = clean_nerve_report.LatencyHistogram()
+    result = mock.Mock()
+
+    histogram.time(result)
+    assert histogram.count == 0
+    result.rawlink.call_args.args[0](result)
+
+    assert histogram.count == 1
+    assert histogram.sum == 0.25
+
+
+def test_format_json_report():
+    report = clean_nerve_report.format_json_report([_result("a")], {"a": _stats()}, simulate=True, timestamp=1.0)
+
+    [entry] = [json.loads(line) for line in report.splitlines()]
+    assert entry["cluster_location"] == "a"
+    assert entry["simulate"]
+    assert entry["nodes_scanned"] == 2
+    assert entry["candidates"] == {"empty_data": 1, "no_ephemeral_owner": 1, "no_children": 2}
+    assert entry["orphans"] == 1
+    assert entry["removed_by_root"] == {"/smartstack/global": 2, "/envoy/global": 0}
+    assert entry["read_latency_s"]["le_0.001"] == 1
+    assert entry["read_latency_s"]["le_+Inf"] == 2
+
+
+def test_format_prometheus_report():
+    report = clean_nerve_report.format_prometheus_report(
+        [_result("b"), _result("a")],
+        {"a": _stats(), "b": _stats()},
+        simulate=False,
+        timestamp=1.0,
+    )
+    lines = report.splitlines()
+
+    assert lines.count("# TYPE clean_nerve_candidates gauge") == 1
+    assert 'clean_nerve_candidates{cluster_location="a",reason="no_children"} 2' in lines
+    assert 'clean_nerve_removed{cluster_location="b",root="/smartstack/global"} 2' in lines
+    assert 'clean_nerve_simulate{cluster_location="a"} 0' in lines
+    assert "# TYPE clean_nerve_zk_read_latency_seconds histogram" in lines
+    assert 'clean_nerve_zk_read_latency_seconds_bucket{cluster_location="a",le="0.001"} 1' in lines
+    assert 'clean_nerve_zk_read_latency_seconds_count{cluster_location="a"} 2' in lines
+    # Clusters are in order within each metric
+    a_index = lines.index('clean_nerve_orphans{cluster_location="a"} 1')
+    assert lines[a_index + 1] == 'clean_nerve_orphans{cluster_location="b"} 1'
+
+
+def test_write_report(tmp_path):
+    report_file = str(tmp_path / "clean_nerve.prom")
+    for _ in range(2):
+        clean_nerve_report.write_report(report_file, "prometheus", [_result("a")], {"a": _stats()}, simulate=False)
+    with open(report_file) as fp:
+        assert fp.read().count("# TYPE clean_nerve_orphans gauge") == 1
+
+    report_file = str(tmp_path / "clean_nerve.json")
+    for _ in range(2):
+        clean_nerve_report.write_report(report_file, "json", [_result("a")], {"a": _stats()}, simulate=False)
+    with open(report_file) as fp:
+        assert len(fp.readlines()) == 2
@@ -1,6 +1,11 @@
+import json
 from unittest import mock
 
+import kazoo.exceptions
+import pytest
+
 from nerve_tools import clean_nerve
+from tests.fake_zk import build_registration_tree
 
 
 def test_parse_args():
@@ -10,6 +15,22 @@ def test_parse_args():
 
     assert not args.simulate
     assert args.cluster_type == "infrastructure"
+    assert args.max_in_flight == clean_nerve.DEFAULT_MAX_IN_FLIGHT
+    assert args.delete_batch_size == clean_nerve.DEFAULT_DELETE_BATCH_SIZE
+    assert args.workers == clean_nerve.DEFAULT_WORKERS
+    assert args.connect_timeout == clean_nerve.DEFAULT_CONNECT_TIMEOUT_S
+    assert args.roots is None
+    assert args.max_reads_per_second is None
+    assert args.max_deletes_per_second is None
+    assert args.checkpoint_file is None
+    assert args.max_services is None
+    assert args.cversion_cache_file is None
+    assert not args.full_scan
+    assert not args.daemon
+    assert args.grace_period_s == clean_nerve.DEFAULT_GRACE_PERIOD_S
+    assert args.partition_path is None
+    assert args.report_file is None
+    assert args.report_format == "json"
 
 
 def test_parse_args_simulate():
@@ -20,6 +41,14 @@ def test_parse_args_simulate():
     assert args.simulate
 
 
+def test_parse_args_roots():
+    mock_argv = ["clean_nerve", "--root", "/a", "--root", "/b"]
+    with mock.patch("sys.argv", mock_argv):
+        args = clean_nerve.parse_args()
+
+    assert args.roots == ["/a", "/b"]
+
+
 def test_parse_args_cluster_type():
     mock_argv = ["clean_nerve", "--cluster-type", "bar"]
     with mock.patch("sys.argv", mock_argv):
@@ -28,16 +57,47 @@ def test_parse_args_cluster_type():
     assert args.cluster_type == "bar"
 
 
+@pytest.mark.parametrize(
+    "option",
+    [
+        ["--checkpoint-file", "checkpoint.json"],
+        ["--max-services", "10"],
+        ["--cversion-cache-file", "cversions.json"],
+        ["--report-file", "report.json"],
+    ],
+)
+def test_parse_args_daemon_rejects_one_off_options(option):
+    with mock.patch("sys.argv", ["clean_nerve", "--daemon"] + option), pytest.raises(SystemExit) as excinfo:
+        clean_nerve.parse_args()
+    assert excinfo.value.code == 2
+
+
+def mock_async(func):
+    """Wrap a synchronous mock ZK call into its *_async equivalent."""
+
+    def call_async(path, watch=None):
+        result = mock.Mock()
+        try:
+            result.get.return_value = func(path)
+        except Exception as e:
+            result.get.side_effect = e
+        return result
+
+    return call_async
+
+
 def create_mock_zk():
     """Create a mock ZK Kazoo client."""
 
     def mock_get_children(path):
         if path == "/smartstack/global":
-            return ["foo", "bar"]
+            return ["foo", "bar", "gone"]
         if path == "/smartstack/global/foo":
             return ["good_service_node", "orphaned_service_node"]
         if path == "/smartstack/global/bar":
             return []
+        if path in ("/smartstack/global/gone", "/envoy/global"):
+            raise kazoo.exceptions.NoNodeError()
         raise ValueError("Unexpected path: %s" % path)
 
     def mock_get(path):
@@ -46,26 +106,452 @@ def create_mock_zk():
             return ("some data", mock.Mock(ephemeralOwner=1, numChildren=0))
         if path == "/smartstack/global/foo/orphaned_service_node":
             # This is an orphaned node that should be removed
-            return ("", mock.Mock(ephemeralOwner=0, numChildren=0))
+            return ("", mock.Mock(ephemeralOwner=0, numChildren=0, version=3))
+        raise ValueError("Unexpected path: %s" % path)
+
+    def mock_exists(path):
+        if path == "/smartstack/global/foo":
+            return mock.Mock(cversion=7)
+        if path == "/smartstack/global/bar":
+            return mock.Mock(cversion=2)
+        if path == "/smartstack/global/gone":
+            return None
         raise ValueError("Unexpected path: %s" % path)
 
     mock_zk = mock.Mock()
     mock_zk.get_children.side_effect = mock_get_children
     mock_zk.get.side_effect = mock_get
+    mock_zk.exists_async.side_effect = mock_async(mock_exists)
+    mock_zk.get_children_async.side_effect = mock_async(mock_get_children)
+    mock_zk.get_async.side_effect = mock_async(mock_get)
+    mock_zk.transaction.return_value.commit.side_effect = lambda: [
+        True for _ in mock_zk.transaction.return_value.delete.call_args_list
+    ]
     return mock_zk
 
 
 def test_clean():
     mock_zk = create_mock_zk()
-    assert clean_nerve.clean(simulate=False, zk=mock_zk) == 1
-    expected_calls = [mock.call("/smartstack/global/foo/orphaned_service_node")]
-    mock_zk.delete.assert_has_calls(expected_calls)
+    assert clean_nerve.clean(simulate=False, zk=mock_zk) == {"/smartstack/global": 1}
+    expected_calls = [mock.call("/smartstack/global/foo/orphaned_service_node", version=3)]
+    assert mock_zk.transaction.return_value.delete.call_args_list == expected_calls
+    mock_zk.transaction.return_value.commit.assert_called_once_with()
+    mock_zk.delete.assert_not_called()
 
 
 def test_clean_simulate():
     mock_zk = create_mock_zk()
-    assert clean_nerve.clean(simulate=True, zk=mock_zk) == 1
-    mock_zk.delete.assert_has_calls([])
+    assert clean_nerve.clean(simulate=True, zk=mock_zk) == {"/smartstack/global": 1}
+    mock_zk.transaction.assert_not_called()
+    mock_zk.delete.assert_not_called()
+
+
+def test_clean_batches_deletes():
+    orphans = [f"orphan_{i}" for i in range(5)]
+    mock_zk = mock.Mock()
+    mock_zk.get_children.return_value = ["foo"]
+    mock_zk.get_children_async.side_effect = mock_async(lambda path: orphans)
+    orphan_stat = mock.Mock(ephemeralOwner=0, numChildren=0, version=0)
+    mock_zk.get_async.side_effect = mock_async(lambda path: (b"", orphan_stat))
+
+    with mock.patch("nerve_tools.clean_nerve.delete_nodes", side_effect=lambda zk, nodes: len(nodes)) as mock_delete:
+        assert clean_nerve.clean(
+            simulate=False,
+            zk=mock_zk,
+            roots=["/smartstack/global"],
+            delete_batch_size=2,
+        ) == {"/smartstack/global": 5}
+
+    assert [call.args[1] for call in mock_delete.call_args_list] == [
+        [("/smartstack/global/foo/orphan_0", 0), ("/smartstack/global/foo/orphan_1", 0)],
+        [("/smartstack/global/foo/orphan_2", 0), ("/smartstack/global/foo/orphan_3", 0)],
+        [("/smartstack/global/foo/orphan_4", 0)],
+    ]
+
+
+def test_clean_every_root():
+    mock_zk = mock.Mock()
+    mock_zk.get_children.side_effect = lambda path: {"/smartstack/global": ["foo"], "/envoy/global": ["bar"]}[path]
+    mock_zk.get_children_async.side_effect = mock_async(lambda path: ["a", "b"])
+    orphan_stat = mock.Mock(ephemeralOwner=0, numChildren=0, version=0)
+    in_use_stat = mock.Mock(ephemeralOwner=1, numChildren=0, version=0)
+    mock_zk.get_async.side_effect = mock_async(
+        lambda path: (b"", orphan_stat)
+        if path.startswith("/envoy/global/") or path.endswith("/a")
+        else (b"{}", in_use_stat)
+    )
+
+    assert clean_nerve.clean(simulate=True, zk=mock_zk) == {"/smartstack/global": 1, "/envoy/global": 2}
+    assert [call.args[0] for call in mock_zk.get_async.call_args_list] == [
+        "/smartstack/global/foo/a",
+        "/smartstack/global/foo/b",
+        "/envoy/global/bar/a",
+        "/envoy/global/bar/b",
+    ]
+
+
+def test_clean_stats():
+    mock_zk = create_mock_zk()
+    stats = clean_nerve.ScanStats()
+
+    clean_nerve.clean(simulate=True, zk=mock_zk, stats=stats)
+
+    assert stats.services_scanned == 3
+    assert stats.nodes_scanned == 2
+    assert stats.candidates == {"empty_data": 1, "no_ephemeral_owner": 1, "no_children": 2}
+    assert stats.orphans == 1
+    # Just the listing of /smartstack/global, the rest are asynchronous
+    assert stats.read_latency.count == 1
+
+
+def test_clean_resumes_from_checkpoint(tmp_path):
+    mock_zk = create_mock_zk()
+    checkpoint = clean_nerve.ScanCheckpoint(str(tmp_path / "checkpoint.json"), "westcoast-prod")
+    checkpoint.set_last_service("/smartstack/global", "bar")
+
+    # Only foo sorts after bar
+    assert clean_nerve.clean(simulate=False, zk=mock_zk, checkpoint=checkpoint, max_services=1) == {
+        "/smartstack/global": 1
+    }
+    assert [call.args[0] for call in mock_zk.get_children_async.call_args_list] == ["/smartstack/global/foo"]
+    assert checkpoint.get_last_service("/smartstack/global") == "foo"
+
+
+def test_clean_in_slices(tmp_path):
+    mock_zk = create_mock_zk()
+    checkpoint = clean_nerve.ScanCheckpoint(str(tmp_path / "checkpoint.json"), "westcoast-prod")
+
+    scanned = []
+    for expected_last_service in ["foo", None]:
+        mock_zk.get_children_async.reset_mock()
+        clean_nerve.clean(simulate=False, zk=mock_zk, checkpoint=checkpoint, max_services=2)
+        scanned.append([call.args[0] for call in mock_zk.get_children_async.call_args_list])
+        assert checkpoint.get_last_service("/smartstack/global") == expected_last_service
+
+    assert scanned == [
+        ["/smartstack/global/bar", "/smartstack/global/foo"],
+        ["/smartstack/global/gone"],
+    ]
+
+
+def test_clean_simulate_leaves_checkpoint(fake_zk, tmp_path):
+    build_registration_tree(fake_zk, "/smartstack/global", services=300, instances=2, orphan_every=2)
+    checkpoint = clean_nerve.ScanCheckpoint(str(tmp_path / "checkpoint.json"), "westcoast-prod")
+
+    clean_nerve.clean(simulate=True, zk=fake_zk, roots=["/smartstack/global"], checkpoint=checkpoint, max_services=150)
+    assert checkpoint.get_last_service("/smartstack/global") is None
+
+    # So the next real run still cleans the services the simulated one scanned
+    clean_nerve.clean(simulate=False, zk=fake_zk, roots=["/smartstack/global"], checkpoint=checkpoint, max_services=150)
+    assert checkpoint.get_last_service("/smartstack/global") == "service_000149.main"
+    assert fake_zk.get_children("/smartstack/global/service_000000.main") == ["instance_000001"]
+
+
+def test_scan_checkpoint_is_per_cluster(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    clean_nerve.ScanCheckpoint(path, "a").set_last_service("/smartstack/global", "foo")
+    clean_nerve.ScanCheckpoint(path, "b").set_last_service("/smartstack/global", "bar")
+
+    assert clean_nerve.ScanCheckpoint(path, "a").get_last_service("/smartstack/global") == "foo"
+    assert clean_nerve.ScanCheckpoint(path, "b").get_last_service("/smartstack/global") == "bar"
+    assert clean_nerve.ScanCheckpoint(path, "c").get_last_service("/smartstack/global") is None
+
+
+def test_clean_skips_unchanged_services(tmp_path):
+    mock_zk = create_mock_zk()
+    cversion_cache = clean_nerve.CversionCache(str(tmp_path / "cversions.json"), "westcoast-prod")
+    cversion_cache.save({"/smartstack/global/removed": 1})
+
+    assert clean_nerve.clean(simulate=True, zk=mock_zk, cversion_cache=cversion_cache) == {"/smartstack/global": 1}
+    # foo had an orphan, so isn't cached, and gone and removed no longer exist
+    assert cversion_cache.load() == {"/smartstack/global/bar": 2}
+
+    mock_zk.get_children_async.reset_mock()
+    assert clean_nerve.clean(simulate=True, zk=mock_zk, cversion_cache=cversion_cache) == {"/smartstack/global": 1}
+    assert [call.args[0] for call in mock_zk.get_children_async.call_args_list] == ["/smartstack/global/foo"]
+
+    mock_zk.get_children_async.reset_mock()
+    clean_nerve.clean(simulate=True, zk=mock_zk, cversion_cache=cversion_cache, full_scan=True)
+    assert [call.args[0] for call in mock_zk.get_children_async.call_args_list] == [
+        "/smartstack/global/bar",
+        "/smartstack/global/foo",
+    ]
+
+
+def test_clean_rate_limits_reads_and_deletes():
+    mock_zk = create_mock_zk()
+    read_limiter = mock.Mock()
+    delete_limiter = mock.Mock()
+
+    clean_nerve.clean(simulate=False, zk=mock_zk, read_limiter=read_limiter, delete_limiter=delete_limiter)
+
+    # Two root listings, three child listings and two node reads
+    assert read_limiter.acquire.call_count == 7
+    delete_limiter.acquire.assert_called_once_with(1)
+
+
+@mock.patch("nerve_tools.clean_nerve.time.sleep")
+@mock.patch("nerve_tools.clean_nerve.time.monotonic")
+def test_token_bucket(mock_monotonic, mock_sleep):
+    mock_monotonic.return_value = 100.0
+    bucket = clean_nerve.TokenBucket(10)
+
+    # A second's worth of burst is allowed
+    for _ in range(10):
+        bucket.acquire()
+    mock_sleep.assert_not_called()
+
+    bucket.acquire(5)
+    mock_sleep.assert_called_once_with(0.5)
+
+    # Paying off the debt refills nothing
+    mock_monotonic.return_value = 100.5
+    mock_sleep.reset_mock()
+    bucket.acquire()
+    mock_sleep.assert_called_once_with(pytest.approx(0.1))
+
+
+def test_delete_nodes():
+    mock_zk = mock.Mock()
+    mock_zk.transaction.return_value.commit.return_value = [True, True]
+
+    assert clean_nerve.delete_nodes(mock_zk, [("/a", 0), ("/b", 1)]) == 2
+
+    assert mock_zk.transaction.return_value.delete.call_args_list == [
+        mock.call("/a", version=0),
+        mock.call("/b", version=1),
+    ]
+    mock_zk.delete.assert_not_called()
+
+
+def test_delete_nodes_falls_back_on_conflict():
+    mock_zk = mock.Mock()
+    mock_zk.transaction.return_value.commit.return_value = [
+        kazoo.exceptions.RolledBackError(),
+        kazoo.exceptions.BadVersionError(),
+        kazoo.exceptions.RolledBackError(),
+        kazoo.exceptions.RolledBackError(),
+    ]
+    mock_zk.delete.side_effect = [
+        None,
+        kazoo.exceptions.BadVersionError(),
+        kazoo.exceptions.NotEmptyError(),
+        kazoo.exceptions.NoNodeError(),
+    ]
+
+    assert clean_nerve.delete_nodes(mock_zk, [("/a", 0), ("/b", 0), ("/c", 0), ("/d", 0)]) == 1
+
+    assert mock_zk.delete.call_args_list == [
+        mock.call("/a", version=0),
+        mock.call("/b", version=0),
+        mock.call("/c", version=0),
+        mock.call("/d", version=0),
+    ]
+
+
+def test_get_instance_nodes_bounds_requests_in_flight():
+    services = [f"service_{i}" for i in range(10)]
+    in_flight = []
+    max_in_flight = []
+
+    def submit(value):
+        result = mock.Mock()
+        in_flight.append(result)
+        max_in_flight.append(len(in_flight))
+
+        def get():
+            in_flight.remove(result)
+            return value
+
+        result.get.side_effect = get
+        return result
+
+    mock_zk = mock.Mock()
+    mock_zk.get_children_async.side_effect = lambda path, watch: submit(["a", "b", "c"])
+    mock_zk.get_async.side_effect = lambda path: submit((b"", mock.Mock(ephemeralOwner=0, numChildren=0)))
+
+    nodes = list(clean_nerve.get_instance_nodes(mock_zk, "/smartstack/global", services, max_in_flight=4))
+
+    assert [path for path, _, _ in nodes] == [
+        f"/smartstack/global/{service}/{instance}" for service in services for instance in ["a", "b", "c"]
+    ]
+    assert in_flight == []
+    # One window each for the child listings and the node reads
+    assert max(max_in_flight) <= 2 * 4
+
+
+def create_watched_mock_zk(tree):
+    """Create a mock ZK Kazoo client serving /smartstack/global from tree,
+    which maps service paths to {instance: (data, stat)}."""
+
+    def get_children(path):
+        if path == "/smartstack/global":
+            return [service_path.rpartition("/")[2] for service_path in tree]
+        if path in tree:
+            return list(tree[path])
+        raise kazoo.exceptions.NoNodeError()
+
+    def get(path):
+        service_path, _, instance = path.rpartition("/")
+        try:
+            return tree[service_path][instance]
+        except KeyError:
+            raise kazoo.exceptions.NoNodeError()
+
+    mock_zk = mock.Mock()
+    mock_zk.get_children.side_effect = lambda path, watch=None: get_children(path)
+    mock_zk.exists.return_value = None
+    mock_zk.get_children_async.side_effect = mock_async(get_children)
+    mock_zk.get_async.side_effect = mock_async(get)
+    mock_zk.transaction.return_value.commit.side_effect = lambda: [
+        True for _ in mock_zk.transaction.return_value.delete.call_args_list
+    ]
+    return mock_zk
+
+
+def _orphan(czxid=10, version=0):
+    return (b"", mock.Mock(ephemeralOwner=0, numChildren=0, czxid=czxid, version=version))
+
+
+def _in_use():
+    return (b"{}", mock.Mock(ephemeralOwner=1, numChildren=0, czxid=1, version=0))
+
+
+@mock.patch("nerve_tools.clean_nerve.time.monotonic", return_value=100.0)
+def test_orphan_watcher_removes_orphans_after_grace_period(mock_monotonic):
+    tree = {
+        "/smartstack/global/foo": {"good": _in_use(), "orphan": _orphan()},
+        "/smartstack/global/bar": {},
+    }
+    mock_zk = create_watched_mock_zk(tree)
+    watcher = clean_nerve.OrphanWatcher(mock_zk, clean_nerve.DEFAULT_ROOTS, simulate=False, grace_period_s=60)
+    watcher.start()
+
+    watcher.run_once(timeout=0)
+    assert sorted(call.args[0] for call in mock_zk.get_children_async.call_args_list) == [
+        "/smartstack/global/bar",
+        "/smartstack/global/foo",
+    ]
+    assert all(call.args[1] == watcher._on_watch_event for call in mock_zk.get_children_async.call_args_list)
+    # Told when the missing Envoy root is created
+    mock_zk.exists.assert_called_once_with("/envoy/global", watch=watcher._on_watch_event)
+    mock_zk.transaction.assert_not_called()
+
+    mock_monotonic.return_value = 160.0
+    watcher.run_once(timeout=0)
+    assert mock_zk.transaction.return_value.delete.call_args_list == [
+        mock.call("/smartstack/global/foo/orphan", version=0)
+    ]
+    assert watcher.removed_count == 1
+
+
+@mock.patch("nerve_tools.clean_nerve.time.monotonic", return_value=100.0)
+def test_orphan_watcher_only_inspects_changed_services(mock_monotonic):
+    tree = {
+        "/smartstack/global/foo": {"good": _in_use()},
+        "/smartstack/global/bar": {"good": _in_use()},
+    }
+    mock_zk = create_watched_mock_zk(tree)
+    watcher = clean_nerve.OrphanWatcher(mock_zk, ["/smartstack/global"], simulate=True, grace_period_s=60)
+    watcher.start()
+    watcher.run_once(timeout=0)
+
+    mock_zk.get_children_async.reset_mock()
+    tree["/smartstack/global/bar"]["orphan"] = _orphan()
+    watcher._on_watch_event(mock.Mock(path="/smartstack/global/bar"))
+    watcher.run_once(timeout=0)
+
+    assert [call.args[0] for call in mock_zk.get_children_async.call_args_list] == ["/smartstack/global/bar"]
+    mock_monotonic.return_value = 160.0
+    watcher.run_once(timeout=0)
+    assert watcher.removed_count == 1
+
+
+@mock.patch("nerve_tools.clean_nerve.time.monotonic", return_value=100.0)
+def test_orphan_watcher_confirms_candidates(mock_monotonic):
+    tree = {"/smartstack/global/foo": {"filled": _orphan(), "recreated": _orphan()}}
+    mock_zk = create_watched_mock_zk(tree)
+    watcher = clean_nerve.OrphanWatcher(mock_zk, ["/smartstack/global"], simulate=False, grace_period_s=60)
+    watcher.start()
+    watcher.run_once(timeout=0)
+
+    # Neither is the orphan that was found when the grace period is up
+    tree["/smartstack/global/foo"]["filled"] = _in_use()
+    tree["/smartstack/global/foo"]["recreated"] = _orphan(czxid=20)
+    mock_monotonic.return_value = 160.0
+    watcher.run_once(timeout=0)
+
+    mock_zk.transaction.assert_not_called()
+    assert watcher.removed_count == 0
+
+
+def test_partition_shares_services():
+    partitions = [clean_nerve.Partition(mock.Mock(), "/clean_nerve") for _ in range(3)]
+    members = [partition.member for partition in partitions]
+    for partition in partitions:
+        partition._on_members_changed(members)
+    services = [f"/smartstack/global/service_{i}" for i in range(300)]
+
+    owners = {service: [p for p in partitions if p.owns(service)] for service in services}
+    assert all(len(owner) == 1 for owner in owners.values())
+    # Roughly evenly
+    assert all(sum(owner == [p] for owner in owners.values()) > 50 for p in partitions)
+
+    # Only the services of a member which leaves move
+    for partition in partitions[:2]:
+        partition._on_members_changed(members[:2])
+    for service, [owner] in owners.items():
+        if owner is not partitions[2]:
+            assert owner.owns(service)
+    assert all(sum(p.owns(service) for p in partitions[:2]) == 1 for service in services)
+
+
+def test_partition_owns_nothing_until_joined():
+    partition = clean_nerve.Partition(mock.Mock(), "/clean_nerve")
+    partition._on_members_changed(["someone-else"])
+    assert not partition.owns("/smartstack/global/foo")
+
+
+def test_clean_partitioned():
+    mock_zk = create_mock_zk()
+    partition = mock.Mock()
+    partition.owns.side_effect = lambda path: path != "/smartstack/global/foo"
+
+    assert clean_nerve.clean(simulate=True, zk=mock_zk, partition=partition) == {"/smartstack/global": 0}
+    assert [call.args[0] for call in mock_zk.get_children_async.call_args_list] == [
+        "/smartstack/global/bar",
+        "/smartstack/global/gone",
+    ]
+
+
+@mock.patch("nerve_tools.clean_nerve.time.monotonic", return_value=100.0)
+def test_orphan_watcher_rebalances(mock_monotonic):
+    tree = {
+        "/smartstack/global/foo": {"orphan": _orphan()},
+        "/smartstack/global/bar": {"orphan": _orphan()},
+    }
+    mock_zk = create_watched_mock_zk(tree)
+    owned = {"/smartstack/global/foo"}
+    partition = mock.Mock()
+    partition.owns.side_effect = lambda path: path in owned
+    watcher = clean_nerve.OrphanWatcher(
+        mock_zk, ["/smartstack/global"], simulate=True, grace_period_s=60, partition=partition
+    )
+    watcher.start()
+    watcher.run_once(timeout=0)
+    assert [call.args[0] for call in mock_zk.get_children_async.call_args_list] == ["/smartstack/global/foo"]
+
+    # foo moves to another member, and bar to this one
+    mock_zk.get_children_async.reset_mock()
+    owned = {"/smartstack/global/bar"}
+    partition.add_listener.call_args.args[0]()
+    watcher.run_once(timeout=0)
+    assert [call.args[0] for call in mock_zk.get_children_async.call_args_list] == ["/smartstack/global/bar"]
+
+    mock_monotonic.return_value = 160.0
+    watcher.run_once(timeout=0)
+    # Only bar's orphan, since foo's was dropped with foo
+    assert watcher.removed_count == 1
 
 
 @mock.patch("nerve_tools.clean_nerve.glob.glob")
@@ -82,3 +568,197 @@ def test_get_zk_cluster_locations(mock_islink, mock_glob):
     result = clean_nerve.get_zk_cluster_locations("ty")
     assert list(result) == ["foo"]
     mock_glob.assert_has_calls([mock.call("/nail/etc/zookeeper_discovery/ty/*.yaml")])
+
+
+@mock.patch("nerve_tools.clean_nerve.get_zk_topology", return_value=["zk1:2181", "zk2:2181"])
+@mock.patch("kazoo.client.KazooClient")
+def test_clean_cluster(mock_kazoo_client, mock_get_zk_topology):
+    mock_kazoo_client.return_value = create_mock_zk()
+
+    result = clean_nerve.clean_cluster("infrastructure", "westcoast-prod", False, 5.0, 16, 50)
+
+    assert result == {
+        "cluster_location": "westcoast-prod",
+        "connected": True,
+        "removed_count": 1,
+        "removed_counts": {"/smartstack/global": 1},
+        "error": None,
+    }
+    mock_kazoo_client.assert_called_once_with(hosts="zk1:2181,zk2:2181")
+    mock_kazoo_client.return_value.start.assert_called_once_with(timeout=5.0)
+    mock_kazoo_client.return_value.stop.assert_called_once_with()
+
+
+@mock.patch("nerve_tools.clean_nerve.get_zk_topology", return_value=["zk1:2181"])
+@mock.patch("kazoo.client.KazooClient")
+def test_clean_cluster_connect_failure(mock_kazoo_client, mock_get_zk_topology):
+    mock_kazoo_client.return_value.start.side_effect = Exception("timed out")
+
+    result = clean_nerve.clean_cluster("infrastructure", "westcoast-prod", False, 5.0, 16, 50)
+
+    assert not result["connected"]
+    assert result["removed_count"] == 0
+    assert "timed out" in result["error"]
+
+
+@mock.patch("nerve_tools.clean_nerve.get_zk_topology", return_value=["zk1:2181"])
+@mock.patch("kazoo.client.KazooClient")
+def test_clean_cluster_scan_failure(mock_kazoo_client, mock_get_zk_topology):
+    mock_kazoo_client.return_value.get_children.side_effect = kazoo.exceptions.ConnectionLoss()
+
+    result = clean_nerve.clean_cluster("infrastructure", "westcoast-prod", False, 5.0, 16, 50)
+
+    assert result["connected"]
+    assert "ConnectionLoss" in result["error"]
+    mock_kazoo_client.return_value.stop.assert_called_once_with()
+
+
+def _cluster_result(cluster_location, connected=True, removed_count=0, error=None):
+    return {
+        "cluster_location": cluster_location,
+        "connected": connected,
+        "removed_count": removed_count,
+        "removed_counts": {"/smartstack/global": removed_count},
+        "error": error,
+    }
+
+
+@mock.patch("nerve_tools.clean_nerve.get_zk_cluster_locations", return_value=["a", "b", "c"])
+@mock.patch("nerve_tools.clean_nerve.clean_cluster")
+def test_main_cleans_every_cluster(mock_clean_cluster, mock_get_locations):
+    mock_clean_cluster.side_effect = lambda cluster_type, cluster_location, **kwargs: _cluster_result(
+        cluster_location,
+        connected=cluster_location != "b",
+        removed_count=2,
+        error="Could not connect" if cluster_location == "b" else None,
+    )
+    with mock.patch("sys.argv", ["clean_nerve", "--workers", "2", "--connect-timeout", "3"]):
+        clean_nerve.main()
+
+    assert sorted(call.kwargs["cluster_location"] for call in mock_clean_cluster.call_args_list) == ["a", "b", "c"]
+    assert all(call.kwargs["connect_timeout"] == 3 for call in mock_clean_cluster.call_args_list)
+
+
+@mock.patch("nerve_tools.clean_nerve.get_zk_cluster_locations", return_value=["a", "b"])
+@mock.patch("nerve_tools.clean_nerve.clean_cluster")
+def test_main_writes_report(mock_clean_cluster, mock_get_locations, tmp_path):
+    def clean_cluster(cluster_type, cluster_location, stats, **kwargs):
+        stats.nodes_scanned = 10
+        return _cluster_result(cluster_location, removed_count=1)
+
+    mock_clean_cluster.side_effect = clean_cluster
+    report_file = tmp_path / "report.json"
+    with mock.patch("sys.argv", ["clean_nerve", "--simulate", "--report-file", str(report_file)]):
+        clean_nerve.main()
+
+    entries = [json.loads(line) for line in report_file.read_text().splitlines()]
+    assert [(e["cluster_location"], e["simulate"], e["nodes_scanned"], e["removed"]) for e in entries] == [
+        ("a", True, 10, 1),
+        ("b", True, 10, 1),
+    ]
+
+
+@mock.patch("nerve_tools.clean_nerve.get_zk_cluster_locations", return_value=["a", "b"])
+@mock.patch("nerve_tools.clean_nerve.clean_cluster")
+def test_main_fails_if_a_cluster_scan_fails(mock_clean_cluster, mock_get_locations):
+    mock_clean_cluster.side_effect = lambda cluster_type, cluster_location, **kwargs: _cluster_result(
+        cluster_location,
+        error="ConnectionLoss()" if cluster_location == "b" else None,
+    )
+    with mock.patch("sys.argv", ["clean_nerve"]), pytest.raises(SystemExit) as excinfo:
+        clean_nerve.main()
+    assert excinfo.value.code == 1
+
+
+def test_clean_fake_zookeeper(fake_zk):
+    orphans = build_registration_tree(fake_zk, "/smartstack/global", services=5, instances=40, orphan_every=7)
+    orphans += build_registration_tree(fake_zk, "/envoy/global", services=2, instances=10, orphan_every=3)
+    stats = clean_nerve.ScanStats()
+
+    removed_counts = clean_nerve.clean(simulate=False, zk=fake_zk, delete_batch_size=8, stats=stats)
+
+    assert sum(removed_counts.values()) == orphans
+    assert stats.nodes_scanned == 5 * 40 + 2 * 10
+    assert stats.orphans == orphans
+    assert stats.deletes_failed == 0
+    remaining = [
+        fake_zk.get(f"/smartstack/global/service_{s:06}.main/{instance}")
+        for s in range(5)
+        for instance in fake_zk.get_children(f"/smartstack/global/service_{s:06}.main")
+    ]
+    assert len(remaining) == 5 * 40 - removed_counts["/smartstack/global"]
+    assert not any(clean_nerve.is_orphan(data, stat) for data, stat in remaining)
+
+    assert clean_nerve.clean(simulate=False, zk=fake_zk) == {"/smartstack/global": 0, "/envoy/global": 0}
+
+
+def test_delete_nodes_fake_zookeeper(fake_zk):
+    for name in ["a", "b", "c"]:
+        fake_zk.create(f"/smartstack/global/foo/{name}", makepath=True)
+    # b is written to after it was scanned
+    fake_zk.set("/smartstack/global/foo/b", b"{}")
+
+    nodes = [(f"/smartstack/global/foo/{name}", 0) for name in ["a", "b", "c"]]
+    assert clean_nerve.delete_nodes(fake_zk, nodes) == 2
+
+    assert fake_zk.get_children("/smartstack/global/foo") == ["b"]
+
+
+def test_clean_cversion_cache_fake_zookeeper(fake_zk, tmp_path):
+    build_registration_tree(fake_zk, "/smartstack/global", services=10, instances=20, orphan_every=50)
+    cversion_cache = clean_nerve.CversionCache(str(tmp_path / "cversions.json"), "westcoast-prod")
+
+    # The first scan removes the orphans, which changes those services
+    # children, so they are scanned again the second time
+    for _ in range(3):
+        fake_zk.ops.clear()
+        clean_nerve.clean(simulate=False, zk=fake_zk, roots=["/smartstack/global"], cversion_cache=cversion_cache)
+
+    assert fake_zk.ops["exists"] == 10
+    assert fake_zk.ops["get"] == 0
+
+    fake_zk.create("/smartstack/global/service_000003.main/new_orphan")
+    fake_zk.ops.clear()
+    clean_nerve.clean(simulate=False, zk=fake_zk, roots=["/smartstack/global"], cversion_cache=cversion_cache)
+    assert fake_zk.ops["get"] == 21
+    assert "new_orphan" not in fake_zk.get_children("/smartstack/global/service_000003.main")
+
+
+def test_clean_saves_cversion_cache_once_per_root(fake_zk, tmp_path):
+    build_registration_tree(fake_zk, "/smartstack/global", services=250, instances=2, orphan_every=1000)
+    build_registration_tree(fake_zk, "/envoy/global", services=250, instances=2, orphan_every=1000)
+    cversion_cache = clean_nerve.CversionCache(str(tmp_path / "cversions.json"), "westcoast-prod")
+    checkpoint = clean_nerve.ScanCheckpoint(str(tmp_path / "checkpoint.json"), "westcoast-prod")
+
+    with mock.patch.object(cversion_cache, "save", wraps=cversion_cache.save) as mock_save:
+        clean_nerve.clean(simulate=False, zk=fake_zk, cversion_cache=cversion_cache, checkpoint=checkpoint)
+
+    # Not after each of the three chunks of each root
+    assert mock_save.call_count == 2
+    # Every service but the first of each root, which had an orphan
+    assert len(cversion_cache.load()) == 498
+
+
+@mock.patch("nerve_tools.clean_nerve.time.monotonic", return_value=100.0)
+def test_orphan_watcher_fake_zookeeper(mock_monotonic, fake_zk):
+    build_registration_tree(fake_zk, "/smartstack/global", services=10, instances=20, orphan_every=1000)
+    watcher = clean_nerve.OrphanWatcher(fake_zk, clean_nerve.DEFAULT_ROOTS, simulate=False, grace_period_s=60)
+    watcher.start()
+    watcher.run_once(timeout=0)
+    assert fake_zk.ops["get"] == 200
+
+    # Only the service which changed is read again
+    fake_zk.ops.clear()
+    fake_zk.create("/smartstack/global/service_000004.main/new_orphan")
+    watcher.run_once(timeout=0)
+    assert fake_zk.ops["get_children"] == 1
+    assert fake_zk.ops["get"] == 21
+
+    # And the Envoy root is picked up once it exists
+    fake_zk.create("/envoy/global/bar/orphan", makepath=True)
+    watcher.run_once(timeout=0)
+
+    mock_monotonic.return_value = 160.0
+    watcher.run_once(timeout=0)
+    assert watcher.removed_count == 3
+    assert fake_zk.get_children("/envoy/global/bar") == []
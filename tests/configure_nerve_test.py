@@ -13,6 +13,7 @@ from unittest.mock import patch
 import pytest
 from nerve_tools.configure_nerve import generate_configuration
 from nerve_tools.configure_nerve import generate_subconfiguration
+from nerve_tools.envoy import LazyEnvoyIngressListeners
 
 from nerve_tools import configure_nerve
 
@@ -218,11 +219,11 @@ def expected_sub_config_with_envoy_ingress_listeners(expected_sub_config):
 def test_generate_subconfiguration(expected_sub_config):
     with (
         patch(
-            "nerve_tools.configure_nerve.get_current_location",
+            "environment_tools.type_utils.get_current_location",
             side_effect=get_current_location,
         ),
         patch(
-            "nerve_tools.configure_nerve.convert_location_type",
+            "environment_tools.type_utils.convert_location_type",
             side_effect=convert_location_type,
         ),
         patch(
@@ -273,11 +274,11 @@ def test_generate_subconfiguration(expected_sub_config):
 def test_generate_subconfiguration_k8s(expected_sub_config):
     with (
         patch(
-            "nerve_tools.configure_nerve.get_current_location",
+            "environment_tools.type_utils.get_current_location",
             side_effect=get_current_location,
         ),
         patch(
-            "nerve_tools.configure_nerve.convert_location_type",
+            "environment_tools.type_utils.convert_location_type",
             side_effect=convert_location_type,
         ),
         patch(
@@ -340,11 +341,11 @@ def test_generate_subconfiguration_with_envoy_ingress_listeners(
 ):
     with (
         patch(
-            "nerve_tools.configure_nerve.get_current_location",
+            "environment_tools.type_utils.get_current_location",
             side_effect=get_current_location,
         ),
         patch(
-            "nerve_tools.configure_nerve.convert_location_type",
+            "environment_tools.type_utils.convert_location_type",
             side_effect=convert_location_type,
         ),
         patch(
@@ -461,6 +462,7 @@ def test_generate_configuration_paasta_service():
             zk_cluster_type="fake_cluster_type",
             labels_dir="/dev/null",
             envoy_service_info=None,
+            envoy_ingress_listeners={},
         )
 
     assert expected_config == actual_config
@@ -507,25 +509,6 @@ def test_generate_configuration_paasta_service_with_envoy_ingress_listeners():
             ("test_service.alt", "10.45.13.8", 1234): 35001,
         }
 
-        mock_envoy_service_main_info = copy.deepcopy(mock_service_info)
-        mock_envoy_service_main_info.update(
-            {
-                "host": "ip_address",
-                "port": 35001,
-                "healthcheck_port": 35001,
-                "extra_healthcheck_headers": {"Host": "test_service.main"},
-            }
-        )
-        mock_envoy_service_alt_info = copy.deepcopy(mock_service_info)
-        mock_envoy_service_alt_info.update(
-            {
-                "host": "ip_address",
-                "port": 35001,
-                "healthcheck_port": 35001,
-                "extra_healthcheck_headers": {"Host": "test_service.alt"},
-            }
-        )
-
         actual_config = generate_configuration(
             services=[
                 (
@@ -558,7 +541,8 @@ def test_generate_configuration_paasta_service_with_envoy_ingress_listeners():
                     zk_location_type="fake_zk_location_type",
                     zk_cluster_type="fake_cluster_type",
                     labels_dir="/dev/null",
-                    envoy_service_info=mock_envoy_service_main_info,
+                    envoy_service_info=None,
+                    envoy_ingress_listeners=envoy_ingress_listeners,
                 ),
                 call(
                     service_name="test_service.alt",
@@ -570,7 +554,8 @@ def test_generate_configuration_paasta_service_with_envoy_ingress_listeners():
                     zk_location_type="fake_zk_location_type",
                     zk_cluster_type="fake_cluster_type",
                     labels_dir="/dev/null",
-                    envoy_service_info=mock_envoy_service_alt_info,
+                    envoy_service_info=None,
+                    envoy_ingress_listeners=envoy_ingress_listeners,
                 ),
             ]
         )
@@ -578,6 +563,126 @@ def test_generate_configuration_paasta_service_with_envoy_ingress_listeners():
     assert expected_config == actual_config
 
 
+def test_generate_subconfiguration_looks_up_envoy_ingress_listeners(
+    expected_sub_config_with_envoy_ingress_listeners,
+):
+    with (
+        patch(
+            "environment_tools.type_utils.get_current_location",
+            side_effect=get_current_location,
+        ),
+        patch(
+            "environment_tools.type_utils.convert_location_type",
+            side_effect=convert_location_type,
+        ),
+        patch(
+            "nerve_tools.configure_nerve.get_named_zookeeper_topology",
+            side_effect=get_named_zookeeper_topology,
+        ),
+        patch(
+            "environment_tools.type_utils.available_location_types",
+            return_value=LOCATION_TYPES,
+        ),
+        patch(
+            "nerve_tools.configure_nerve.get_labels_by_service_and_port",
+            side_effect=get_labels_by_service_and_port,
+        ),
+        patch(
+            "nerve_tools.envoy.get_host_ip",
+            return_value="10.0.0.1",
+        ),
+        patch(
+            "nerve_tools.envoy.get_envoy_ingress_listeners",
+            return_value={("test_service", "10.4.5.6", 1234): 35000},
+        ) as mock_get_listeners,
+    ):
+        mock_service_info = {
+            "port": 1234,
+            "routes": [("remote_location", "local_location")],
+            "healthcheck_timeout_s": 2.0,
+            "healthcheck_mode": "http",
+            "healthcheck_port": 1234,
+            "advertise": ["region", "superregion"],
+            "extra_advertise": [
+                ("habitat:my_habitat", "region:another_region"),
+                ("habitat:your_habitat", "region:another_region"),  # Ignored
+            ],
+            "deploy_group": "prod.canary",
+            "paasta_instance": "canary",
+            "service_ip": "10.4.5.6",
+        }
+
+        actual_config = generate_subconfiguration(
+            service_name="test_service",
+            service_info=mock_service_info,
+            host_ip="10.0.0.1",
+            hacheck_port=6666,
+            weight=mock.sentinel.weight,
+            zk_topology_dir="/fake/path",
+            zk_location_type="superregion",
+            zk_cluster_type="infrastructure",
+            labels_dir="/dev/null",
+            envoy_service_info=None,
+            envoy_ingress_listeners=LazyEnvoyIngressListeners(9901),
+        )
+
+    assert expected_sub_config_with_envoy_ingress_listeners == actual_config
+    mock_get_listeners.assert_called_once_with(9901)
+
+
+@pytest.mark.parametrize(
+    "service_info",
+    [
+        {"port": 1234, "advertise": []},
+        {"port": None},
+        # Advertised, but to nowhere with a ZooKeeper cluster
+        {"port": 1234, "advertise": ["region"], "extra_advertise": []},
+    ],
+)
+def test_generate_subconfiguration_does_not_fetch_envoy_listeners_when_unused(service_info):
+    with (
+        patch(
+            "environment_tools.type_utils.get_current_location",
+            side_effect=get_current_location,
+        ),
+        patch(
+            "environment_tools.type_utils.convert_location_type",
+            side_effect=convert_location_type,
+        ),
+        patch(
+            "nerve_tools.configure_nerve.get_named_zookeeper_topology",
+            side_effect=KeyError,
+        ),
+        patch(
+            "environment_tools.type_utils.available_location_types",
+            return_value=LOCATION_TYPES,
+        ),
+        patch(
+            "nerve_tools.configure_nerve.get_labels_by_service_and_port",
+            return_value={},
+        ),
+        patch("nerve_tools.envoy.get_envoy_ingress_listeners") as mock_get_listeners,
+    ):
+        assert (
+            generate_subconfiguration(
+                service_name="test_service",
+                service_info=service_info,
+                host_ip="10.0.0.1",
+                hacheck_port=6666,
+                weight=10,
+                zk_topology_dir="/fake/path",
+                zk_location_type="superregion",
+                zk_cluster_type="infrastructure",
+                labels_dir="/dev/null",
+                envoy_service_info=None,
+                envoy_ingress_listeners=LazyEnvoyIngressListeners(9901),
+            )
+            == {}
+        )
+
+    mock_get_listeners.assert_not_called()
+
+
 def test_generate_configuration_healthcheck_port():
     expected_config = {
         "instance_id": "my_host",
@@ -633,6 +738,7 @@ def test_generate_configuration_healthcheck_port():
             zk_cluster_type="fake_cluster_type",
             labels_dir="/dev/null",
             envoy_service_info=None,
+            envoy_ingress_listeners={},
         )
 
     assert expected_config == actual_config
@@ -694,6 +800,7 @@ def test_generate_configuration_healthcheck_mode():
             zk_cluster_type="fake_cluster_type",
             labels_dir="/dev/null",
             envoy_service_info=None,
+            envoy_ingress_listeners={},
         )
 
     assert expected_config == actual_config
@@ -722,6 +829,77 @@ def test_generate_configuration_empty():
         }
 
 
+def _registrations(*intervals):
+    return {
+        f"service_{i}.my_superregion:10.0.0.1.{1000 + i}.v2.new": {
+            "check_interval": interval,
+            "checks": [{"type": "http"}],
+        }
+        for i, interval in enumerate(intervals)
+    }
+
+
+def test_get_healthcheck_qps():
+    assert configure_nerve.get_healthcheck_qps({}) == 0
+    assert configure_nerve.get_healthcheck_qps(_registrations(2.0, 4.0, 4.0)) == 1.0
+
+
+def test_apply_healthcheck_budget_within_budget():
+    services = _registrations(2.0, 4.0, 4.0)
+    configure_nerve.apply_healthcheck_budget(services, hacheck_qps_budget=10, check_interval_jitter=0.0)
+    assert [s["check_interval"] for s in services.values()] == [2.0, 4.0, 4.0]
+
+
+def test_apply_healthcheck_budget_stretches_intervals():
+    services = _registrations(2.0, 4.0, 4.0)
+    configure_nerve.apply_healthcheck_budget(services, hacheck_qps_budget=0.5, check_interval_jitter=0.0)
+    assert [s["check_interval"] for s in services.values()] == [4.0, 8.0, 8.0]
+    assert configure_nerve.get_healthcheck_qps(services) == 0.5
+
+
+def test_apply_healthcheck_budget_jitter():
+    services = _registrations(*(10 * [3.0]))
+    configure_nerve.apply_healthcheck_budget(services, hacheck_qps_budget=None, check_interval_jitter=0.5)
+    intervals = [s["check_interval"] for s in services.values()]
+    assert all(3.0 <= interval < 4.5 for interval in intervals)
+    assert len(set(intervals)) > 1
+
+    # The same registrations always get the same intervals
+    again = _registrations(*(10 * [3.0]))
+    configure_nerve.apply_healthcheck_budget(again, hacheck_qps_budget=None, check_interval_jitter=0.5)
+    assert [s["check_interval"] for s in again.values()] == intervals
+
+
+def test_apply_healthcheck_budget_jitter_never_exceeds_budget():
+    services = _registrations(*(10 * [1.0]))
+    configure_nerve.apply_healthcheck_budget(services, hacheck_qps_budget=5, check_interval_jitter=0.2)
+    assert configure_nerve.get_healthcheck_qps(services) <= 5
+
+
+def test_generate_configuration_hacheck_qps_budget():
+    with (
+        patch("nerve_tools.configure_nerve.get_host_ip", return_value="ip_address"),
+        patch("nerve_tools.configure_nerve.get_hostname", return_value="my_host"),
+        patch(
+            "nerve_tools.configure_nerve.generate_subconfiguration",
+            return_value=_registrations(1.0, 1.0),
+        ),
+    ):
+        configuration = configure_nerve.generate_configuration(
+            services=[("test_service", {"port": 1234})],
+            heartbeat_path="",
+            hacheck_port=6666,
+            zk_topology_dir="/fake/path",
+            zk_location_type="fake_zk_location_type",
+            zk_cluster_type="fake_cluster_type",
+            labels_dir="/dev/null",
+            envoy_ingress_listeners={},
+            hacheck_qps_budget=1.0,
+        )
+
+    assert [s["check_interval"] for s in configuration["services"].values()] == [2.0, 2.0]
+
+
 @contextmanager
 def setup_mocks_for_main():
     mock_sys = MagicMock()
@@ -813,6 +991,30 @@ def test_nerve_restarted_when_config_files_differ():
         mock_sleep.assert_called_with(30)
 
 
+def test_main_reports_hacheck_qps(caplog):
+    caplog.set_level("INFO")
+    with setup_mocks_for_main() as (
+        mock_sys,
+        mock_file_cmp,
+        mock_move,
+        mock_subprocess_call,
+        mock_subprocess_check_call,
+        mock_sleep,
+        mock_file_not_modified,
+    ):
+        mock_file_cmp.return_value = True
+        configure_nerve.generate_configuration.return_value = {
+            "services": _registrations(2.0, 4.0, 4.0),
+        }
+
+        configure_nerve.main()
+        assert "hacheck requests per second" not in caplog.text
+
+        sys.argv.append("--report-hacheck-qps")
+        configure_nerve.main()
+        assert "Generated config implies 1.00 hacheck requests per second" in caplog.text
+
+
 def test_nerve_not_restarted_when_configs_files_are_identical():
     with setup_mocks_for_main() as (
         mock_sys,
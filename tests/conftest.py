@@ -0,0 +1,8 @@
+import pytest
+
+from tests.fake_zk import FakeZooKeeper
+
+
+@pytest.fixture
+def fake_zk() -> FakeZooKeeper:
+    return FakeZooKeeper()
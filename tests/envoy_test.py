@@ -1,6 +1,15 @@
+import http.server
+import json
+import threading
 from unittest.mock import patch
 
+import pytest
+
+from nerve_tools.envoy import EnvoyAdminClient
+from nerve_tools.envoy import LazyEnvoyIngressListeners
+from nerve_tools.envoy import find_envoy_cluster_status
 from nerve_tools.envoy import get_envoy_ingress_listeners
+from nerve_tools.envoy import is_envoy_host_routable
 
 
 def test_get_envoy_ingress_listeners_success():
@@ -29,14 +38,132 @@ def test_get_envoy_ingress_listeners_success():
 
 def test_get_envoy_ingress_listeners_failure():
     with patch(
-        "nerve_tools.envoy.requests.get",
+        "requests.get",
         side_effect=Exception,
     ):
         assert get_envoy_ingress_listeners(123) == {}
 
 
 def test_get_envoy_ingress_listeners_no_query_when_envoy_disabled():
-    with patch("nerve_tools.envoy.requests.get") as mock_requests:
+    with patch("requests.get") as mock_requests:
         admin_port = None
         get_envoy_ingress_listeners(admin_port)
     mock_requests.assert_not_called()
+
+
+def test_lazy_envoy_ingress_listeners():
+    listeners = {("test_service.main", "10.45.13.4", 1234): 54321}
+    with patch(
+        "nerve_tools.envoy.get_envoy_ingress_listeners",
+        return_value=listeners,
+    ) as mock_get_listeners:
+        lazy_listeners = LazyEnvoyIngressListeners(123)
+        mock_get_listeners.assert_not_called()
+
+        assert ("test_service.main", "10.45.13.4", 1234) in lazy_listeners
+        assert ("test_service.alt", "10.45.13.4", 1234) not in lazy_listeners
+        assert lazy_listeners[("test_service.main", "10.45.13.4", 1234)] == 54321
+        assert dict(lazy_listeners) == listeners
+
+    mock_get_listeners.assert_called_once_with(123)
+
+
+def _host_status(address, **health_status):
+    return {
+        "address": {"socket_address": {"address": address, "port_value": 31337}},
+        "health_status": health_status,
+    }
+
+
+CLUSTERS = {
+    "cluster_statuses": [
+        {"name": "other.main", "host_statuses": [_host_status("10.0.0.9")]},
+        {
+            "name": "service.main",
+            "added_via_api": True,
+            "host_statuses": [
+                _host_status("10.0.0.1", eds_health_status="HEALTHY"),
+                _host_status("10.0.0.2", eds_health_status="HEALTHY", failed_outlier_check=True),
+            ],
+        },
+        {"name": "service.main.egress", "host_statuses": []},
+    ]
+}
+
+
+@pytest.mark.parametrize("indent", [None, 1])
+def test_find_envoy_cluster_status(indent):
+    clusters_json = json.dumps(CLUSTERS, indent=indent)
+
+    with patch("json.loads") as mock_loads:
+        assert find_envoy_cluster_status(clusters_json, "service.main") == CLUSTERS["cluster_statuses"][1]
+        assert find_envoy_cluster_status(clusters_json, "service.main.egress") == CLUSTERS["cluster_statuses"][2]
+    # Found without parsing the whole thing
+    assert mock_loads.call_count == 0
+
+    assert find_envoy_cluster_status(clusters_json, "missing.main") is None
+    assert find_envoy_cluster_status("not json", "service.main") is None
+
+
+def test_find_envoy_cluster_status_name_not_first():
+    clusters = {"cluster_statuses": [{"host_statuses": [], "name": "service.main"}]}
+    assert find_envoy_cluster_status(json.dumps(clusters), "service.main") == clusters["cluster_statuses"][0]
+
+
+@pytest.mark.parametrize(
+    "health_status,expected",
+    [
+        [{}, True],
+        [{"eds_health_status": "HEALTHY"}, True],
+        [{"eds_health_status": "DRAINING"}, False],
+        [{"eds_health_status": "UNHEALTHY"}, False],
+        [{"eds_health_status": "HEALTHY", "failed_outlier_check": True}, False],
+        [{"eds_health_status": "HEALTHY", "failed_active_health_check": True}, False],
+        [{"eds_health_status": "HEALTHY", "pending_dynamic_removal": True}, False],
+    ],
+)
+def test_is_envoy_host_routable(health_status, expected):
+    assert is_envoy_host_routable(_host_status("10.0.0.1", **health_status)) == expected
+
+
+class FakeEnvoyAdminHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.client_address[1], self.path))
+        body = json.dumps(CLUSTERS).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_envoy_admin_client():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeEnvoyAdminHandler)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    envoy_admin = EnvoyAdminClient(server.server_address[1])
+    try:
+        assert envoy_admin.get_cluster_status("service.main") == CLUSTERS["cluster_statuses"][1]
+        assert envoy_admin.get_cluster_status("missing.main") is None
+    finally:
+        envoy_admin.close()
+        server.shutdown()
+        server.server_close()
+
+    assert [path for _, path in server.requests] == 2 * ["/clusters?format=json"]
+    # Over the one connection
+    assert len({port for port, _ in server.requests}) == 1
+
+
+def test_envoy_admin_client_unreachable():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeEnvoyAdminHandler)
+    port = server.server_address[1]
+    server.server_close()
+
+    envoy_admin = EnvoyAdminClient(port)
+    assert envoy_admin.get_cluster_status("service.main") is None
@@ -0,0 +1,341 @@
+"""An in-memory fake of ZooKeeper, for the tests and benchmarks."""
+
+import collections
+import queue
+import threading
+import time
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import kazoo.exceptions
+from kazoo.protocol.states import EventType
+from kazoo.protocol.states import KeeperState
+from kazoo.protocol.states import WatchedEvent
+from kazoo.protocol.states import ZnodeStat
+
+Watch = Callable[[WatchedEvent], None]
+
+
+class _Node:
+    __slots__ = ("data", "ephemeral_owner", "czxid", "mzxid", "pzxid", "version", "cversion", "children")
+
+    def __init__(self, data: bytes, ephemeral_owner: int, zxid: int) -> None:
+        self.data = data
+        self.ephemeral_owner = ephemeral_owner
+        self.czxid = self.mzxid = self.pzxid = zxid
+        self.version = 0
+        self.cversion = 0
+        # dict rather than set, to list children in the order they were created
+        self.children: Dict[str, None] = {}
+
+    def stat(self) -> ZnodeStat:
+        return ZnodeStat(
+            czxid=self.czxid,
+            mzxid=self.mzxid,
+            ctime=0,
+            mtime=0,
+            version=self.version,
+            cversion=self.cversion,
+            aversion=0,
+            ephemeralOwner=self.ephemeral_owner,
+            dataLength=len(self.data),
+            numChildren=len(self.children),
+            pzxid=self.pzxid,
+        )
+
+
+class FakeAsyncResult:
+    """Just enough of kazoo's IAsyncResult"""
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+        self._value: object = None
+        self._exception: Optional[Exception] = None
+        self._callbacks: List[Callable[["FakeAsyncResult"], None]] = []
+        self._lock = threading.Lock()
+
+    def complete(self, func: Callable[[], object]) -> None:
+        try:
+            self._value = func()
+        except Exception as e:
+            self._exception = e
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def get(self) -> object:
+        self._event.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+    def rawlink(self, callback: Callable[["FakeAsyncResult"], None]) -> None:
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+class FakeTransaction:
+    def __init__(self, zk: "FakeZooKeeper") -> None:
+        self.zk = zk
+        self.operations: List[Tuple[str, str, int]] = []
+
+    def delete(self, path: str, version: int = -1) -> None:
+        self.operations.append(("delete", path, version))
+
+    def check(self, path: str, version: int) -> None:
+        self.operations.append(("check", path, version))
+
+    def commit(self) -> List[object]:
+        return self.zk._commit(self.operations)
+
+
+class FakeZooKeeper:
+    """An in-memory stand-in for a connected KazooClient.
+
+    Supports enough of the API for clean_nerve: creating, reading, listing
+    and deleting nodes (synchronously, asynchronously and in transactions),
+    with real ZnodeStats and one-shot watches. Every request takes
+    latency_s to complete, as a round trip to a real ensemble would, but any
+    number of asynchronous requests may be outstanding at once. ops counts
+    requests by method name.
+    """
+
+    def __init__(self, latency_s: float = 0.0) -> None:
+        self.latency_s = latency_s
+        self.ops: Dict[str, int] = collections.Counter()
+        self.connected = True
+        self._lock = threading.RLock()
+        self._zxid = 1
+        self._nodes = {"/": _Node(b"", 0, 0)}
+        self._child_watches: Dict[str, Set[Watch]] = collections.defaultdict(set)
+        self._data_watches: Dict[str, Set[Watch]] = collections.defaultdict(set)
+        self._listeners: List[Callable[[str], None]] = []
+        self._pending: "queue.Queue[Tuple[float, FakeAsyncResult, Callable[[], object]]]" = queue.Queue()
+        if latency_s:
+            threading.Thread(target=self._complete_requests, daemon=True).start()
+
+    # Connection
+
+    def start(self, timeout: float = 15) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[str], None]) -> None:
+        self._listeners.remove(listener)
+
+    # Internals
+
+    def _wait(self) -> None:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def _complete_requests(self) -> None:
+        while True:
+            due, result, func = self._pending.get()
+            time.sleep(max(0.0, due - time.monotonic()))
+            result.complete(func)
+
+    def _submit(self, op: str, func: Callable[[], object]) -> FakeAsyncResult:
+        self.ops[op] += 1
+        result = FakeAsyncResult()
+        if self.latency_s:
+            self._pending.put((time.monotonic() + self.latency_s, result, func))
+        else:
+            result.complete(func)
+        return result
+
+    def _node(self, path: str) -> _Node:
+        try:
+            return self._nodes[path]
+        except KeyError:
+            raise kazoo.exceptions.NoNodeError(path)
+
+    @staticmethod
+    def _parent(path: str) -> str:
+        return path.rpartition("/")[0] or "/"
+
+    def _fire(self, watches: Dict[str, Set[Watch]], path: str, event_type: str) -> None:
+        for watch in watches.pop(path, set()):
+            watch(WatchedEvent(event_type, KeeperState.CONNECTED, path))
+
+    def _next_zxid(self) -> int:
+        self._zxid += 1
+        return self._zxid
+
+    def _create(self, path: str, value: bytes, ephemeral: bool, makepath: bool) -> str:
+        with self._lock:
+            if path in self._nodes:
+                raise kazoo.exceptions.NodeExistsError(path)
+            parent_path = self._parent(path)
+            if parent_path not in self._nodes:
+                if not makepath:
+                    raise kazoo.exceptions.NoNodeError(parent_path)
+                self._create(parent_path, b"", False, True)
+            parent = self._nodes[parent_path]
+            zxid = self._next_zxid()
+            self._nodes[path] = _Node(value, 1 if ephemeral else 0, zxid)
+            parent.children[path.rpartition("/")[2]] = None
+            parent.cversion += 1
+            parent.pzxid = zxid
+        self._fire(self._data_watches, path, EventType.CREATED)
+        self._fire(self._child_watches, parent_path, EventType.CHILD)
+        return path
+
+    def _check_delete(self, path: str, version: int) -> None:
+        node = self._node(path)
+        if version != -1 and node.version != version:
+            raise kazoo.exceptions.BadVersionError(path)
+        if node.children:
+            raise kazoo.exceptions.NotEmptyError(path)
+
+    def _delete(self, path: str, version: int) -> None:
+        with self._lock:
+            self._check_delete(path, version)
+            del self._nodes[path]
+            parent_path = self._parent(path)
+            parent = self._nodes[parent_path]
+            del parent.children[path.rpartition("/")[2]]
+            parent.cversion += 1
+            parent.pzxid = self._next_zxid()
+        self._fire(self._data_watches, path, EventType.DELETED)
+        self._fire(self._child_watches, path, EventType.DELETED)
+        self._fire(self._child_watches, parent_path, EventType.CHILD)
+
+    def _get(self, path: str, watch: Optional[Watch]) -> Tuple[bytes, ZnodeStat]:
+        with self._lock:
+            node = self._node(path)
+            if watch is not None:
+                self._data_watches[path].add(watch)
+            return node.data, node.stat()
+
+    def _get_children(self, path: str, watch: Optional[Watch]) -> List[str]:
+        with self._lock:
+            node = self._node(path)
+            if watch is not None:
+                self._child_watches[path].add(watch)
+            return list(node.children)
+
+    def _exists(self, path: str, watch: Optional[Watch]) -> Optional[ZnodeStat]:
+        with self._lock:
+            if watch is not None:
+                self._data_watches[path].add(watch)
+            node = self._nodes.get(path)
+            return node.stat() if node is not None else None
+
+    def _commit(self, operations: List[Tuple[str, str, int]]) -> List[object]:
+        self.ops["commit"] += 1
+        self._wait()
+        with self._lock:
+            for i, (op, path, version) in enumerate(operations):
+                try:
+                    if op == "delete":
+                        self._check_delete(path, version)
+                    elif self._node(path).version != version:
+                        raise kazoo.exceptions.BadVersionError(path)
+                except kazoo.exceptions.ZookeeperError as e:
+                    return (
+                        [kazoo.exceptions.RolledBackError() for _ in operations[:i]]
+                        + [e]
+                        + [kazoo.exceptions.RuntimeInconsistency() for _ in range(len(operations) - i - 1)]
+                    )
+            for op, path, version in operations:
+                if op == "delete":
+                    self._delete(path, version)
+            return [True] * len(operations)
+
+    # KazooClient API
+
+    def create(self, path: str, value: bytes = b"", ephemeral: bool = False, makepath: bool = False) -> str:
+        self.ops["create"] += 1
+        self._wait()
+        return self._create(path, value, ephemeral, makepath)
+
+    def ensure_path(self, path: str) -> None:
+        if path not in self._nodes:
+            self.create(path, makepath=True)
+
+    def set(self, path: str, value: bytes, version: int = -1) -> ZnodeStat:
+        self.ops["set"] += 1
+        self._wait()
+        with self._lock:
+            node = self._node(path)
+            if version != -1 and node.version != version:
+                raise kazoo.exceptions.BadVersionError(path)
+            node.data = value
+            node.version += 1
+            node.mzxid = self._next_zxid()
+            stat = node.stat()
+        self._fire(self._data_watches, path, EventType.CHANGED)
+        return stat
+
+    def delete(self, path: str, version: int = -1) -> None:
+        self.ops["delete"] += 1
+        self._wait()
+        self._delete(path, version)
+
+    def get(self, path: str, watch: Optional[Watch] = None) -> Tuple[bytes, ZnodeStat]:
+        self.ops["get"] += 1
+        self._wait()
+        return self._get(path, watch)
+
+    def get_async(self, path: str, watch: Optional[Watch] = None) -> FakeAsyncResult:
+        return self._submit("get", lambda: self._get(path, watch))
+
+    def get_children(self, path: str, watch: Optional[Watch] = None) -> List[str]:
+        self.ops["get_children"] += 1
+        self._wait()
+        return self._get_children(path, watch)
+
+    def get_children_async(self, path: str, watch: Optional[Watch] = None) -> FakeAsyncResult:
+        return self._submit("get_children", lambda: self._get_children(path, watch))
+
+    def exists(self, path: str, watch: Optional[Watch] = None) -> Optional[ZnodeStat]:
+        self.ops["exists"] += 1
+        self._wait()
+        return self._exists(path, watch)
+
+    def exists_async(self, path: str, watch: Optional[Watch] = None) -> FakeAsyncResult:
+        return self._submit("exists", lambda: self._exists(path, watch))
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+
+def build_registration_tree(
+    zk: FakeZooKeeper,
+    root: str,
+    services: int,
+    instances: int,
+    orphan_every: int = 100,
+) -> int:
+    """Register instances of each of services under root, making every
+    orphan_every'th of them an orphan, and return the number of orphans."""
+    orphans = 0
+    for s in range(services):
+        for i in range(instances):
+            orphan = (s * instances + i) % orphan_every == 0
+            orphans += orphan
+            zk._create(
+                f"{root}/service_{s:06}.main/instance_{i:06}",
+                b"" if orphan else b'{"host": "10.0.0.1", "port": 31337}',
+                ephemeral=not orphan,
+                makepath=True,
+            )
+    return orphans
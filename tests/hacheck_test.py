@@ -0,0 +1,87 @@
+import http.server
+import socket
+import threading
+import urllib.parse
+from unittest import mock
+
+import pytest
+
+from nerve_tools.hacheck import HacheckClient
+
+
+class FakeHacheckHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections alive between requests, as hacheck does
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status_code):
+        self.server.client_ports.add(self.client_address[1])
+        self.send_response(status_code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        _, service, port, _ = self.path.strip("/").split("/")
+        self._respond(503 if (service, port) in self.server.downed else 200)
+
+    def do_POST(self):
+        _, service, port, _ = self.path.strip("/").split("/")
+        body = urllib.parse.parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        if body["status"] == ["down"]:
+            self.server.downed.add((service, port))
+        else:
+            self.server.downed.discard((service, port))
+        self._respond(200)
+
+
+@pytest.fixture
+def hacheck_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeHacheckHandler)
+    server.downed = set()
+    server.client_ports = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_set_state_and_is_up_over_http(hacheck_server):
+    hacheck = HacheckClient(port=hacheck_server.server_address[1])
+
+    with mock.patch("subprocess.check_call") as check_call:
+        assert hacheck.is_up("service.main")
+        hacheck.set_state("service.main", "down")
+        hacheck.set_state("other.main", "down", 1234)
+        assert not hacheck.is_up("service.main")
+        assert not hacheck.is_up("other.main", 1234)
+        assert hacheck.is_up("other.main")
+        hacheck.set_state("service.main", "up")
+        assert hacheck.is_up("service.main")
+    hacheck.close()
+
+    assert hacheck_server.downed == {("other.main", "1234")}
+    # Every request went over the one connection, without running any binaries
+    assert len(hacheck_server.client_ports) == 1
+    assert check_call.call_count == 0
+
+
+def _get_unused_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_falls_back_to_binaries_without_http_api():
+    hacheck = HacheckClient(port=_get_unused_port())
+
+    with mock.patch("subprocess.check_call") as check_call:
+        hacheck.set_state("service.main", "down", 1234)
+        assert hacheck.is_up("all")
+    check_call.assert_any_call(["/usr/bin/hadown", "service.main", "-P", "1234"])
+    assert check_call.call_args_list[1][0][0] == ["/usr/bin/hastatus", "all"]
+
+    with mock.patch("subprocess.check_call", side_effect=Exception):
+        assert not hacheck.is_up("all")
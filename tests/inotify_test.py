@@ -0,0 +1,51 @@
+import sys
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from nerve_tools.inotify import DirectoryWatcher
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux-only")
+
+
+@linux_only
+def test_wait_returns_when_a_file_is_written(tmp_path):
+    timer = threading.Timer(0.1, (tmp_path / "service.yaml").write_text, ["resources: []"])
+    with DirectoryWatcher(str(tmp_path)) as watcher:
+        assert not watcher.polling
+        start = time.monotonic()
+        timer.start()
+        assert watcher.wait(30)
+        assert time.monotonic() - start < 10
+    timer.join()
+
+
+@linux_only
+def test_wait_returns_when_a_file_is_moved_into_place(tmp_path):
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    watched_dir = tmp_path / "watched"
+    watched_dir.mkdir()
+    (other_dir / "service.yaml").write_text("resources: []")
+
+    with DirectoryWatcher(str(watched_dir)) as watcher:
+        (other_dir / "service.yaml").rename(watched_dir / "service.yaml")
+        assert watcher.wait(30)
+        # Every event was consumed
+        assert not watcher.wait(0)
+
+
+@linux_only
+def test_wait_times_out_when_nothing_changes(tmp_path):
+    with DirectoryWatcher(str(tmp_path)) as watcher:
+        assert not watcher.wait(0.01)
+
+
+def test_missing_directory_falls_back_to_polling(tmp_path):
+    with DirectoryWatcher(str(tmp_path / "missing")) as watcher:
+        assert watcher.polling
+        with mock.patch("time.sleep") as mock_sleep:
+            assert not watcher.wait(1)
+    mock_sleep.assert_called_once_with(1)
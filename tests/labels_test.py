@@ -0,0 +1,125 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from nerve_tools import configure_nerve
+from nerve_tools import labels
+
+
+@pytest.fixture
+def labels_dir(tmp_path):
+    (tmp_path / "service_one1234").write_text("label1: value1\n")
+    (tmp_path / "service_one1234_extra").write_text("label2: value2\n")
+    (tmp_path / "service_one12345").write_text("label3: value3\n")
+    (tmp_path / "service_two5678").write_text("label4: value4\n")
+    labels.load_labels_bundle.cache_clear()
+    yield str(tmp_path)
+    labels.load_labels_bundle.cache_clear()
+
+
+def _build(labels_dir):
+    bundle = labels.build_labels_bundle(labels_dir)
+    labels.write_labels_bundle(bundle, labels.get_labels_bundle_path(labels_dir))
+    return bundle
+
+
+def test_build_labels_bundle(labels_dir):
+    assert labels.build_labels_bundle(labels_dir) == {
+        "version": labels.LABELS_BUNDLE_VERSION,
+        "labels": {
+            "service_one1234": {"label1": "value1"},
+            "service_one12345": {"label3": "value3"},
+            "service_one1234_extra": {"label2": "value2"},
+            "service_two5678": {"label4": "value4"},
+        },
+    }
+
+
+def test_build_labels_bundle_keeps_native_types(tmp_path):
+    (tmp_path / "service_one1234").write_text("weight: 10\ncanary: true\nname: x\n")
+    labels.write_labels_bundle(labels.build_labels_bundle(str(tmp_path)), labels.get_labels_bundle_path(str(tmp_path)))
+    labels.load_labels_bundle.cache_clear()
+
+    loose = configure_nerve.get_labels_by_service_and_port("service_one", 1234, labels_dir=str(tmp_path))
+    assert loose == {"weight": 10, "canary": True, "name": "x"}
+    assert labels.load_labels_bundle(str(tmp_path)).get_labels("service_one1234") == loose
+    labels.load_labels_bundle.cache_clear()
+
+
+def test_build_labels_bundle_skips_existing_bundle(labels_dir):
+    _build(labels_dir)
+    assert labels.LABELS_BUNDLE_FILENAME not in labels.build_labels_bundle(labels_dir)["labels"]
+
+
+def test_labels_bundle_get_labels():
+    bundle = labels.LabelsBundle(
+        {
+            "a1": {"x": "1"},
+            "a12": {"y": "2"},
+            "a2": {"z": "3"},
+            "b1": {"x": "4"},
+        }
+    )
+    assert bundle.get_labels("a1") == {"x": "1", "y": "2"}
+    assert bundle.get_labels("a2") == {"z": "3"}
+    assert bundle.get_labels("b") == {"x": "4"}
+    assert bundle.get_labels("c") == {}
+
+
+def test_load_labels_bundle_missing(labels_dir):
+    assert labels.load_labels_bundle(labels_dir) is None
+
+
+def test_load_labels_bundle_wrong_version(labels_dir):
+    with open(labels.get_labels_bundle_path(labels_dir), "w") as fp:
+        json.dump({"version": labels.LABELS_BUNDLE_VERSION + 1, "labels": {}}, fp)
+    assert labels.load_labels_bundle(labels_dir) is None
+
+
+def test_get_labels_by_service_and_port_matches_loose_files(labels_dir):
+    loose = configure_nerve.get_labels_by_service_and_port("service_one", 1234, labels_dir=labels_dir)
+    _build(labels_dir)
+    labels.load_labels_bundle.cache_clear()
+    with mock.patch("nerve_tools.configure_nerve.glob", return_value=[]):
+        bundled = configure_nerve.get_labels_by_service_and_port("service_one", 1234, labels_dir=labels_dir)
+    assert loose == bundled == {"label1": "value1", "label2": "value2", "label3": "value3"}
+
+
+def test_get_labels_by_service_and_port_loose_files_override_bundle(tmp_path):
+    labels.load_labels_bundle.cache_clear()
+    labels.write_labels_bundle(
+        {"version": labels.LABELS_BUNDLE_VERSION, "labels": {"service_one1234": {"a": "bundle", "b": "bundle"}}},
+        labels.get_labels_bundle_path(str(tmp_path)),
+    )
+    (tmp_path / "service_one1234_override").write_text("b: loose\n")
+    assert configure_nerve.get_labels_by_service_and_port("service_one", 1234, labels_dir=str(tmp_path)) == {
+        "a": "bundle",
+        "b": "loose",
+    }
+    labels.load_labels_bundle.cache_clear()
+
+
+def test_main(labels_dir):
+    expected_bundle = labels.build_labels_bundle(labels_dir)
+    with mock.patch("sys.argv", ["build_nerve_labels_bundle", "--labels-dir", labels_dir]):
+        labels.main()
+    with open(labels.get_labels_bundle_path(labels_dir)) as fp:
+        assert json.load(fp) == expected_bundle
+    # The loose files are left alone
+    assert sorted(os.listdir(labels_dir)) == sorted([labels.LABELS_BUNDLE_FILENAME] + list(expected_bundle["labels"]))
+
+
+def test_main_remove_loose_files(labels_dir):
+    loose = configure_nerve.get_labels_by_service_and_port("service_one", 1234, labels_dir=labels_dir)
+    argv = ["build_nerve_labels_bundle", "--labels-dir", labels_dir, "--remove-loose-files"]
+    with mock.patch("sys.argv", argv):
+        labels.main()
+
+    assert os.listdir(labels_dir) == [labels.LABELS_BUNDLE_FILENAME]
+    # With nothing else to read, the bundle alone gives the same labels
+    labels.load_labels_bundle.cache_clear()
+    with mock.patch("yaml.load") as mock_load:
+        assert configure_nerve.get_labels_by_service_and_port("service_one", 1234, labels_dir=labels_dir) == loose
+    assert mock_load.call_count == 0
@@ -0,0 +1,31 @@
+import subprocess
+import sys
+
+import pytest
+
+# Modules that are slow to import and must only be imported by the code
+# paths that actually need them.
+HEAVY_MODULES = [
+    "environment_tools",
+    "kazoo",
+    "paasta_tools",
+    "requests",
+    "service_configuration_lib",
+    "yaml",
+]
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "nerve_tools.clean_nerve",
+        "nerve_tools.configure_nerve",
+        "nerve_tools.labels",
+        "nerve_tools.updown_service",
+        "nerve_tools.zk_topology",
+    ],
+)
+def test_entry_points_do_not_import_heavy_modules(module):
+    code = f"import sys, {module}; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    output = subprocess.check_output([sys.executable, "-c", code], text=True)
+    assert output.split() == []
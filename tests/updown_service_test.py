@@ -1,3 +1,9 @@
+import http.server
+import os
+import socket
+import sys
+import threading
+import time
 from unittest import mock
 
 import pytest
@@ -5,6 +11,8 @@ import yaml
 from requests.exceptions import RequestException
 
 from nerve_tools import updown_service
+from nerve_tools.envoy import EnvoyAdminClient
+from nerve_tools.hacheck import HacheckClient
 
 
 def test_get_args_pass():
@@ -49,14 +57,31 @@ def test_get_args_pass():
 
         with mock.patch("sys.argv", argv):
             args = updown_service.get_args()
-            timeout = updown_service._get_timeout_s(args.service, args.timeout)
+            timeout = updown_service._get_timeout_s(args.services[0][0], args.timeout)
 
-        assert args.service == "myservice.name"
+        assert args.services == [("myservice.name", expected_port)]
         assert args.state == expected_state
         assert args.timeout == expected_args_timeout
         assert timeout == expected_timeout
         assert args.wait_only == expected_wait_only
-        assert args.port == expected_port
+        assert not args.all_local
+
+
+def test_get_args_several_services():
+    argv = ["updown_service", "one.main", "two.main:1234", "down"]
+    with mock.patch("sys.argv", argv):
+        args = updown_service.get_args()
+
+    assert args.services == [("one.main", None), ("two.main", 1234)]
+    assert args.state == "down"
+
+
+def test_get_args_all_local():
+    with mock.patch("sys.argv", ["updown_service", "--all-local", "down"]):
+        args = updown_service.get_args()
+
+    assert args.services == []
+    assert args.all_local
 
 
 def test_get_args_fail():
@@ -65,6 +90,8 @@ def test_get_args_fail():
         ["updown_service", "myservice.name"],
         ["updown_service", "myservice", "up"],
         ["updown_service", "myservice.name", "wibble"],
+        ["updown_service", "up"],
+        ["updown_service", "--all-local", "myservice.name", "up"],
     ]
 
     for argv in tests:
@@ -74,37 +101,134 @@ def test_get_args_fail():
             assert str(excinfo.value) == "2", argv
 
 
-def test_check_local_healthcheck_returns_true_on_success():
+def _service_config(**overrides):
+    service_config = {
+        "managed": True,
+        "updown_timeout_s": updown_service.DEFAULT_TIMEOUT_S,
+        "healthcheck_uri": "/status",
+        "healthcheck_port": 1010,
+        "healthcheck_mode": "http",
+        "healthcheck_timeout_s": 1.0,
+    }
+    service_config.update(overrides)
+    return service_config
+
+
+@pytest.fixture
+def mock_session():
+    with mock.patch("nerve_tools.updown_service._get_healthcheck_session") as mock_get_session:
+        yield mock_get_session.return_value
+
+
+def test_check_local_healthcheck_returns_true_on_success(mock_session):
+    assert updown_service.check_local_healthcheck("service_three.main", _service_config())
+    mock_session.get.assert_called_once_with("http://127.0.0.1:1010/status", timeout=1.0)
+
+
+def test_check_local_healthcheck_returns_false_on_failure(mock_session):
+    mock_session.get.return_value.raise_for_status.side_effect = RequestException()
+    assert not updown_service.check_local_healthcheck("service_three.main", _service_config())
+    mock_session.get.assert_called_once_with("http://127.0.0.1:1010/status", timeout=1.0)
+
+
+def test_check_local_healthcheck_loads_config(mock_session):
     with (
         mock.patch(
-            "nerve_tools.updown_service.read_service_configuration",
-            return_value={"port": 1010},
+            "paasta_tools.long_running_service_tools.load_service_namespace_config",
+            return_value={"proxy_port": 3, "healthcheck_timeout_s": 5},
+        ),
+        mock.patch(
+            "service_configuration_lib.read_service_configuration",
+            return_value={"port": 1010, "smartstack": {"main": {"healthcheck_uri": "/health"}}},
         ),
-        mock.patch("requests.get", return_value=mock.Mock()) as mock_http,
     ):
         assert updown_service.check_local_healthcheck("service_three.main")
-        mock_http.assert_called_once_with("http://127.0.0.1:1010/status")
+    mock_session.get.assert_called_once_with("http://127.0.0.1:1010/health", timeout=5)
+
+
+class _HealthcheckHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.client_ports.add(self.client_address[1])
+        if self.path == "/hang":
+            self.server.release.wait()
+        self.send_response(200 if self.path == "/status" else 500)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture
+def healthcheck_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _HealthcheckHandler)
+    server.daemon_threads = True
+    server.client_ports = set()
+    server.release = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+    vars(updown_service._healthcheck_sessions).clear()
+
+
+def test_check_local_healthcheck_http(healthcheck_server):
+    service_config = _service_config(healthcheck_port=healthcheck_server.server_address[1])
+
+    for _ in range(3):
+        assert updown_service.check_local_healthcheck("service_three.main", service_config)
+    assert not updown_service.check_local_healthcheck(
+        "service_three.main",
+        {**service_config, "healthcheck_uri": "/unhealthy"},
+    )
+    # All over the one connection
+    assert len(healthcheck_server.client_ports) == 1
 
 
-def test_check_local_healthcheck_returns_false_on_failure():
-    mock_get = mock.Mock(raise_for_status=mock.Mock(side_effect=RequestException()))
-    with (
-        mock.patch(
-            "nerve_tools.updown_service.read_service_configuration",
-            return_value={"port": 1010},
-        ),
-        mock.patch("requests.get", return_value=mock_get) as mock_http,
-    ):
-        assert not updown_service.check_local_healthcheck("service_three.main")
-        mock_http.assert_called_once_with("http://127.0.0.1:1010/status")
+def test_get_healthcheck_session_is_per_thread():
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(updown_service._get_healthcheck_session()))
+    thread.start()
+    thread.join()
+
+    session = updown_service._get_healthcheck_session()
+    assert updown_service._get_healthcheck_session() is session
+    assert sessions[0] is not session
+    vars(updown_service._healthcheck_sessions).clear()
+
+
+def test_check_local_healthcheck_times_out(healthcheck_server):
+    service_config = _service_config(
+        healthcheck_port=healthcheck_server.server_address[1],
+        healthcheck_uri="/hang",
+        healthcheck_timeout_s=0.1,
+    )
+
+    start = time.monotonic()
+    assert not updown_service.check_local_healthcheck("service_three.main", service_config)
+    assert time.monotonic() - start < 10
+
+
+def test_check_local_healthcheck_tcp():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        service_config = _service_config(healthcheck_mode="tcp", healthcheck_port=listener.getsockname()[1])
+        assert updown_service.check_local_healthcheck("service_three.main", service_config)
+
+    # Nothing listening any more
+    assert not updown_service.check_local_healthcheck("service_three.main", service_config)
 
 
 def test_should_manage_service():
-    mconfig_path = "nerve_tools.updown_service.load_service_namespace_config"
+    mconfig_path = "paasta_tools.long_running_service_tools.load_service_namespace_config"
     mconfig = mock.Mock(return_value={"proxy_port": 3})
     mconfig_discovery_only = mock.Mock(return_value={"proxy_port": None})
 
-    sconfig_path = "nerve_tools.updown_service.read_service_configuration"
+    sconfig_path = "service_configuration_lib.read_service_configuration"
     with (
         mock.patch(mconfig_path, new=mconfig),
         mock.patch(sconfig_path, return_value={}),
@@ -134,7 +258,7 @@ def test_should_manage_service():
 def test_timeout_s():
     arg_timeout_s = 30
     new_timeout_s = 50
-    mconfig_path = "nerve_tools.updown_service.load_service_namespace_config"
+    mconfig_path = "paasta_tools.long_running_service_tools.load_service_namespace_config"
 
     mconfig = mock.Mock(return_value={})
     with mock.patch(mconfig_path, new=mconfig):
@@ -154,11 +278,16 @@ def test_timeout_s():
 
 
 def test_reconfigure_hacheck():
+    # With nothing listening for hacheck's HTTP API, the binaries are run instead
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        hacheck = HacheckClient(port=sock.getsockname()[1])
+
     with mock.patch("subprocess.check_call") as check_call:
-        updown_service.reconfigure_hacheck("test.main", "down", None)
-        updown_service.reconfigure_hacheck("test.main", "down", 1234)
-        updown_service.reconfigure_hacheck("test.main", "up", None)
-        updown_service.reconfigure_hacheck("test.main", "up", 1337)
+        updown_service.reconfigure_hacheck("test.main", "down", None, hacheck)
+        updown_service.reconfigure_hacheck("test.main", "down", 1234, hacheck)
+        updown_service.reconfigure_hacheck("test.main", "up", None, hacheck)
+        updown_service.reconfigure_hacheck("test.main", "up", 1337, hacheck)
 
         expected_calls = [
             mock.call(["/usr/bin/hadown", "test.main"]),
@@ -244,7 +373,7 @@ def test_check_envoy_state_no_endpoints(tmp_path):
     (tmp_path / service).mkdir()
     (tmp_path / service / f"{service}.yaml").write_text(yaml.dump(envoy_eds_config))
 
-    with pytest.raises(SystemExit):
+    with pytest.raises(updown_service.NoBackendsError):
         updown_service.check_envoy_state(
             service,
             "up",
@@ -263,27 +392,431 @@ def test_check_envoy_state_missing_eds_file(tmp_path):
     )
 
 
+def _write_eds_file(eds_dir, service, addresses):
+    endpoints = [
+        {"lb_endpoints": [{"endpoint": {"address": {"socket_address": {"address": address}}}} for address in addresses]}
+    ]
+    (eds_dir / service).mkdir(exist_ok=True)
+    (eds_dir / service / f"{service}.yaml").write_text(yaml.dump({"resources": [{"endpoints": endpoints}]}))
+
+
+def test_check_envoy_state_matches_address_exactly(tmp_path):
+    _write_eds_file(tmp_path, "service.instance", ["10.0.0.10", "10.0.0.100"])
+
+    with mock.patch("nerve_tools.updown_service.get_my_ip_address", return_value="10.0.0.1"):
+        assert updown_service.check_envoy_state("service.instance", "down", str(tmp_path))
+
+
+def test_get_eds_endpoint_addresses_only_parses_changed_files(tmp_path):
+    eds_file = tmp_path / "service.instance" / "service.instance.yaml"
+    _write_eds_file(tmp_path, "service.instance", ["10.0.0.1", "10.0.0.2"])
+
+    with mock.patch("yaml.load", wraps=yaml.load) as mock_load:
+        for _ in range(3):
+            addresses = updown_service.get_eds_endpoint_addresses("service.instance", str(tmp_path))
+        assert addresses == {"10.0.0.1", "10.0.0.2"}
+        assert mock_load.call_count == 1
+
+        _write_eds_file(tmp_path, "service.instance", ["10.0.0.3"])
+        os.utime(eds_file, ns=(0, eds_file.stat().st_mtime_ns + 1))
+        assert updown_service.get_eds_endpoint_addresses("service.instance", str(tmp_path)) == {"10.0.0.3"}
+        assert mock_load.call_count == 2
+
+    # The rewrite replaced the file's cached addresses, rather than adding to them
+    assert updown_service._eds_endpoint_addresses[str(eds_file)] == (
+        (eds_file.stat().st_mtime_ns, eds_file.stat().st_size, eds_file.stat().st_ino),
+        {"10.0.0.3"},
+    )
+
+
 @pytest.mark.parametrize(
-    "check_envoy_state_side_effect,expected_result,expected_iterations",
+    "check_envoy_state_side_effect,expected_result,expected_sleeps",
     [
-        # Service is immediately in the expected state
-        [[True], 0, 1],
-        # Service never enters the expected state
-        [10 * [False], 1, 10],
+        # Service is immediately in the expected state, so just wait_time
+        [[True], 0, [1]],
+        # Service never enters the expected state, polled quickly at first then
+        # backing off, but never past the timeout
+        [14 * [False], 1, [0.05, 0.1, 0.2, 0.4, 0.8] + 8 * [1] + [0.45]],
         # Service enters the expected state on third poll
-        [[False, False, True], 0, 3],
+        [[False, False, True], 0, [0.05, 0.1, 1]],
     ],
 )
-def test_wait_for_envoy_state(check_envoy_state_side_effect, expected_result, expected_iterations):
+def test_wait_for_envoy_state(check_envoy_state_side_effect, expected_result, expected_sleeps, capsys):
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
     with (
-        mock.patch("time.sleep") as mock_sleep,
+        mock.patch("time.sleep", side_effect=sleep) as mock_sleep,
+        mock.patch("time.monotonic", side_effect=lambda: clock[0]),
         mock.patch("subprocess.check_call"),
         mock.patch(
             "nerve_tools.updown_service.check_envoy_state",
             side_effect=check_envoy_state_side_effect,
         ),
     ):
-        actual_result = updown_service.wait_for_envoy_state("service_three.main", "down", 10, 1, "/not/real")
+        actual_result = updown_service.wait_for_envoy_state(["service_three.main"], "down", 10, 1, "/not/real")
 
     assert expected_result == actual_result
-    assert mock_sleep.call_count == expected_iterations
+    assert [args[0] for args, _ in mock_sleep.call_args_list] == pytest.approx(expected_sleeps)
+    # How long it took is reported
+    if expected_result == 0:
+        assert f"entered state 'down' after {sum(expected_sleeps[:-1]):.2f}s" in capsys.readouterr().out
+    else:
+        assert "failed to enter state 'down' after 10.00s" in capsys.readouterr().out
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux-only")
+def test_wait_for_envoy_state_wakes_when_eds_file_changes(tmp_path):
+    service = "service_three.main"
+    (tmp_path / service).mkdir()
+    states = iter([False, True])
+
+    def rewrite_eds_file():
+        _write_eds_file(tmp_path, service, ["10.0.0.1"])
+
+    timer = threading.Timer(0.1, rewrite_eds_file)
+    with (
+        mock.patch.object(updown_service, "ENVOY_POLL_INTERVAL_S", 60),
+        mock.patch(
+            "nerve_tools.updown_service.check_envoy_state",
+            side_effect=lambda *args: next(states),
+        ),
+    ):
+        start = time.monotonic()
+        timer.start()
+        actual_result = updown_service.wait_for_envoy_state([service], "down", 120, 0, str(tmp_path))
+        elapsed = time.monotonic() - start
+    timer.join()
+
+    assert actual_result == 0
+    # Woken by the rewrite, long before the next poll was due
+    assert elapsed < 30
+
+
+def test_wait_for_envoy_state_waits_for_services_concurrently(capsys):
+    clock = [0.0]
+    lock = threading.Lock()
+    one_checked = threading.Event()
+
+    def sleep(seconds):
+        # Don't let two.main run out the clock before one.main gets a look in
+        one_checked.wait()
+        with lock:
+            clock[0] += seconds
+
+    def check_envoy_state(service, *args):
+        if service == "one.main":
+            one_checked.set()
+            return True
+        return False
+
+    # one.main converges at once, two.main never does
+    with (
+        mock.patch("time.sleep", side_effect=sleep) as mock_sleep,
+        mock.patch("time.monotonic", side_effect=lambda: clock[0]),
+        mock.patch("nerve_tools.updown_service.check_envoy_state", side_effect=check_envoy_state),
+    ):
+        actual_result = updown_service.wait_for_envoy_state(["one.main", "two.main"], "down", 10, 5, "/not/real")
+
+    assert actual_result == 1
+    # Only two.main polled, until the timeout, and the extra wait wasn't applied
+    assert sum(args[0] for args, _ in mock_sleep.call_args_list) == pytest.approx(10)
+    assert mock.call(5) not in mock_sleep.call_args_list
+    output = capsys.readouterr().out
+    assert "one.main: entered state 'down' after 0.00s" in output
+    assert "two.main: failed to enter state 'down' after 10.00s" in output
+
+
+def test_wait_for_envoy_state_stops_when_a_service_has_no_backends(capsys):
+    def check_envoy_state(service, expected_state, envoy_eds_dir):
+        if service == "one.main":
+            raise updown_service.NoBackendsError(service)
+        return False
+
+    start = time.monotonic()
+    with mock.patch("nerve_tools.updown_service.check_envoy_state", side_effect=check_envoy_state):
+        actual_result = updown_service.wait_for_envoy_state(["one.main", "two.main"], "down", 300, 5, "/not/real")
+
+    assert actual_result == 1
+    # two.main wasn't waited for until the timeout
+    assert time.monotonic() - start < 5
+    captured = capsys.readouterr()
+    assert "one.main: has no backends in the service mesh" in captured.out
+    assert "two.main: stopped waiting to enter state 'down'" in captured.out
+    assert "No backends present in the service mesh" in captured.err
+
+
+def test_wait_for_envoy_state_raises_promptly_when_a_wait_fails():
+    def check_envoy_state(service, expected_state, envoy_eds_dir):
+        if service == "one.main":
+            raise KeyError("resources")
+        return False
+
+    start = time.monotonic()
+    with (
+        mock.patch("nerve_tools.updown_service.check_envoy_state", side_effect=check_envoy_state),
+        pytest.raises(KeyError),
+    ):
+        updown_service.wait_for_envoy_state(["one.main", "two.main"], "down", 300, 5, "/not/real")
+
+    # two.main wasn't waited for until the timeout
+    assert time.monotonic() - start < 5
+
+
+def test_wait_for_envoy_state_applies_wait_time_once():
+    with (
+        mock.patch("time.sleep") as mock_sleep,
+        mock.patch("nerve_tools.updown_service.check_envoy_state", return_value=True),
+    ):
+        actual_result = updown_service.wait_for_envoy_state(
+            ["one.main", "two.main", "three.main"], "down", 10, 5, "/not/real"
+        )
+
+    assert actual_result == 0
+    assert mock_sleep.call_args_list == [mock.call(5)]
+
+
+def test_main_drains_all_local_services():
+    local_services = [
+        ("one.main", {"port": 31000}),
+        ("one.main", {"port": 31001}),
+        ("two.main", {"port": 31002}),
+        ("unmanaged.main", {"port": 31003}),
+    ]
+    argv = ["updown_service", "--all-local", "--envoy-eds-dir", "/not/real", "-t", "30", "down"]
+    with (
+        mock.patch("sys.argv", argv),
+        mock.patch(
+            "nerve_tools.configure_nerve.call_paasta_dump_locally_running_services",
+            return_value=local_services,
+        ),
+        mock.patch(
+            "nerve_tools.updown_service.load_service_config",
+            side_effect=lambda service: _service_config(managed=service != "unmanaged.main"),
+        ) as mock_load,
+        mock.patch("nerve_tools.updown_service.reconfigure_hacheck") as mock_reconfigure,
+        mock.patch("nerve_tools.updown_service.wait_for_envoy_state", return_value=0) as mock_wait,
+        pytest.raises(SystemExit) as excinfo,
+    ):
+        updown_service.main()
+
+    assert excinfo.value.code == 0
+    services = ["one.main", "two.main", "unmanaged.main"]
+    hacheck = mock_reconfigure.call_args_list[0][0][3]
+    assert mock_reconfigure.call_args_list == [
+        mock.call("one.main", "down", 31000, hacheck),
+        mock.call("one.main", "down", 31001, hacheck),
+        mock.call("two.main", "down", 31002, hacheck),
+    ]
+    mock_wait.assert_called_once_with(
+        services=["one.main", "two.main"],
+        expected_state="down",
+        timeout=30,
+        wait_time=updown_service.DEFAULT_WAIT_TIME_S,
+        envoy_eds_dir="/not/real",
+        hacheck=hacheck,
+        envoy_admin=None,
+        zk=None,
+        service_configs={service: _service_config(managed=service != "unmanaged.main") for service in services},
+        drain_ports=None,
+    )
+    # Each service's config was only loaded once
+    assert mock_load.call_args_list == [mock.call(service) for service in services]
+
+
+def test_wait_for_envoy_state_asks_hacheck_about_all_once():
+    hacheck = mock.Mock(spec=HacheckClient)
+    hacheck.is_up.return_value = False
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    with (
+        mock.patch("time.sleep", side_effect=sleep),
+        mock.patch("time.monotonic", side_effect=lambda: clock[0]),
+        mock.patch("nerve_tools.updown_service.check_envoy_state", return_value=False),
+        mock.patch("nerve_tools.updown_service.check_local_healthcheck", side_effect=[False, False, True]),
+    ):
+        actual_result = updown_service.wait_for_envoy_state(["one.main"], "up", 10, 1, "/not/real", hacheck)
+
+    assert actual_result == 0
+    hacheck.is_up.assert_called_once_with("all")
+
+
+@pytest.mark.parametrize(
+    "health_status,expected_state,expected",
+    [
+        [{"eds_health_status": "HEALTHY"}, "up", True],
+        [{"eds_health_status": "HEALTHY"}, "down", False],
+        [{"eds_health_status": "HEALTHY", "failed_outlier_check": True}, "up", False],
+        [{"eds_health_status": "DRAINING"}, "down", True],
+        [None, "down", True],
+        [None, "up", False],
+    ],
+)
+def test_check_envoy_admin_state(health_status, expected_state, expected):
+    host_statuses = [
+        {"address": {"socket_address": {"address": "10.0.0.2", "port_value": 31337}}},
+    ]
+    if health_status is not None:
+        host_statuses.append(
+            {
+                "address": {"socket_address": {"address": "10.0.0.1", "port_value": 31337}},
+                "health_status": health_status,
+            }
+        )
+    envoy_admin = mock.Mock(spec=EnvoyAdminClient)
+    envoy_admin.get_cluster_status.return_value = {"name": "service.main", "host_statuses": host_statuses}
+
+    with mock.patch("nerve_tools.updown_service.get_my_ip_address", return_value="10.0.0.1"):
+        assert updown_service.check_envoy_admin_state("service.main", expected_state, envoy_admin) == expected
+    envoy_admin.get_cluster_status.assert_called_once_with("service.main")
+
+
+def test_check_envoy_admin_state_missing_cluster():
+    envoy_admin = mock.Mock(spec=EnvoyAdminClient)
+    envoy_admin.get_cluster_status.return_value = None
+
+    assert not updown_service.check_envoy_admin_state("service.main", "down", envoy_admin)
+
+
+def test_check_envoy_admin_state_no_backends():
+    envoy_admin = mock.Mock(spec=EnvoyAdminClient)
+    envoy_admin.get_cluster_status.return_value = {"name": "service.main", "host_statuses": []}
+
+    with pytest.raises(updown_service.NoBackendsError):
+        updown_service.check_envoy_admin_state("service.main", "down", envoy_admin)
+
+
+def test_wait_for_envoy_state_with_envoy_admin():
+    envoy_admin = mock.Mock(spec=EnvoyAdminClient)
+    with (
+        mock.patch("time.sleep"),
+        mock.patch("nerve_tools.updown_service.check_envoy_state") as mock_check_eds,
+        mock.patch("nerve_tools.updown_service.check_envoy_admin_state", return_value=True) as mock_check_admin,
+    ):
+        actual_result = updown_service.wait_for_envoy_state(
+            ["service.main"], "down", 10, 1, None, envoy_admin=envoy_admin
+        )
+
+    assert actual_result == 0
+    mock_check_admin.assert_called_once_with("service.main", "down", envoy_admin)
+    assert mock_check_eds.call_count == 0
+
+
+def test_wait_for_envoy_state_with_zk(fake_zk):
+    path = "/smartstack/global/service.main/instance"
+    fake_zk.create(path, b'{"host": "10.0.0.1", "port": 31337}', ephemeral=True, makepath=True)
+    timer = threading.Timer(0.1, fake_zk.delete, [path])
+
+    with (
+        mock.patch.object(updown_service, "ENVOY_POLL_INTERVAL_S", 60),
+        mock.patch("nerve_tools.updown_service.get_my_ip_address", return_value="10.0.0.1"),
+        mock.patch("nerve_tools.updown_service.check_envoy_state") as mock_check_eds,
+    ):
+        start = time.monotonic()
+        timer.start()
+        actual_result = updown_service.wait_for_envoy_state(["service.main"], "down", 120, 0, "/not/real", zk=fake_zk)
+        elapsed = time.monotonic() - start
+    timer.join()
+
+    assert actual_result == 0
+    # Woken by the deregistration, long before the next poll was due
+    assert elapsed < 30
+    assert mock_check_eds.call_count == 0
+
+
+PROC_NET_TCP = """\
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000:7A69 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 662 1
+   1: 0100007F:7A69 0100007F:D431 01 00000000:00000000 00:00000000 00000000     0        0 663 1
+   2: 0100007F:7A69 0100007F:D432 01 00000000:00000000 00:00000000 00000000     0        0 664 1
+   3: 0100007F:7A69 0100007F:D433 06 00000000:00000000 03:00000BA9 00000000     0        0 0 3
+   4: 0100007F:D434 0100007F:7A69 01 00000000:00000000 00:00000000 00000000     0        0 665 1
+   5: 0100007F:7A6A 0100007F:D435 01 00000000:00000000 00:00000000 00000000     0        0 666 1
+"""
+
+
+def test_get_established_connection_count(tmp_path):
+    (tmp_path / "tcp").write_text(PROC_NET_TCP)
+    paths = [str(tmp_path / "tcp"), str(tmp_path / "missing")]
+
+    # Only established connections to the port, not from it
+    assert updown_service.get_established_connection_count({31337}, paths) == 2
+    # Nothing's seen listening on the others, so their connections can't be counted
+    assert updown_service.get_established_connection_count({31337, 31338}, paths) is None
+    assert updown_service.get_established_connection_count({1234}, paths) is None
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/net/tcp"), reason="needs /proc/net/tcp")
+def test_get_established_connection_count_of_real_connections():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+        assert updown_service.get_established_connection_count({port}) == 0
+
+        client = socket.create_connection(("127.0.0.1", port))
+        server, _ = listener.accept()
+        assert updown_service.get_established_connection_count({port}) == 1
+        client.close()
+        server.close()
+        assert updown_service.get_established_connection_count({port}) == 0
+
+
+@pytest.mark.parametrize(
+    "connection_counts,expected_elapsed_s",
+    [
+        # Already drained, so only the minimum wait
+        [[0], 1.0],
+        [[3, 2, 1, 0], 1.0],
+        # Drains after the minimum wait, then the quiet period
+        [[1] * 30 + [0], 1.75],
+        # Never drains, so the whole wait
+        [[1], 5],
+        # Can't be told, so the whole wait
+        [[None], 5],
+    ],
+)
+def test_wait_for_connections_to_drain(connection_counts, expected_elapsed_s):
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    counts = iter(connection_counts)
+    with (
+        mock.patch("time.sleep", side_effect=sleep),
+        mock.patch("time.monotonic", side_effect=lambda: clock[0]),
+        mock.patch(
+            "nerve_tools.updown_service.get_established_connection_count",
+            side_effect=lambda ports: next(counts, connection_counts[-1]),
+        ),
+    ):
+        elapsed_s = updown_service.wait_for_connections_to_drain({31337}, 5)
+    # Give or take a poll
+    assert elapsed_s == pytest.approx(expected_elapsed_s, abs=updown_service.DRAIN_POLL_INTERVAL_S + 0.001)
+
+
+def test_wait_for_envoy_state_waits_for_drain():
+    with (
+        mock.patch("time.sleep") as mock_sleep,
+        mock.patch("nerve_tools.updown_service.check_envoy_state", return_value=True),
+        mock.patch("nerve_tools.updown_service.wait_for_connections_to_drain", return_value=0.3) as mock_drain,
+    ):
+        actual_result = updown_service.wait_for_envoy_state(
+            ["one.main"], "down", 10, 5, "/not/real", drain_ports={31337}
+        )
+
+    assert actual_result == 0
+    mock_drain.assert_called_once_with({31337}, 5)
+    assert mock_sleep.call_count == 0
+
+
+def test_get_drain_ports():
+    assert updown_service.get_drain_ports([("one.main", 31337), ("two.main", 31338)]) == {31337, 31338}
+    # Can't tell when one.main has drained
+    assert updown_service.get_drain_ports([("one.main", None), ("two.main", 31338)]) is None
@@ -0,0 +1,54 @@
+import json
+import threading
+
+from nerve_tools.zk_registrations import RegistrationWatcher
+from nerve_tools.zk_registrations import get_registered_host
+
+
+def _register(zk, path, host):
+    zk.create(path, json.dumps({"host": host, "port": 31337}).encode(), ephemeral=True, makepath=True)
+
+
+def test_get_registered_host():
+    assert get_registered_host(b'{"host": "10.0.0.1", "port": 31337}') == "10.0.0.1"
+    assert get_registered_host(b"") is None
+    assert get_registered_host(b"[]") is None
+
+
+def test_get_registered_hosts(fake_zk):
+    _register(fake_zk, "/smartstack/global/service.main/a", "10.0.0.1")
+    _register(fake_zk, "/envoy/global/service.main/b", "10.0.0.2")
+    _register(fake_zk, "/smartstack/global/other.main/c", "10.0.0.3")
+    fake_zk.create("/smartstack/global/service.main/orphan", makepath=True)
+    registrations = RegistrationWatcher(fake_zk, "service.main")
+
+    assert registrations.get_registered_hosts() == {"10.0.0.1", "10.0.0.2"}
+
+    fake_zk.delete("/envoy/global/service.main/b")
+    _register(fake_zk, "/envoy/global/service.main/d", "10.0.0.4")
+    fake_zk.ops.clear()
+    assert registrations.get_registered_hosts() == {"10.0.0.1", "10.0.0.4"}
+    # Only the new node was read
+    assert fake_zk.ops["get"] == 1
+
+
+def test_wait_wakes_on_registration_changes(fake_zk):
+    _register(fake_zk, "/smartstack/global/service.main/a", "10.0.0.1")
+    registrations = RegistrationWatcher(fake_zk, "service.main")
+    registrations.get_registered_hosts()
+
+    assert not registrations.wait(0.01)
+    timer = threading.Timer(0.05, fake_zk.delete, ["/smartstack/global/service.main/a"])
+    timer.start()
+    assert registrations.wait(30)
+    timer.join()
+    assert registrations.get_registered_hosts() == set()
+
+
+def test_wait_wakes_when_service_is_first_registered(fake_zk):
+    registrations = RegistrationWatcher(fake_zk, "service.main")
+    assert registrations.get_registered_hosts() == set()
+
+    _register(fake_zk, "/envoy/global/service.main/a", "10.0.0.1")
+    assert registrations.wait(0)
+    assert registrations.get_registered_hosts() == {"10.0.0.1"}
@@ -0,0 +1,165 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from nerve_tools import clean_nerve
+from nerve_tools import configure_nerve
+from nerve_tools import zk_topology
+
+
+@pytest.fixture
+def zk_topology_dir(tmp_path):
+    topology_dir = tmp_path / "zookeeper_discovery"
+    (topology_dir / "infrastructure").mkdir(parents=True)
+    (topology_dir / "infrastructure" / "westcoast-prod.yaml").write_text('- ["zk1", 2181]\n- ["zk2", 2181]\n')
+    (topology_dir / "infrastructure" / "westcoast-dev.yaml").write_text('- ["zk3", 2181]\n')
+    os.symlink(
+        topology_dir / "infrastructure" / "westcoast-prod.yaml",
+        topology_dir / "infrastructure" / "local.yaml",
+    )
+    zk_topology._zk_topology_indexes.clear()
+    zk_topology._checked_zk_topology_indexes.clear()
+    yield str(topology_dir)
+    zk_topology._zk_topology_indexes.clear()
+    zk_topology._checked_zk_topology_indexes.clear()
+
+
+@pytest.fixture
+def clock():
+    clock = [0.0]
+    with mock.patch("nerve_tools.zk_topology.time.monotonic", side_effect=lambda: clock[0]):
+        yield clock
+
+
+def _compile(zk_topology_dir):
+    index = zk_topology.compile_zk_topology_index(zk_topology_dir)
+    zk_topology.write_zk_topology_index(index, zk_topology.get_zk_topology_index_path(zk_topology_dir))
+    return index
+
+
+def test_get_zk_topology_index_path():
+    assert zk_topology.get_zk_topology_index_path("/nail/etc/zk/") == "/nail/etc/zk.index.json"
+
+
+def test_compile_zk_topology_index(zk_topology_dir):
+    index = zk_topology.compile_zk_topology_index(zk_topology_dir)
+    assert index["version"] == zk_topology.ZK_TOPOLOGY_INDEX_VERSION
+    assert index["topologies"] == {
+        "infrastructure": {
+            "local": ["zk1:2181", "zk2:2181"],
+            "westcoast-dev": ["zk3:2181"],
+            "westcoast-prod": ["zk1:2181", "zk2:2181"],
+        },
+    }
+    assert index["symlinks"] == {"infrastructure": ["local"]}
+    assert set(index["manifest"]) == {
+        ".",
+        "infrastructure",
+        "infrastructure/local.yaml",
+        "infrastructure/westcoast-dev.yaml",
+        "infrastructure/westcoast-prod.yaml",
+    }
+
+
+def test_load_zk_topology_index(zk_topology_dir):
+    index = _compile(zk_topology_dir)
+    assert zk_topology.load_zk_topology_index(zk_topology_dir) == index
+
+
+def test_load_zk_topology_index_missing(zk_topology_dir):
+    assert zk_topology.load_zk_topology_index(zk_topology_dir) is None
+
+
+def test_load_zk_topology_index_stale(zk_topology_dir, clock):
+    _compile(zk_topology_dir)
+    assert zk_topology.load_zk_topology_index(zk_topology_dir) is not None
+    path = os.path.join(zk_topology_dir, "infrastructure", "westcoast-dev.yaml")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    # Not noticed until it's next checked
+    assert zk_topology.load_zk_topology_index(zk_topology_dir) is not None
+    clock[0] += zk_topology.ZK_TOPOLOGY_INDEX_CHECK_INTERVAL_S
+    assert zk_topology.load_zk_topology_index(zk_topology_dir) is None
+
+
+def test_load_zk_topology_index_checks_once_per_interval(zk_topology_dir, clock):
+    _compile(zk_topology_dir)
+    with (
+        mock.patch("os.stat", wraps=os.stat) as mock_stat,
+        mock.patch("os.scandir", wraps=os.scandir) as mock_scandir,
+    ):
+        for _ in range(100):
+            assert zk_topology.load_zk_topology_index(zk_topology_dir) is not None
+        # Just the once: the index file and topology directory are stat()ed,
+        # and it and its one cluster type directory scanned
+        assert mock_stat.call_count == 2
+        assert mock_scandir.call_count == 2
+
+        mock_stat.reset_mock()
+        mock_scandir.reset_mock()
+        clock[0] += zk_topology.ZK_TOPOLOGY_INDEX_CHECK_INTERVAL_S
+        for _ in range(100):
+            assert zk_topology.load_zk_topology_index(zk_topology_dir) is not None
+        assert mock_stat.call_count == 2
+        assert mock_scandir.call_count == 2
+
+
+def test_load_zk_topology_index_recompiled(zk_topology_dir, clock):
+    _compile(zk_topology_dir)
+    assert zk_topology.load_zk_topology_index(zk_topology_dir)["topologies"]["infrastructure"]["westcoast-dev"] == [
+        "zk3:2181"
+    ]
+
+    # Within the same process, as clean_nerve --daemon would see it
+    with open(os.path.join(zk_topology_dir, "infrastructure", "westcoast-dev.yaml"), "w") as fp:
+        fp.write('- ["zk4", 2181]\n')
+    _compile(zk_topology_dir)
+    clock[0] += zk_topology.ZK_TOPOLOGY_INDEX_CHECK_INTERVAL_S
+    assert zk_topology.load_zk_topology_index(zk_topology_dir)["topologies"]["infrastructure"]["westcoast-dev"] == [
+        "zk4:2181"
+    ]
+
+
+def test_compile_zk_topology_index_dangling_symlink(zk_topology_dir):
+    os.symlink(
+        os.path.join(zk_topology_dir, "infrastructure", "gone.yaml"),
+        os.path.join(zk_topology_dir, "infrastructure", "dangling.yaml"),
+    )
+    index = _compile(zk_topology_dir)
+    assert "infrastructure/dangling.yaml" not in index["manifest"]
+    assert "dangling" not in index["topologies"]["infrastructure"]
+    assert zk_topology.load_zk_topology_index(zk_topology_dir) == index
+
+
+def test_load_zk_topology_index_wrong_version(zk_topology_dir):
+    index = _compile(zk_topology_dir)
+    index["version"] = zk_topology.ZK_TOPOLOGY_INDEX_VERSION + 1
+    with open(zk_topology.get_zk_topology_index_path(zk_topology_dir), "w") as fp:
+        json.dump(index, fp)
+    assert zk_topology.load_zk_topology_index(zk_topology_dir) is None
+
+
+def test_configure_nerve_uses_index(zk_topology_dir):
+    _compile(zk_topology_dir)
+    # The YAML files should not be opened at all
+    with mock.patch("nerve_tools.configure_nerve.open", side_effect=AssertionError, create=True):
+        assert configure_nerve.get_named_zookeeper_topology("infrastructure", "westcoast-dev", zk_topology_dir) == [
+            "zk3:2181"
+        ]
+        with pytest.raises(KeyError):
+            configure_nerve.get_named_zookeeper_topology("infrastructure", "nowhere", zk_topology_dir)
+
+
+def test_clean_nerve_uses_index(zk_topology_dir, monkeypatch):
+    monkeypatch.setattr(clean_nerve, "ZK_TOPOLOGY_DIR", zk_topology_dir)
+    _compile(zk_topology_dir)
+    assert sorted(clean_nerve.get_zk_cluster_locations("infrastructure")) == ["westcoast-dev", "westcoast-prod"]
+    assert clean_nerve.get_zk_topology("infrastructure", "westcoast-dev") == ["zk3:2181"]
+
+
+def test_main(zk_topology_dir):
+    with mock.patch("sys.argv", ["compile_zk_topology_index", "--zk-topology-dir", zk_topology_dir]):
+        zk_topology.main()
+    assert zk_topology.load_zk_topology_index(zk_topology_dir) is not None